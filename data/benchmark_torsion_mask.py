@@ -0,0 +1,91 @@
+"""
+Benchmarks get_torsion_mask against the previous implementation, which removes each bond from a copy of
+the molecular graph and recounts the connected components, and checks that both give the same masks.
+Small molecules (segments without residues, e.g. CSD) are timed as whole segments, proteins and nucleic
+acids block by block as get_side_chain_torsion_mask_block runs it.
+    python -m data.benchmark_torsion_mask --data_file data/train.pkl --max_items 1000
+"""
+import argparse
+import time
+
+import networkx as nx
+import numpy as np
+from tqdm import tqdm
+
+from .dataset import open_data_file, data_to_blocks
+from .pdb_utils import VOCAB
+from .torsion import get_torsion_mask
+from .tokenizer.mol_atom_match import struct_to_topology
+
+RESIDUES = set([x[0] for x in VOCAB.aas] + [x[0] for x in VOCAB.bases])
+
+
+def get_torsion_mask_by_components(atoms, coords):
+    """previous get_torsion_mask, O(n_edges * (n_atoms + n_edges))"""
+    G = struct_to_topology(atoms, coords)
+    edges = list(nx.edges(G))
+    mask_edges, mask_rotate = [], []
+    if nx.number_connected_components(G) > 1:
+        mask_edges = [False] * len(edges)
+        return np.array(edges), np.array(mask_edges), np.array(mask_rotate)
+    for i in range(0, len(edges)):
+        G2 = G.copy()
+        G2.remove_edge(*edges[i])
+        if nx.number_connected_components(G2) == 2:
+            l1 = list(sorted(nx.connected_components(G2), key=len)[0])
+            l2 = list(sorted(nx.connected_components(G2), key=len)[1])
+            if len(l1) > 1 and len(l2) > 1:
+                mask_rotate.append([i in l1 for i in range(len(G.nodes()))])
+                mask_edges.append(True)
+            else:
+                mask_edges.append(False)
+        else:
+            mask_edges.append(False)
+    return np.array(edges), np.array(mask_edges), np.array(mask_rotate)
+
+
+def molecules(data_file, max_items):
+    """(kind, atoms, coords) of the small molecule segments and of the residues of the items"""
+    data = open_data_file(data_file)
+    for i in range(min(len(data), max_items) if max_items is not None else len(data)):
+        for blocks in data_to_blocks(data[i]['data']):
+            if len(set(block.symbol for block in blocks).intersection(RESIDUES)) > 0:
+                for block in blocks:
+                    yield 'sidechain', [unit.element for unit in block.units], [unit.coordinate for unit in block.units]
+            else:
+                atoms = [unit.element for block in blocks for unit in block.units]
+                yield 'molecule', atoms, [unit.coordinate for block in blocks for unit in block.units]
+
+
+def main(args):
+    VOCAB.load_tokenizer(args.fragmentation_method)
+    timings = {}
+    for kind, atoms, coords in tqdm(molecules(args.data_file, args.max_items), desc='Benchmarking torsion masks'):
+        if len(atoms) < 2:
+            continue
+        t = timings.setdefault(kind, {'n': 0, 'max_atoms': 0, 'bridges': 0.0, 'components': 0.0})
+        start = time.perf_counter()
+        edges, mask_edges, mask_rotate = get_torsion_mask(atoms, coords)
+        t['bridges'] += time.perf_counter() - start
+        start = time.perf_counter()
+        ref_edges, ref_mask_edges, ref_mask_rotate = get_torsion_mask_by_components(atoms, coords)
+        t['components'] += time.perf_counter() - start
+        for res, ref in zip([edges, mask_edges, mask_rotate], [ref_edges, ref_mask_edges, ref_mask_rotate]):
+            assert res.dtype == ref.dtype and res.shape == ref.shape and np.array_equal(res, ref), f'Different torsion masks for {kind} with {len(atoms)} atoms'
+        t['n'] += 1
+        t['max_atoms'] = max(t['max_atoms'], len(atoms))
+    for kind, t in timings.items():
+        print(f"{kind}: {t['n']} molecules (at most {t['max_atoms']} atoms), bridges {t['bridges']:.2f}s, "
+              f"connected components {t['components']:.2f}s, speedup {t['components'] / max(t['bridges'], 1e-9):.1f}x")
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Benchmark the torsion mask computation')
+    parser.add_argument('--data_file', type=str, required=True)
+    parser.add_argument('--max_items', type=int, default=None)
+    parser.add_argument('--fragmentation_method', type=str, default=None, choices=['PS_300', 'PS_500'])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse())
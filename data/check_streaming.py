@@ -0,0 +1,125 @@
+"""
+Checks that StreamingDataset reads every item exactly once per epoch across DDP ranks and DataLoader workers,
+for a single shard, for more workers than shards and for shards of uneven sizes, and that resumed epochs
+continue where they stopped. Also checks that shards of unknown size (num_items given, no count index)
+are not counted when the dataset is created. Without --data_file the shards are temporary .pkl files of dummy items.
+    python -m data.check_streaming
+    python -m data.check_streaming --data_file "data/pretrain/part_*.jsonl.gz"
+"""
+import os
+import pickle
+import argparse
+import tempfile
+
+from .streaming import StreamingDataset, list_shards, count_index_path
+
+
+class ItemIdDataset:
+    '''source that keeps every item and transforms it into its id'''
+    collate_fn = None
+
+    def _filter_item(self, item):
+        return item
+
+    def _transform_item(self, item):
+        return item['id']
+
+
+def epoch_ids(dataset, world_size, num_workers):
+    '''ids read by every (rank, worker) slot in the current epoch'''
+    return [list(dataset.iter_slot(rank, world_size, worker_id, num_workers))
+            for rank in range(world_size) for worker_id in range(num_workers)]
+
+
+def check(path, all_ids, world_size, num_workers, batch_size, shuffle):
+    dataset = StreamingDataset([(ItemIdDataset(), path)], shuffle=shuffle, shuffle_buffer=16,
+                               batch_size=batch_size, items_per_shard=100)
+    n_expected = len(all_ids) // world_size // batch_size * batch_size * world_size
+    setting = f'world_size={world_size}, num_workers={num_workers}, batch_size={batch_size}, shuffle={shuffle}'
+    for epoch in range(2):
+        dataset.set_epoch(epoch)
+        slots = epoch_ids(dataset, world_size, num_workers)
+        ids = [i for slot in slots for i in slot]
+        assert len(ids) == n_expected, f'{len(ids)} items instead of {n_expected} ({setting})'
+        assert len(set(ids)) == len(ids), f'{len(ids) - len(set(ids))} items read more than once ({setting})'
+        assert set(ids) <= all_ids, f'unknown items ({setting})'
+        if n_expected == len(all_ids):
+            assert set(ids) == all_ids, f'{len(all_ids - set(ids))} items not read ({setting})'
+
+        # resuming after some batches of each rank yields the rest of the epoch
+        n_batches = dataset._num_batches(world_size)
+        resume_index = n_batches // 2 * batch_size
+        dataset.set_epoch(epoch, resume_index)
+        resumed = epoch_ids(dataset, world_size, num_workers)
+        dataset.set_epoch(epoch)
+        for rank in range(world_size):
+            batches = interleave(slots[rank * num_workers:(rank + 1) * num_workers], batch_size)
+            resumed_batches = interleave(resumed[rank * num_workers:(rank + 1) * num_workers], batch_size)
+            assert batches[n_batches // 2:] == resumed_batches, f'resumed epoch differs ({setting})'
+
+
+def check_unknown_sizes(path, all_ids, world_size, num_workers, batch_size):
+    '''with num_items given and no count index, files are not read when the dataset is created'''
+    for data_file in list_shards(path):
+        if os.path.exists(count_index_path(data_file)):
+            os.remove(count_index_path(data_file))
+    dataset = StreamingDataset([(ItemIdDataset(), path)], shuffle_buffer=16, batch_size=batch_size,
+                               num_items=len(all_ids))
+    setting = f'unknown sizes, world_size={world_size}, num_workers={num_workers}, batch_size={batch_size}'
+    assert not any(os.path.exists(count_index_path(data_file)) for data_file in list_shards(path)), \
+        f'shards counted although num_items is given ({setting})'
+    n_expected = len(all_ids) // world_size // batch_size * batch_size * world_size
+    ids = [i for slot in epoch_ids(dataset, world_size, num_workers) for i in slot]
+    assert len(ids) == n_expected, f'{len(ids)} items instead of {n_expected} ({setting})'
+    assert set(ids) <= all_ids, f'unknown items ({setting})'
+
+
+def interleave(slots, batch_size):
+    '''batches in the order the DataLoader takes them from its workers, one batch of each in turn'''
+    batches = [[slot[i:i + batch_size] for i in range(0, len(slot), batch_size)] for slot in slots]
+    res = []
+    for i in range(max(len(b) for b in batches)):
+        res.extend(b[i] for b in batches if i < len(b))
+    return res
+
+
+def write_dummy_shards(out_dir, sizes):
+    n = 0
+    for k, size in enumerate(sizes):
+        with open(os.path.join(out_dir, f'part_{k}.pkl'), 'wb') as fout:
+            pickle.dump([{'id': f'item_{n + i}'} for i in range(size)], fout)
+        n += size
+
+
+def main(args):
+    if args.data_file is not None:
+        dataset = StreamingDataset([(ItemIdDataset(), args.data_file)])
+        all_ids = [item['id'] for shard in dataset.shards for item in dataset._read_shard(shard)]
+        assert len(set(all_ids)) == len(all_ids), 'item ids of the data are not unique'
+        settings = [(args.data_file, set(all_ids))]
+    else:
+        tmp_dir = tempfile.TemporaryDirectory()
+        settings = []
+        for name, sizes in [('single', [1000]), ('few', [300, 7, 450]), ('many', [5, 90, 13, 61, 200, 33, 8, 120])]:
+            os.makedirs(os.path.join(tmp_dir.name, name))
+            write_dummy_shards(os.path.join(tmp_dir.name, name), sizes)
+            settings.append((os.path.join(tmp_dir.name, name), {f'item_{i}' for i in range(sum(sizes))}))
+    for path, all_ids in settings:
+        for world_size in [1, 2, 3]:
+            for num_workers in [1, 4]:
+                for batch_size in [1, 8]:
+                    for shuffle in [True, False]:
+                        check(path, all_ids, world_size, num_workers, batch_size, shuffle)
+                    if args.data_file is None:
+                        check_unknown_sizes(path, all_ids, world_size, num_workers, batch_size)
+        print(f'{path}: every item is read once per epoch')
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Check that streaming reads every item once per epoch')
+    parser.add_argument('--data_file', type=str, default=None, help='data file, directory or glob pattern of shards with unique item ids')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse())
@@ -0,0 +1,247 @@
+import os
+import json
+import gzip
+import pickle
+import argparse
+
+import numpy as np
+import orjson
+from tqdm import tqdm
+
+
+# per-atom and per-block arrays of item['data'], stored concatenated over all items
+ATOM_KEYS = ['X', 'A', 'atom_positions']
+BLOCK_KEYS = ['B', 'block_lengths', 'segment_ids']
+CORE_KEYS = ATOM_KEYS + BLOCK_KEYS
+DTYPES = {
+    'X': np.float32,
+    'A': np.int32,
+    'atom_positions': np.int32,
+    'B': np.int32,
+    'block_lengths': np.int32,
+    'segment_ids': np.int32,
+}
+META_FILE = 'meta.json'
+FORMAT_VERSION = 1
+
+
+def is_columnar(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+class ColumnarWriter:
+    '''
+    Streams items (the same nested dicts as in the .pkl/.jsonl.gz files) into a columnar directory:
+        meta.json: number of items, dtypes and shapes of the columns
+        {X, A, atom_positions}.bin: per-atom arrays of all items, concatenated
+        {B, block_lengths, segment_ids}.bin: per-block arrays of all items, concatenated
+        atom_offsets.npy, block_offsets.npy: [n_items + 1], start of each item in the arrays above
+        extra.bin, extra_offsets.npy: every other field of the item and of item['data'], pickled per item
+        ids.json: id of each item
+    '''
+    def __init__(self, path, x_dtype=np.float32):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtypes = dict(DTYPES, X=np.dtype(x_dtype).type)
+        self.files = {key: open(os.path.join(path, f'{key}.bin'), 'wb') for key in CORE_KEYS + ['extra']}
+        self.atom_offsets, self.block_offsets, self.extra_offsets = [0], [0], [0]
+        self.ids = []
+
+    def add(self, item):
+        data = item['data']
+        n_atoms, n_blocks = len(data['A']), len(data['B'])
+        for key in CORE_KEYS:
+            value = np.asarray(data[key], dtype=self.dtypes[key])
+            expected = n_atoms if key in ATOM_KEYS else n_blocks
+            assert value.shape[0] == expected, f'{key} of {item["id"]} has {value.shape[0]} entries, expected {expected}'
+            self.files[key].write(value.tobytes())
+        extra = {
+            'item': {k: v for k, v in item.items() if k not in ('id', 'data')},
+            'data': {k: v for k, v in data.items() if k not in CORE_KEYS},
+        }
+        extra = pickle.dumps(extra, protocol=pickle.HIGHEST_PROTOCOL)
+        self.files['extra'].write(extra)
+        self.atom_offsets.append(self.atom_offsets[-1] + n_atoms)
+        self.block_offsets.append(self.block_offsets[-1] + n_blocks)
+        self.extra_offsets.append(self.extra_offsets[-1] + len(extra))
+        self.ids.append(item['id'])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        np.save(os.path.join(self.path, 'atom_offsets.npy'), np.array(self.atom_offsets, dtype=np.int64))
+        np.save(os.path.join(self.path, 'block_offsets.npy'), np.array(self.block_offsets, dtype=np.int64))
+        np.save(os.path.join(self.path, 'extra_offsets.npy'), np.array(self.extra_offsets, dtype=np.int64))
+        with open(os.path.join(self.path, 'ids.json'), 'wb') as fout:
+            fout.write(orjson.dumps(self.ids))
+        meta = {
+            'version': FORMAT_VERSION,
+            'n_items': len(self.ids),
+            'columns': {
+                key: {
+                    'dtype': np.dtype(self.dtypes[key]).str,
+                    'shape': [self.atom_offsets[-1] if key in ATOM_KEYS else self.block_offsets[-1]] + ([3] if key == 'X' else []),
+                } for key in CORE_KEYS
+            },
+        }
+        # written last, so an interrupted conversion is not recognized as a columnar store
+        with open(os.path.join(self.path, META_FILE), 'w') as fout:
+            json.dump(meta, fout, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ColumnarStore:
+    '''
+    Read-only, memory-mapped view of a directory written by ColumnarWriter. Behaves like the list of items
+    returned by open_data_file: store[i] builds the item dict, whose core arrays in item['data'] are
+    zero-copy numpy views into the memory-mapped columns (copy them before modifying in place).
+    Items can be replaced in memory with store[i] = item (e.g. after cropping), which does not touch the files.
+    '''
+    def __init__(self, path, selected=None, overrides=None):
+        self.path = path
+        self.selected = selected  # indexes of the items in the files, None for all
+        self.overrides = {} if overrides is None else overrides  # position -> item, replaced in memory
+        self._open()
+
+    def _open(self):
+        with open(os.path.join(self.path, META_FILE), 'r') as fin:
+            meta = json.load(fin)
+        assert meta['version'] == FORMAT_VERSION, f'Unsupported columnar format version {meta["version"]}'
+        self.columns = {}
+        for key, col in meta['columns'].items():
+            file = os.path.join(self.path, f'{key}.bin')
+            if col['shape'][0] == 0:  # np.memmap cannot map empty files
+                self.columns[key] = np.zeros(col['shape'], dtype=col['dtype'])
+            else:
+                self.columns[key] = np.asarray(np.memmap(file, dtype=col['dtype'], mode='r', shape=tuple(col['shape'])))
+        self.atom_offsets = np.load(os.path.join(self.path, 'atom_offsets.npy'), mmap_mode='r')
+        self.block_offsets = np.load(os.path.join(self.path, 'block_offsets.npy'), mmap_mode='r')
+        self.extra_offsets = np.load(os.path.join(self.path, 'extra_offsets.npy'), mmap_mode='r')
+        extra_file = os.path.join(self.path, 'extra.bin')
+        self.extra = np.memmap(extra_file, dtype=np.uint8, mode='r') if os.path.getsize(extra_file) > 0 else None
+        with open(os.path.join(self.path, 'ids.json'), 'rb') as fin:
+            self.all_ids = orjson.loads(fin.read())
+        self._id_to_idx = None
+
+    def __getstate__(self):
+        # memory maps are reopened instead of copied when sent to DataLoader workers
+        return {'path': self.path, 'selected': self.selected, 'overrides': self.overrides}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.all_ids) if self.selected is None else len(self.selected)
+
+    def _file_idx(self, idx):
+        return idx if self.selected is None else int(self.selected[idx])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx in self.overrides:
+            return self.overrides[idx]
+        i = self._file_idx(idx)
+        a0, a1 = self.atom_offsets[i], self.atom_offsets[i + 1]
+        b0, b1 = self.block_offsets[i], self.block_offsets[i + 1]
+        data = {key: self.columns[key][a0:a1] for key in ATOM_KEYS}
+        data.update({key: self.columns[key][b0:b1] for key in BLOCK_KEYS})
+        extra = pickle.loads(self.extra[self.extra_offsets[i]:self.extra_offsets[i + 1]].tobytes()) if self.extra is not None else {'item': {}, 'data': {}}
+        data.update(extra['data'])
+        item = {'id': self.all_ids[i], 'data': data}
+        item.update(extra['item'])
+        return item
+
+    def __setitem__(self, idx, item):
+        self.overrides[idx] = item
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    @property
+    def ids(self):
+        if self.selected is None:
+            return list(self.all_ids)
+        return [self.all_ids[i] for i in self.selected]
+
+    def index(self, item_id):
+        '''position of the item with the given id'''
+        if self._id_to_idx is None:
+            self._id_to_idx = {item_id: idx for idx, item_id in enumerate(self.ids)}
+        return self._id_to_idx[item_id]
+
+    def num_blocks(self, idx):
+        if idx in self.overrides:
+            return len(self.overrides[idx]['data']['B'])
+        i = self._file_idx(idx)
+        return int(self.block_offsets[i + 1] - self.block_offsets[i])
+
+    def num_atoms(self, idx):
+        if idx in self.overrides:
+            return len(self.overrides[idx]['data']['A'])
+        i = self._file_idx(idx)
+        return int(self.atom_offsets[i + 1] - self.atom_offsets[i])
+
+    def sizes(self):
+        '''numbers of blocks and atoms of all items, [n_items] each, without building the items'''
+        selected = np.arange(len(self.all_ids)) if self.selected is None else np.asarray(self.selected)
+        n_blocks = np.asarray(self.block_offsets)[selected + 1] - np.asarray(self.block_offsets)[selected]
+        n_atoms = np.asarray(self.atom_offsets)[selected + 1] - np.asarray(self.atom_offsets)[selected]
+        for idx in self.overrides:
+            n_blocks[idx], n_atoms[idx] = self.num_blocks(idx), self.num_atoms(idx)
+        return n_blocks, n_atoms
+
+    def subset(self, indexes):
+        '''a store with only the items at the given positions, sharing the memory maps'''
+        indexes = np.asarray(indexes, dtype=np.int64)
+        position = {int(old): new for new, old in enumerate(indexes)}
+        overrides = {position[old]: item for old, item in self.overrides.items() if old in position}
+        selected = indexes if self.selected is None else np.asarray(self.selected)[indexes]
+        return ColumnarStore(self.path, selected=selected, overrides=overrides)
+
+
+def iter_data_file(data_file):
+    '''iterates over the items of a .pkl or .jsonl.gz file, streaming the latter'''
+    if data_file.endswith('.jsonl.gz'):
+        with gzip.open(data_file, 'rb') as f:
+            for line in f:
+                item = orjson.loads(line)
+                if 'block_to_pdb_indexes' in item:
+                    item['block_to_pdb_indexes'] = {int(k): v for k, v in item['block_to_pdb_indexes'].items()}
+                yield item
+    elif data_file.endswith('.pkl'):
+        with open(data_file, 'rb') as f:
+            yield from pickle.load(f)
+    else:
+        raise ValueError('Unknown file format')
+
+
+def convert_to_columnar(data_file, out_path, x_dtype=np.float32):
+    with ColumnarWriter(out_path, x_dtype=x_dtype) as writer:
+        for item in tqdm(iter_data_file(data_file), desc=f'Converting {data_file}'):
+            writer.add(item)
+    return out_path
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Convert a .pkl or .jsonl.gz dataset into the memory-mapped columnar format')
+    parser.add_argument('--input', type=str, required=True, help='dataset file, .pkl or .jsonl.gz')
+    parser.add_argument('--output', type=str, required=True, help='output directory, e.g. data.columnar')
+    parser.add_argument('--x_dtype', type=str, default='float32', choices=['float32', 'float64'], help='dtype of the coordinates')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse()
+    convert_to_columnar(args.input, args.output, x_dtype=np.dtype(args.x_dtype))
+    store = ColumnarStore(args.output)
+    print(f'Wrote {len(store)} items, {store.atom_offsets[-1]} atoms, {store.block_offsets[-1]} blocks to {args.output}')
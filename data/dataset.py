@@ -1,13 +1,16 @@
 # Source https://github.com/THUNLP-MT/GET
 
 import os
+import bisect
 import pickle
+import hashlib
 import argparse
 from tqdm.contrib.concurrent import process_map
 from os.path import basename, splitext
 from typing import List
 from collections import Counter
 import gzip
+import zipfile
 import orjson
 import numpy as np
 import torch
@@ -15,10 +18,61 @@ import biotite.structure as bs
 import biotite.structure.io.pdb as pdb
 
 from utils.logger import print_log
-from .pdb_utils import Atom, VOCAB, dist_matrix_from_coords
+from .pdb_utils import Atom, VOCAB, interface_from_coords
+from .columnar import ColumnarStore, is_columnar
 
 
 MODALITIES = {"PP":0, "PL":1, "Pion":2, "Ppeptide":3, "PRNA":4, "PDNA":5, "RNAL":6, "CSD":7}
+TORCH_TO_NUMPY = {torch.float: np.float32, torch.long: np.int64, torch.bool: np.bool_}
+
+
+class CollateBuffers:
+    '''
+    Reusable host memory for collated batches, pinned by default so that the copies to the GPU can be
+    asynchronous. The buffers rotate over n_slots sets, a batch stays valid until n_slots - 1 further batches
+    are collated. Only useful when batches are collated in the main process (num_workers=0), tensors from
+    DataLoader workers are passed through shared memory anyway.
+    '''
+    def __init__(self, n_slots=2, pin_memory=True):
+        self.slots = [{} for _ in range(n_slots)]
+        self.slot = 0
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+    def next_batch(self):
+        self.slot = (self.slot + 1) % len(self.slots)
+
+    def get(self, key, shape, dtype):
+        buffers = self.slots[self.slot]
+        numel = int(np.prod(shape))
+        if key not in buffers or buffers[key].dtype != dtype or buffers[key].numel() < numel:
+            # some headroom, so that the buffers are not reallocated for every slightly larger batch
+            buffers[key] = torch.empty(int(numel * 1.25) + 1, dtype=dtype, pin_memory=self.pin_memory)
+        return buffers[key][:numel].view(shape)
+
+
+class BufferedCollate:
+    '''collate_fn for the DataLoader, which collates into CollateBuffers'''
+    def __init__(self, collate_fn, buffers):
+        self.collate_fn = collate_fn
+        self.buffers = buffers
+
+    def __call__(self, batch):
+        self.buffers.next_batch()
+        return self.collate_fn(batch, buffers=self.buffers)
+
+
+def collate_cat(batch, key, dtype, buffers=None):
+    '''
+    concatenates a per-item field of the batch along the first dimension with a single np.concatenate,
+    into a new tensor sharing memory with the numpy result, or into CollateBuffers if given
+    '''
+    arrays = [np.asarray(item[key]) for item in batch]
+    np_dtype = TORCH_TO_NUMPY[dtype]
+    if buffers is None:
+        return torch.from_numpy(np.concatenate(arrays, axis=0, dtype=np_dtype))
+    out = buffers.get(key, (sum(len(a) for a in arrays),) + arrays[0].shape[1:], dtype)
+    np.concatenate(arrays, axis=0, out=out.numpy())
+    return out
 
 class Block:
     def __init__(self, symbol: str, units: List[Atom]) -> None:
@@ -183,11 +237,7 @@ def blocks_interface(blocks1, blocks2, dist_th, return_indexes=False):
     blocks_coord, blocks_mask = blocks_to_coords(blocks1 + blocks2)
     blocks1_coord, blocks1_mask = blocks_coord[:len(blocks1)], blocks_mask[:len(blocks1)]
     blocks2_coord, blocks2_mask = blocks_coord[len(blocks1):], blocks_mask[len(blocks1):]
-    dist = dist_matrix_from_coords(blocks1_coord, blocks1_mask, blocks2_coord, blocks2_mask)
-    
-    on_interface = dist < dist_th
-    indexes1 = np.nonzero(on_interface.sum(axis=1) > 0)[0]
-    indexes2 = np.nonzero(on_interface.sum(axis=0) > 0)[0]
+    indexes1, indexes2 = interface_from_coords(blocks1_coord, blocks1_mask, blocks2_coord, blocks2_mask, dist_th)
 
     blocks1 = [blocks1[i] for i in indexes1]
     blocks2 = [blocks2[i] for i in indexes2]
@@ -364,15 +414,10 @@ class BlockGeoAffDataset(torch.utils.data.Dataset):
         return new_data
 
     @classmethod
-    def collate_fn(cls, batch):
+    def collate_fn(cls, batch, buffers=None):
         keys = ['X', 'B', 'A', 'atom_positions', 'block_lengths', 'segment_ids']
         types = [torch.float, torch.long, torch.long, torch.long, torch.long, torch.long]
-        res = {}
-        for key, _type in zip(keys, types):
-            val = []
-            for item in batch:
-                val.append(torch.tensor(item[key], dtype=_type))
-            res[key] = torch.cat(val, dim=0)
+        res = {key: collate_cat(batch, key, _type, buffers) for key, _type in zip(keys, types)}
         res['label'] = torch.tensor([item['label'] for item in batch], dtype=torch.float)
         lengths = [len(item['B']) for item in batch]
         res['lengths'] = torch.tensor(lengths, dtype=torch.long)
@@ -383,6 +428,7 @@ class PDBBindBenchmark(torch.utils.data.Dataset):
 
     def __init__(self, data_file):
         super().__init__()
+        self.data_file = data_file
         self.data = open_data_file(data_file)
         self.indexes = [ {'id': item['id'], 'label': item['affinity']['neglog_aff'] } for item in self.data ]  # to satify the requirements of inference.py
 
@@ -409,7 +455,7 @@ class PDBBindBenchmark(torch.utils.data.Dataset):
         return data
 
     @classmethod
-    def collate_fn(cls, batch):
+    def collate_fn(cls, batch, buffers=None):
         keys = ['X', 'B', 'A', 'block_lengths', 'segment_ids']
         types = [torch.float, torch.long, torch.long, torch.long, torch.long]
         has_block_embeddings = 'block_embeddings' in batch[0]
@@ -422,12 +468,7 @@ class PDBBindBenchmark(torch.utils.data.Dataset):
             keys.append('block_embeddings1')
             types.append(torch.float)
             types.append(torch.float)
-        res = {}
-        for key, _type in zip(keys, types):
-            val = []
-            for item in batch:
-                val.append(torch.tensor(item[key], dtype=_type))
-            res[key] = torch.cat(val, dim=0)
+        res = {key: collate_cat(batch, key, _type, buffers) for key, _type in zip(keys, types)}
         res['label'] = torch.tensor([item['label'] for item in batch], dtype=torch.float)
         lengths = [len(item['B']) for item in batch]
         res['lengths'] = torch.tensor(lengths, dtype=torch.long)
@@ -438,8 +479,9 @@ class PDBDataset(torch.utils.data.Dataset):
 
     def __init__(self, data_file):
         super().__init__()
+        self.data_file = data_file
         self.data = open_data_file(data_file)
-        self.indexes = [ item['id'] for item in self.data ]  # to satify the requirements of inference.py
+        self.indexes = get_item_ids(self.data)  # to satify the requirements of inference.py
 
     def __len__(self):
         return len(self.data)
@@ -462,15 +504,10 @@ class PDBDataset(torch.utils.data.Dataset):
         return data
 
     @classmethod
-    def collate_fn(cls, batch):
+    def collate_fn(cls, batch, buffers=None):
         keys = ['X', 'B', 'A', 'atom_positions', 'block_lengths', 'segment_ids']
         types = [torch.float, torch.long, torch.long, torch.long, torch.long, torch.long]
-        res = {}
-        for key, _type in zip(keys, types):
-            val = []
-            for item in batch:
-                val.append(torch.tensor(item[key], dtype=_type))
-            res[key] = torch.cat(val, dim=0)
+        res = {key: collate_cat(batch, key, _type, buffers) for key, _type in zip(keys, types)}
         lengths = [len(item['B']) for item in batch]
         res['lengths'] = torch.tensor(lengths, dtype=torch.long)
         return res
@@ -480,8 +517,9 @@ class ProtInterfaceDataset(PDBDataset):
     def __init__(self, data_file):
         super().__init__(data_file)
 
-        for item in self.data:
-            item['prot_data'] = BlockGeoAffDataset.filter_for_segment(item['data'], 0)
+        if not isinstance(self.data, ColumnarStore):  # items of columnar stores are filtered on access
+            for item in self.data:
+                item['prot_data'] = BlockGeoAffDataset.filter_for_segment(item['data'], 0)
 
     
     def __getitem__(self, idx):
@@ -496,8 +534,12 @@ class ProtInterfaceDataset(PDBDataset):
             'segment_ids': [Nblock]
         }        
         '''
-        cmplx_data = self.data[idx]['data']
-        prot_data = self.data[idx]['prot_data']
+        item = self.data[idx]
+        cmplx_data = item['data']
+        if 'prot_data' in item:
+            prot_data = item['prot_data']
+        else:
+            prot_data = BlockGeoAffDataset.filter_for_segment(dict(cmplx_data), 0)
 
         data = {
             'cmplx': cmplx_data,
@@ -507,7 +549,8 @@ class ProtInterfaceDataset(PDBDataset):
         return data
 
     @classmethod
-    def collate_fn(cls, batch):
+    def collate_fn(cls, batch, buffers=None):
+        # no buffers, the protein and the complex would write into the same ones
         batch_prot = super().collate_fn([item['prot'] for item in batch])
         batch_cmplx = super().collate_fn([item['cmplx'] for item in batch])
 
@@ -522,8 +565,9 @@ class LabelledPDBDataset(torch.utils.data.Dataset):
 
     def __init__(self, data_file):
         super().__init__()
+        self.data_file = data_file
         self.data = open_data_file(data_file)
-        self.indexes = [ item['id'] for item in self.data ]  # to satify the requirements of inference.py
+        self.indexes = get_item_ids(self.data)  # to satify the requirements of inference.py
 
     def __len__(self):
         return len(self.data)
@@ -550,18 +594,11 @@ class LabelledPDBDataset(torch.utils.data.Dataset):
         return data
 
     @classmethod
-    def collate_fn(cls, batch):
+    def collate_fn(cls, batch, buffers=None):
         keys = ['X', 'B', 'A', 'atom_positions', 'block_lengths', 'segment_ids', 'label']
         types = [torch.float, torch.long, torch.long, torch.long, torch.long, torch.long, torch.float]
-        res = {}
-        for key, _type in zip(keys, types):
-            val = []
-            for item in batch:
-                val.append(torch.tensor(item[key], dtype=_type))
-            if key == 'label':
-                res[key] = torch.tensor(val, dtype=_type)
-            else:
-                res[key] = torch.cat(val, dim=0)
+        res = {key: collate_cat(batch, key, _type, buffers) for key, _type in zip(keys[:-1], types[:-1])}
+        res['label'] = torch.tensor([item['label'] for item in batch], dtype=types[-1])
         lengths = [len(item['B']) for item in batch]
         res['lengths'] = torch.tensor(lengths, dtype=torch.long)
         return res
@@ -571,8 +608,9 @@ class MultiClassLabelledPDBDataset(torch.utils.data.Dataset):
 
     def __init__(self, data_file):
         super().__init__()
+        self.data_file = data_file
         self.data = open_data_file(data_file)
-        self.indexes = [ item['id'] for item in self.data ]  # to satify the requirements of inference.py
+        self.indexes = get_item_ids(self.data)  # to satify the requirements of inference.py
 
     def __len__(self):
         return len(self.data)
@@ -597,18 +635,11 @@ class MultiClassLabelledPDBDataset(torch.utils.data.Dataset):
         return data
 
     @classmethod
-    def collate_fn(cls, batch):
+    def collate_fn(cls, batch, buffers=None):
         keys = ['X', 'B', 'A', 'atom_positions', 'block_lengths', 'segment_ids', 'label']
         types = [torch.float, torch.long, torch.long, torch.long, torch.long, torch.long, torch.long]
-        res = {}
-        for key, _type in zip(keys, types):
-            val = []
-            for item in batch:
-                val.append(torch.tensor(item[key], dtype=_type))
-            if key == 'label':
-                res[key] = torch.tensor(val, dtype=_type)
-            else:
-                res[key] = torch.cat(val, dim=0)
+        res = {key: collate_cat(batch, key, _type, buffers) for key, _type in zip(keys[:-1], types[:-1])}
+        res['label'] = torch.tensor([item['label'] for item in batch], dtype=types[-1])
         lengths = [len(item['B']) for item in batch]
         res['lengths'] = torch.tensor(lengths, dtype=torch.long)
         return res
@@ -645,16 +676,120 @@ class MixDatasetWrapper(torch.utils.data.Dataset):
         return None
 
 
+class EdgeCacheDataset(torch.utils.data.Dataset):
+    '''
+    Adds the edges of an EdgeStore (see models/edge_cache.py) to the batches of a dataset with fixed coordinates,
+    as batch['precomputed_edges'], so that the model skips the neighbor search.
+    Other attributes are those of the wrapped dataset.
+    '''
+    def __init__(self, dataset, edge_store) -> None:
+        super().__init__()
+        assert len(dataset) == len(edge_store), f'{len(dataset)} items in the dataset but {len(edge_store)} in the edge store'
+        self.dataset = dataset
+        self.edge_store = edge_store
+
+    def __getattr__(self, name):
+        if name in ('dataset', 'edge_store'):  # not set yet, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        item = dict(self.dataset[idx])  # shallow copy, the raw item is not modified
+        item['edge_store_index'] = idx
+        return item
+
+    def collate_fn(self, batch, buffers=None):
+        res = self.dataset.collate_fn(batch, buffers=buffers)
+        res['precomputed_edges'] = self.edge_store.precomputed_edges(
+            [item['edge_store_index'] for item in batch], res['lengths'], res['block_lengths'])
+        return res
+
+
+
+def _item_sizes(dataset):
+    '''numbers of blocks and atoms of each item as it is batched, read from the raw items without transforming them'''
+    if isinstance(dataset, ProtInterfaceDataset):
+        # the protein segment is batched alongside the complex
+        n_blocks, n_atoms = [], []
+        for item in dataset.data:
+            data = item['data']
+            prot_mask = np.asarray(data['segment_ids']) == 0
+            n_blocks.append(len(data['B']) + int(prot_mask.sum()))
+            n_atoms.append(len(data['A']) + int(np.asarray(data['block_lengths'])[prot_mask].sum()))
+        return np.array(n_blocks, dtype=np.int64), np.array(n_atoms, dtype=np.int64)
+    data = getattr(dataset, 'data', None)
+    if isinstance(data, ColumnarStore):
+        return data.sizes()
+    if isinstance(data, list):
+        data = [item['data'] if 'data' in item else item for item in data]
+    else:  # no raw items, measure the returned ones
+        data = [dataset[i] for i in range(len(dataset))]
+    n_blocks = [len(item['B']) if 'B' in item else item['len'] for item in data]
+    n_atoms = [len(item['A']) if 'A' in item else 0 for item in data]
+    return np.array(n_blocks, dtype=np.int64), np.array(n_atoms, dtype=np.int64)
+
+
+def load_size_index(dataset):
+    '''
+    numbers of blocks and atoms of each item of the dataset, [n_items] each. The index is saved next to the
+    data file as {data_file}.sizes.npz and reused while the dataset has the same items (ids and crop setting).
+    Items cropped before training keep their block count between runs, their atom count is from the crop
+    of the run that built the index.
+    '''
+    if isinstance(dataset, MixDatasetWrapper):
+        sizes = [load_size_index(d) for d in dataset.datasets]
+        return np.concatenate([s[0] for s in sizes]), np.concatenate([s[1] for s in sizes])
+    if isinstance(dataset, EdgeCacheDataset):
+        return load_size_index(dataset.dataset)
+    data_file = getattr(dataset, 'data_file', None)
+    if data_file is None or not hasattr(dataset, 'data'):
+        return _item_sizes(dataset)
+    crop = getattr(dataset, 'crop', None)
+    fingerprint = hashlib.sha1()
+    fingerprint.update(f'{type(dataset).__name__}|{None if crop is None else crop.max_blocks}|'.encode())
+    fingerprint.update('\n'.join(str(item_id) for item_id in get_item_ids(dataset.data)).encode())
+    fingerprint = fingerprint.hexdigest()
+
+    index_file = data_file.rstrip('/') + '.sizes.npz'
+    if os.path.exists(index_file):
+        try:
+            with np.load(index_file) as index:
+                if str(index['fingerprint']) == fingerprint:
+                    return index['n_blocks'], index['n_atoms']
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            print_log(f'Failed to load the size index from {index_file} ({e}), rebuilding it', level='WARN')
+    n_blocks, n_atoms = _item_sizes(dataset)
+    try:
+        # concurrent builds (e.g. DDP ranks) each write their own file, the rename is atomic
+        tmp = f'{index_file}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as fout:  # np.savez would append .npz to the name
+            np.savez(fout, fingerprint=fingerprint, n_blocks=n_blocks, n_atoms=n_atoms)
+        os.replace(tmp, index_file)
+    except OSError as e:
+        print_log(f'Failed to save the size index to {index_file}: {e}', level='WARN')
+    return n_blocks, n_atoms
+
+
+def estimate_edges(n_blocks, n_atoms, k_neighbors):
+    '''estimated number of edges of the atom-level and block-level KNN graphs of the items'''
+    return k_neighbors * (n_atoms + n_blocks)
+
 
 class DynamicBatchWrapper(torch.utils.data.Dataset):
-    def __init__(self, dataset, max_n_vertex_per_batch, max_n_vertex_per_item=None, shuffle=True) -> None:
+    def __init__(self, dataset, max_n_vertex_per_batch, max_n_vertex_per_item=None, shuffle=True, k_neighbors=9) -> None:
         super().__init__()
         self.dataset = dataset
-        self.indexes = [i for i in range(len(dataset))]
+        self.indexes = np.arange(len(dataset))
         self.max_n_vertex_per_batch = max_n_vertex_per_batch
         if max_n_vertex_per_item is None:
             max_n_vertex_per_item = max_n_vertex_per_batch
         self.max_n_vertex_per_item = max_n_vertex_per_item
+        # batches are formed from the sizes alone, without building the items
+        self.n_blocks, self.n_atoms = load_size_index(dataset)
+        self.n_edges = estimate_edges(self.n_blocks, self.n_atoms, k_neighbors)
         self.total_size = None
         self.batch_indexes = []
         self.shuffle = shuffle
@@ -665,28 +800,32 @@ class DynamicBatchWrapper(torch.utils.data.Dataset):
         if self.shuffle:
             np.random.shuffle(self.indexes)
         last_batch_indexes = self.batch_indexes
-        self.batch_indexes = []
 
-        cur_vertex_cnt = 0
-        batch = []
-        
-        num_too_large = 0
-
-        for i in self.indexes:
-            data = self.dataset[i]
-            item_len = len(data['B']) if 'B' in data else data['len']
-            if item_len > self.max_n_vertex_per_item:
-                num_too_large += 1
-                continue
-            cur_vertex_cnt += item_len
-            if cur_vertex_cnt > self.max_n_vertex_per_batch:
-                self.batch_indexes.append(batch)
-                batch = []
-                cur_vertex_cnt = item_len
-            batch.append(i)
-        self.batch_indexes.append(batch)
+        indexes = np.asarray(self.indexes)
+        too_large = self.n_blocks[indexes] > self.max_n_vertex_per_item
+        num_too_large = int(too_large.sum())
+        self.batch_indexes = self._pack(indexes[~too_large])
+        if len(self.batch_indexes) == 0:
+            self.batch_indexes.append([])
         print_log(f'Number of items too large: {num_too_large} out of {len(self.indexes)}. Remaining: {len(self.indexes) - num_too_large} batches. Created {len(self.batch_indexes)} batches.')
+        self._control_length(last_batch_indexes)
 
+    def _pack(self, indexes):
+        '''
+        greedily fills each batch up to max_n_vertex_per_batch vertexes, in the order of the indexes.
+        An item larger than a batch forms a batch by itself.
+        '''
+        cum_lens = np.concatenate([[0], np.cumsum(self.n_blocks[indexes])]).tolist()
+        indexes = np.asarray(indexes).tolist()
+        batch_indexes, start = [], 0
+        while start < len(indexes):
+            end = bisect.bisect_right(cum_lens, cum_lens[start] + self.max_n_vertex_per_batch, lo=start) - 1
+            end = max(end, start + 1)
+            batch_indexes.append(indexes[start:end])
+            start = end
+        return batch_indexes
+
+    def _control_length(self, last_batch_indexes):
         if self.total_size is None:
             self.total_size = len(self.batch_indexes)
         else:
@@ -697,39 +836,128 @@ class DynamicBatchWrapper(torch.utils.data.Dataset):
             else:
                 self.batch_indexes = self.batch_indexes[:self.total_size]
 
+    def batch_stats(self, max_n_edge_per_batch=None):
+        '''
+        statistics of the current batches:
+            padding: fraction of padded block slots when the blocks of each batch are padded to its largest item
+                (as in AttentionPooling)
+            vertex_utilization, edge_utilization: mean fraction of the per-batch budgets that is filled
+            edge_cv: coefficient of variation of the estimated edges per batch, a proxy for the spread of step times
+        '''
+        batches = [b for b in self.batch_indexes if len(b) > 0]
+        if len(batches) == 0:
+            return {'n_batches': 0}
+        sizes = np.array([len(b) for b in batches])
+        flat = np.concatenate([np.asarray(b, dtype=np.int64) for b in batches])
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        blocks = np.add.reduceat(self.n_blocks[flat], starts)
+        max_blocks = np.maximum.reduceat(self.n_blocks[flat], starts)
+        edges = np.add.reduceat(self.n_edges[flat], starts)
+        stats = {
+            'n_batches': len(batches),
+            'items_per_batch': float(sizes.mean()),
+            'padding': float(1 - blocks.sum() / (sizes * max_blocks).sum()),
+            'vertex_utilization': float((blocks / self.max_n_vertex_per_batch).mean()),
+            'edge_cv': float(edges.std() / edges.mean()),
+        }
+        if max_n_edge_per_batch is not None:
+            stats['edge_utilization'] = float((edges / max_n_edge_per_batch).mean())
+        return stats
+
     def __len__(self):
         return len(self.batch_indexes)
     
     def __getitem__(self, idx):
         return [self.dataset[i] for i in self.batch_indexes[idx]]
     
-    def collate_fn(self, batched_batch):
+    def collate_fn(self, batched_batch, buffers=None):
         batch = []
         for minibatch in batched_batch:
             batch.extend(minibatch)
-        return self.dataset.collate_fn(batch)
+        return self.dataset.collate_fn(batch, buffers=buffers)
+
+class BucketedDynamicBatchWrapper(DynamicBatchWrapper):
+    '''
+    Groups items of similar size into batches. Items are bucketed by their number of atoms (bucket boundaries
+    grow geometrically by bucket_ratio) and shuffled within their bucket. Going through the buckets from small
+    to large, each item goes into the fullest of the last open_batches batches that still has room for it, both
+    in max_n_vertex_per_batch vertexes and in max_n_edge_per_batch estimated KNN edges, which dominate the cost
+    of a step. The batches are shuffled afterwards, so the order of sizes is random over the epoch.
+    max_n_edge_per_batch defaults to the budget of vertexes times the median number of edges per vertex.
+    '''
+    def __init__(self, dataset, max_n_vertex_per_batch, max_n_vertex_per_item=None, shuffle=True, k_neighbors=9,
+                 max_n_edge_per_batch=None, bucket_ratio=1.25, open_batches=8) -> None:
+        self.max_n_edge_per_batch = max_n_edge_per_batch
+        self.bucket_ratio = bucket_ratio
+        self.open_batches = open_batches
+        super().__init__(dataset, max_n_vertex_per_batch, max_n_vertex_per_item, shuffle, k_neighbors)
+
+    def _form_batch(self):
+        if self.max_n_edge_per_batch is None:
+            self.max_n_edge_per_batch = int(self.max_n_vertex_per_batch * np.median(self.n_edges / np.maximum(self.n_blocks, 1)))
+        last_batch_indexes = self.batch_indexes
+
+        indexes = np.asarray(self.indexes)
+        too_large = self.n_blocks[indexes] > self.max_n_vertex_per_item
+        num_too_large = int(too_large.sum())
+        indexes = indexes[~too_large]
+        if self.shuffle:
+            indexes = indexes[np.random.permutation(len(indexes))]
+        # stable sort keeps the random order within a bucket
+        buckets = np.floor(np.log(np.maximum(self.n_atoms[indexes], 1)) / np.log(self.bucket_ratio)).astype(np.int64)
+        indexes, buckets = indexes[np.argsort(buckets, kind='stable')], np.sort(buckets)
+        self.batch_indexes = self._pack_best_fit(indexes)
+        if self.shuffle:
+            self.batch_indexes = [self.batch_indexes[i] for i in np.random.permutation(len(self.batch_indexes))]
+        if len(self.batch_indexes) == 0:
+            self.batch_indexes.append([])
+        print_log(f'Number of items too large: {num_too_large} out of {len(self.indexes)}. Created {len(self.batch_indexes)} batches from {len(np.unique(buckets))} size buckets.')
+        self._control_length(last_batch_indexes)
+        stats = self.batch_stats(self.max_n_edge_per_batch)
+        print_log(', '.join(f'{key}: {value:.3f}' if isinstance(value, float) else f'{key}: {value}' for key, value in stats.items()))
+
+    def _pack_best_fit(self, indexes):
+        batches, open_batches = [], []  # open batches are [item indexes, free vertexes, free edges]
+        for i, n_blocks, n_edges in zip(indexes.tolist(), self.n_blocks[indexes].tolist(), self.n_edges[indexes].tolist()):
+            best = None
+            for batch in open_batches:
+                if n_blocks <= batch[1] and n_edges <= batch[2] and (best is None or batch[2] < best[2]):
+                    best = batch
+            if best is None:  # also for items larger than a batch, which form a batch by themselves
+                open_batches.append([[i], self.max_n_vertex_per_batch - n_blocks, self.max_n_edge_per_batch - n_edges])
+                if len(open_batches) > self.open_batches:
+                    fullest = min(range(len(open_batches)), key=lambda j: open_batches[j][2])
+                    batches.append(open_batches.pop(fullest)[0])
+            else:
+                best[0].append(i)
+                best[1] -= n_blocks
+                best[2] -= n_edges
+        batches.extend(batch[0] for batch in open_batches)
+        return batches
+
 
 class BalancedDynamicBatchWrapper(DynamicBatchWrapper):
-    def __init__(self, dataset, max_n_vertex_per_batch, max_n_vertex_per_item=None, shuffle=True) -> None:
-        self.labels = Counter([item['label'] for item in dataset])
-        self.sampling_weights = [1 / self.labels[item['label']] for item in dataset]
+    def __init__(self, dataset, max_n_vertex_per_batch, max_n_vertex_per_item=None, shuffle=True, k_neighbors=9) -> None:
+        self.dataset_labels = [item['label'] for item in dataset]
+        self.labels = Counter(self.dataset_labels)
+        self.sampling_weights = [1 / self.labels[label] for label in self.dataset_labels]
         self.sampling_weights = np.array(self.sampling_weights) / sum(self.sampling_weights)
-        super().__init__(dataset, max_n_vertex_per_batch, max_n_vertex_per_item, shuffle)
+        super().__init__(dataset, max_n_vertex_per_batch, max_n_vertex_per_item, shuffle, k_neighbors)
         self._form_batch()
     
     def _form_batch(self):
         chosen_indexes = np.random.choice(len(self.dataset), size=len(self.dataset), replace=True, p=self.sampling_weights)
         self.indexes = chosen_indexes
         super()._form_batch()
-        print(f'Number of items in each class: {Counter([self.dataset[i]["label"] for i in self.indexes])}')
+        print(f'Number of items in each class: {Counter([self.dataset_labels[i] for i in self.indexes])}')
 
 class PretrainBalancedDynamicBatchWrapper(DynamicBatchWrapper):
-    def __init__(self, dataset, max_n_vertex_per_batch, max_n_vertex_per_item=None, shuffle=True) -> None:
+    def __init__(self, dataset, max_n_vertex_per_batch, max_n_vertex_per_item=None, shuffle=True, k_neighbors=9) -> None:
         self.dataset_labels = [dataset._get_raw_item(idx)['modality'] for idx in range(len(dataset))]
         self.labels = Counter(self.dataset_labels)
         self.sampling_weights = [1 / np.log(self.labels[label]) for label in self.dataset_labels] # downweight the large classes by log
         self.sampling_weights = np.array(self.sampling_weights) / sum(self.sampling_weights)
-        super().__init__(dataset, max_n_vertex_per_batch, max_n_vertex_per_item, shuffle)
+        super().__init__(dataset, max_n_vertex_per_batch, max_n_vertex_per_item, shuffle, k_neighbors)
         self._form_batch()
     
     def _form_batch(self):
@@ -750,7 +978,7 @@ def dataset_to_compressed_jsonl(dataset, output_file):
         for item in dataset:
             if 'block_to_pdb_indexes' in item:
                 item['block_to_pdb_indexes'] = {str(k): v for k, v in item['block_to_pdb_indexes'].items()}
-            f.write(orjson.dumps(item) + b"\n")
+            f.write(orjson.dumps(item, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n")  # e.g. packed torsion masks
 
 def compressed_jsonl_to_dataset(input_file):
     dataset = []
@@ -763,13 +991,28 @@ def compressed_jsonl_to_dataset(input_file):
     return dataset
 
 def open_data_file(data_file):
-    if data_file.endswith('.jsonl.gz'):
+    if is_columnar(data_file):
+        return ColumnarStore(data_file)
+    elif data_file.endswith('.jsonl.gz'):
         return compressed_jsonl_to_dataset(data_file)
     elif data_file.endswith('.pkl'):
         with open(data_file, 'rb') as f:
             return pickle.load(f)
     else:
         raise ValueError('Unknown file format')
+
+
+def get_item_ids(data):
+    if isinstance(data, ColumnarStore):
+        return data.ids  # without building the items
+    return [item['id'] for item in data]
+
+
+def subset_data(data, indexes):
+    '''keeps the items at the given positions, columnar stores stay memory-mapped'''
+    if isinstance(data, ColumnarStore):
+        return data.subset(indexes)
+    return [data[i] for i in indexes]
  
 
 if __name__ == '__main__':
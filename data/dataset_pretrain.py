@@ -1,49 +1,242 @@
+import os
+import json
 import pickle
+import hashlib
+import multiprocessing
 import torch
 import numpy as np
-import copy
 from collections import defaultdict
-from utils.noise_transforms import TorsionNoiseTransform, GaussianNoiseTransform, GlobalRotationTransform, GlobalTranslationTransform, CropTransform
+from utils.noise_transforms import TorsionNoiseTransform, GaussianNoiseTransform, GlobalRotationTransform, GlobalTranslationTransform, CropTransform, torsion_rotated_parts
 from torch_scatter import scatter_mean
 from tqdm import tqdm
-from .dataset import open_data_file
+from utils.logger import print_log
+from .dataset import open_data_file, get_item_ids, collate_cat, TORCH_TO_NUMPY
+from .columnar import ColumnarStore, CORE_KEYS, META_FILE, is_columnar
+from .torsion import is_packed_torsion_mask, pack_torsion_masks
+
+
+def _readonly_arrays(data):
+    '''
+    the per-atom and per-block fields of in-memory items as read-only arrays (as columnar stores return them), which
+    __getitem__ shares instead of copying. Forked DataLoader workers then read a few arrays per item instead of
+    touching (and duplicating the pages of) a Python object per atom.
+    '''
+    for key in CORE_KEYS:
+        value = np.asarray(data[key])
+        value.setflags(write=False)
+        data[key] = value
+    return data
+
+
+def _item_view(item):
+    '''shallow copy of item['data'] for the transforms, which only write into the coordinates, copied here'''
+    data = dict(item['data'])
+    data['X'] = np.array(data['X'])
+    return data
+
+
+def _mask_blocks(data, masked_blocks, atom_mask_token):
+    '''
+    replaces the atoms of each masked block by a single atom (atom_mask_token) at the center of the block
+    Returns:
+        X [Natom_masked, 3], A [Natom_masked] of the masked item and atom_map [Natom], the new index of each atom
+    '''
+    block_lengths = np.asarray(data['block_lengths'])
+    block_ids = np.repeat(np.arange(len(block_lengths)), block_lengths)
+    block_centers = scatter_mean(torch.tensor(np.asarray(data['X']), dtype=torch.float), torch.from_numpy(block_ids), dim=0).numpy()
+    first_atom = np.cumsum(block_lengths) - block_lengths
+    atom_masked = masked_blocks[block_ids]
+    # all atoms of unmasked blocks and the first atom of masked ones, which takes the place of its block
+    keep = ~atom_masked | (np.arange(len(block_ids)) == first_atom[block_ids])
+    new_index = np.cumsum(keep) - 1
+    atom_map = np.where(atom_masked, new_index[first_atom[block_ids]], new_index)
+    X = np.asarray(data['X'], dtype=float)[keep]
+    A = np.asarray(data['A'])[keep]
+    merged = new_index[first_atom[masked_blocks]]
+    X[merged] = block_centers[masked_blocks]
+    A[merged] = atom_mask_token
+    return X, A, atom_map
+
+
+PREPROCESS_VERSION = 2
+PREPROCESS_CHUNK_SIZE = 1000
+_preprocess_dataset = None  # the dataset whose items the forked workers of preprocess_items process
+
+
+def preprocess_cache_file(dataset, seed):
+    '''
+    file the preprocessed items of the dataset are saved to, next to the data file, named by a hash of the data file
+    (path, size and modification time), the dataset class and its crop and mask settings, and the seed of the random
+    crops if the items are cropped
+    '''
+    data_file = dataset.data_file.rstrip('/')
+    stat = os.stat(os.path.join(data_file, META_FILE) if is_columnar(data_file) else data_file)
+    params = {
+        'version': PREPROCESS_VERSION,
+        'dataset': type(dataset).__name__,
+        'source': [os.path.abspath(data_file), stat.st_size, stat.st_mtime_ns],
+        'crop': None if dataset.crop is None else [dataset.crop.max_blocks, dataset.crop.fragmentation_method],
+        'vocab_to_mask': [int(i) for i in getattr(dataset, 'vocab_to_mask', [])],
+        'seed': None if dataset.crop is None else int(seed),
+    }
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    name = os.path.basename(data_file).split('.')[0]
+    return os.path.join(os.path.dirname(data_file), f'{name}.{type(dataset).__name__}_{key}_processed.pkl')
+
+
+def _preprocess_chunk(args):
+    '''
+    (position, item, changed) of the items in [start, end) kept by _filter_item, changed if _filter_item replaced the
+    data of the item (cropped it). item is None for unchanged columnar items
+    '''
+    start, end, seed = args
+    dataset = _preprocess_dataset
+    in_memory = not isinstance(dataset.data, ColumnarStore)
+    state = np.random.get_state()
+    np.random.seed(seed)  # crops are random, the same for any number of workers
+    kept = []
+    for idx in range(start, end):
+        item = dataset.data[idx]
+        processed = dataset._filter_item(item)
+        if processed is None:
+            continue
+        changed = processed['data'] is not item['data']
+        if in_memory or changed:
+            processed['data'] = _readonly_arrays(pack_torsion_masks(processed['data']))
+            kept.append((idx, processed, changed))
+        else:  # columnar stores build the item on access
+            kept.append((idx, None, False))
+    np.random.set_state(state)
+    return kept
+
+
+def _load_preprocessed(dataset, cache_file):
+    with open(cache_file, 'rb') as fin:
+        cache = pickle.load(fin)
+    if is_columnar(dataset.data_file):
+        data = ColumnarStore(dataset.data_file).subset(cache['source_positions'])
+    else:
+        source = open_data_file(dataset.data_file)
+        data = [source[i] for i in cache['source_positions']]
+        del source
+    for idx, item in cache['overrides'].items():
+        data[idx] = item
+    for idx in (cache['overrides'] if isinstance(data, ColumnarStore) else range(len(data))):
+        data[idx]['data'] = _readonly_arrays(pack_torsion_masks(data[idx]['data']))
+    dataset.data = data
+    dataset.indexes = [{'id': item_id} for item_id in get_item_ids(data)]
+    dataset.source_positions = cache['source_positions']
+    if not isinstance(data, ColumnarStore):
+        dataset.changed_items = set(cache['overrides'])
+
+
+def preprocess_items(dataset, desc='Preprocessing'):
+    '''
+    crops (if set_crop was called) and filters the items of the dataset with its _filter_item, in dataset.n_cpu forked
+    processes, and keeps the torsion masks of in-memory items packed and their arrays read-only. The positions of the
+    kept items in the data file and the items changed by _filter_item (the cropped ones) are saved to
+    preprocess_cache_file, and the next run with the same data file, settings and seed reads the data file again and
+    takes them from there.
+    '''
+    global _preprocess_dataset
+    # drawn whether the cache exists or not, so that the crops depend on the seed of the run only
+    seed = np.random.randint(2 ** 31)
+    cache_file = preprocess_cache_file(dataset, seed)
+    if os.path.exists(cache_file):
+        print_log(f'Loading preprocessed data from {cache_file}')
+        _load_preprocessed(dataset, cache_file)
+        return
+    if dataset.data is None:
+        dataset.data = open_data_file(dataset.data_file)
+        dataset.indexes = [{'id': item_id} for item_id in get_item_ids(dataset.data)]
+        dataset.source_positions = np.arange(len(dataset.data))
+
+    n_items = len(dataset.data)
+    starts = range(0, n_items, PREPROCESS_CHUNK_SIZE)
+    seeds = np.random.RandomState(seed).randint(2 ** 31, size=len(starts))
+    chunks = [(start, min(start + PREPROCESS_CHUNK_SIZE, n_items), chunk_seed) for start, chunk_seed in zip(starts, seeds)]
+    _preprocess_dataset = dataset
+    try:
+        if dataset.n_cpu > 1 and len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            # the workers read the items of the forked dataset, only the kept ones are sent back
+            with multiprocessing.get_context('fork').Pool(min(dataset.n_cpu, len(chunks))) as pool:
+                results = list(tqdm(pool.imap(_preprocess_chunk, chunks), total=len(chunks), desc=desc))
+        else:
+            results = [_preprocess_chunk(chunk) for chunk in tqdm(chunks, desc=desc)]
+    finally:
+        _preprocess_dataset = None
+    kept = [x for result in results for x in result]
+    positions = np.array([idx for idx, _, _ in kept], dtype=np.int64)
+    print(f"Removed {n_items - len(kept)} items. Original={n_items} Cleaned={len(kept)}")
+
+    if isinstance(dataset.data, ColumnarStore):
+        data = dataset.data.subset(positions)
+        for idx, (_, item, _) in enumerate(kept):
+            if item is not None:
+                data[idx] = item  # cropped, kept in memory
+        overrides = data.overrides
+    else:
+        data = [item for _, item, _ in kept]
+        # items cropped by an earlier call differ from the data file too
+        changed_before = getattr(dataset, 'changed_items', set())
+        overrides = {idx: item for idx, (i, item, changed) in enumerate(kept) if changed or i in changed_before}
+        dataset.changed_items = set(overrides)
+    dataset.data = data
+    dataset.indexes = [dataset.indexes[i] for i in positions]
+    dataset.source_positions = np.asarray(dataset.source_positions)[positions]
+    cache = {'source_positions': dataset.source_positions, 'overrides': overrides}
+
+    try:
+        tmp = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as fout:
+            pickle.dump(cache, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+        print_log(f'Preprocessed data saved to {cache_file}')
+    except OSError as e:
+        print_log(f'Cannot save the preprocessed data to {cache_file} ({e})', level='WARN')
 
 class PretrainMaskedDataset(torch.utils.data.Dataset):
-    def __init__(self, data_file, mask_proportion, mask_token, atom_mask_token, vocab_to_mask):
+    def __init__(self, data_file, mask_proportion, mask_token, atom_mask_token, vocab_to_mask, n_cpu=4):
         super().__init__()
-        self.data = open_data_file(data_file)
-        self.indexes = [ {'id': item['id']} for item in self.data ]
+        self.data_file = data_file
+        self.data = None  # opened by preprocess unless the preprocessed items are cached
+        self.n_cpu = n_cpu  # processes used in preprocessing
         self.mask_proportion = mask_proportion
         self.mask_token = mask_token
         self.atom_mask_token = atom_mask_token
         self.vocab_to_mask = vocab_to_mask # list of vocab indices that can be masked
         self.idx_to_mask_block = dict(zip(self.vocab_to_mask, range(len(self.vocab_to_mask))))
+        self.mask_block_labels = np.full(max(self.vocab_to_mask, default=-1) + 1, -1, dtype=np.int64)  # idx_to_mask_block as an array
+        self.mask_block_labels[self.vocab_to_mask] = np.arange(len(self.vocab_to_mask))
         self.crop = None
         self.preprocess()
     
     def set_crop(self, max_n_vertex_per_item, fragmentation_method):
         self.crop = CropTransform(max_n_vertex_per_item-2, fragmentation_method) # 2 blocks are global blocks
-        for item in tqdm(self.data, desc="Preprocessing, cropping large items", total=len(self.data)):
-            data = item['data']
-            if len(data['B']) > self.crop.max_blocks:
-                data, keep_blocks = self.crop(data)
-                item['data'] = data
-        self.preprocess()
+        preprocess_items(self, desc="Preprocessing, cropping large items")
 
     def preprocess(self):
-        missing_maskable_nodes = []
-        for idx, item in enumerate(self.data):
-            data = item["data"]
-            can_mask0 = item["data"]["can_mask"] = np.where(np.logical_and(np.isin(np.array(data['B']), np.array(self.vocab_to_mask)), 
-                    np.array(data["segment_ids"])==0))[0].tolist()
-            can_mask1 = item["data"]["can_mask"] = np.where(np.logical_and(np.isin(np.array(data['B']), np.array(self.vocab_to_mask)), 
-                    np.array(data["segment_ids"])==1))[0].tolist()
-            item["data"]["can_mask"] = [can_mask0, can_mask1]
-            if len(can_mask0) == 0 or len(can_mask1) == 0:
-                missing_maskable_nodes.append(idx)
-        print(f"Removed {len(missing_maskable_nodes)} items with no maskable nodes. Original={len(self.data)} Cleaned={len(self.data) - len(missing_maskable_nodes)}")
-        self.data = [self.data[i] for i in range(len(self.data)) if i not in missing_maskable_nodes]
-        self.indexes = [self.indexes[i] for i in range(len(self.indexes)) if i not in missing_maskable_nodes]
+        # remove items with no maskable nodes in either segment
+        preprocess_items(self)
+
+    def _filter_item(self, item):
+        '''crops a single item and checks it as set_crop and preprocess do for the whole dataset, None if it is removed'''
+        if self.crop is not None and len(item['data']['B']) > self.crop.max_blocks:
+            item = dict(item)
+            item['data'], keep_blocks = self.crop(item['data'])
+        item['data'] = self.get_mask_for_item(item['data'])
+        can_mask0, can_mask1 = item["data"]["can_mask"]
+        if len(can_mask0) == 0 or len(can_mask1) == 0:
+            return None
+        return item
+
+    def get_mask_for_item(self, data):
+        can_mask0 = np.where(np.logical_and(np.isin(np.array(data['B']), np.array(self.vocab_to_mask)), 
+                np.array(data["segment_ids"])==0))[0].tolist()
+        can_mask1 = np.where(np.logical_and(np.isin(np.array(data['B']), np.array(self.vocab_to_mask)), 
+                np.array(data["segment_ids"])==1))[0].tolist()
+        data["can_mask"] = [can_mask0, can_mask1]
+        return data
     
     def __len__(self):
         return len(self.data)
@@ -66,52 +259,26 @@ class PretrainMaskedDataset(torch.utils.data.Dataset):
             'label': [Nmasked_blocks]
         }        
         '''
-        item = self.data[idx]
-        data = copy.deepcopy(item['data'])
-        B = np.array(data['B'])
+        data = dict(self.data[idx]['data'])  # new arrays are assigned below, the item is not modified
+        if "can_mask" not in data:  # items of columnar stores are built on access
+            data = self.get_mask_for_item(data)
+        B = np.asarray(data['B'])
         # mask blocks on the non-noisy side to not interfere with the noised torsion angles
-        can_mask = item["data"]["can_mask"][0] + item["data"]["can_mask"][1]
+        can_mask = data["can_mask"][0] + data["can_mask"][1]
         num_to_select = max(1, int(self.mask_proportion * len(can_mask)))
         selected_indices = np.random.choice(can_mask, size=num_to_select, replace=False)
-        masked_blocks = np.zeros_like(data['B'], dtype=bool)
+        masked_blocks = np.zeros(len(B), dtype=bool)
         masked_blocks[selected_indices] = True
 
-        block_ids = sum([block_len*[block_id] for block_id, block_len in enumerate(data['block_lengths'])], [])
-        block_centers = scatter_mean(torch.tensor(data['X'], dtype=torch.float), torch.tensor(block_ids, dtype=torch.long), dim=0).tolist()
-        masked_A, masked_X = [], []
-        old_A_map = {}
-        curr_block = 0
-        curr_A = 0
-        for block_id in range(len(B)):
-            block_len = data['block_lengths'][block_id]
-            if masked_blocks[block_id]:
-                for A_i in range(block_len):
-                    old_A_map[curr_A+A_i] = len(masked_A)
-                masked_A.append(self.atom_mask_token)
-                masked_X.append(block_centers[block_id])
-            else:
-                for A_i in range(block_len):
-                    old_A_map[curr_A+A_i] = len(masked_A) + A_i
-                masked_A.extend(data['A'][curr_block:curr_block+block_len])
-                masked_X.extend(data['X'][curr_block:curr_block+block_len])
-            curr_block += block_len
-            curr_A += block_len
-        data['A'] = masked_A
-        data['X'] = masked_X
-
-        block_lengths = np.array(data['block_lengths'])
-        block_lengths[masked_blocks] = 1
-        data['block_lengths'] = block_lengths.tolist()
-
-        data['masked_labels'] = [self.idx_to_mask_block[b] for b in B[masked_blocks].tolist()]
-        new_blocks = B
-        new_blocks[masked_blocks] = self.mask_token
-        data['B'] = new_blocks.tolist()
-        data['masked_blocks'] = masked_blocks.tolist()
+        data['X'], data['A'], _ = _mask_blocks(data, masked_blocks, self.atom_mask_token)
+        data['block_lengths'] = np.where(masked_blocks, 1, data['block_lengths'])
+        data['masked_labels'] = self.mask_block_labels[B[masked_blocks]]
+        data['B'] = np.where(masked_blocks, self.mask_token, B)
+        data['masked_blocks'] = masked_blocks
         return data
 
     @classmethod
-    def collate_fn(cls, batch):
+    def collate_fn(cls, batch, buffers=None):
         """
         an example of the returned batch
         {
@@ -127,39 +294,68 @@ class PretrainMaskedDataset(torch.utils.data.Dataset):
         """
         keys = ['X', 'B', 'A', 'atom_positions', 'block_lengths', 'segment_ids', 'masked_blocks', 'masked_labels']
         types = [torch.float, torch.long, torch.long, torch.long, torch.long, torch.long, torch.bool, torch.long]
-        res = {}
-        for key, _type in zip(keys, types):
-            val = []
-            for item in batch:
-                val.append(torch.tensor(item[key], dtype=_type))
-                res[key] = torch.cat(val, dim=0)
+        res = {key: collate_cat(batch, key, _type, buffers) for key, _type in zip(keys, types)}
         lengths = [len(item['B']) for item in batch]
         res['lengths'] = torch.tensor(lengths, dtype=torch.long)
         return res
 
+def _noisy_atom_range(data, chosen_segment):
+    '''global atom of the chosen segment and the end of its atoms'''
+    segment_ids, block_lengths = np.asarray(data['segment_ids']), np.asarray(data['block_lengths'])
+    global_atom = np.sum(block_lengths[segment_ids < chosen_segment])
+    return [global_atom, global_atom + np.sum(block_lengths[segment_ids == chosen_segment])]
+
+
+def _collate_noise_inputs(batch, torsion):
+    '''inputs of BatchNoiseTransform for a batch of clean items, with atom and edge indexes shifted by the previous items'''
+    atom_offsets = np.cumsum([0] + [len(item['X']) for item in batch[:-1]])
+    res = {
+        'noisy_segment': torch.tensor([item['noisy_segment'] for item in batch], dtype=torch.long),
+        'noisy_atom_range': torch.from_numpy(np.array([item['noisy_atom_range'] for item in batch], dtype=np.int64) + atom_offsets[:, None]),
+        'can_rotate': torch.tensor([item['can_rotate'] for item in batch], dtype=torch.bool),
+    }
+    if torsion:
+        num_tor_edges = [item['tor_edges'].shape[1] for item in batch]
+        num_rotated = [item['tor_rotated'].shape[1] for item in batch]
+        tor_edges = np.concatenate([item['tor_edges'] for item in batch], axis=1, dtype=np.int64)
+        tor_edges += np.repeat(atom_offsets, num_tor_edges)
+        edge_offsets = np.cumsum([0] + num_tor_edges[:-1])
+        tor_rotated = np.concatenate([item['tor_rotated'] for item in batch], axis=1, dtype=np.int64)
+        tor_rotated += np.stack([np.repeat(edge_offsets, num_rotated), np.repeat(atom_offsets, num_rotated)])
+        res['tor_edges'] = torch.from_numpy(tor_edges)
+        res['tor_rotated'] = torch.from_numpy(tor_rotated)
+        res['tor_batch'] = torch.from_numpy(np.repeat(np.arange(len(batch)), num_tor_edges))
+        res['tor_align'] = torch.tensor([item['tor_align'] for item in batch], dtype=torch.bool)
+    if 'atom_map' in batch[0]:
+        mapped_offsets = np.cumsum([0] + [len(item['A']) for item in batch[:-1]])
+        atom_map = np.concatenate([item['atom_map'] for item in batch], dtype=np.int64)
+        atom_map += np.repeat(mapped_offsets, [len(item['X']) for item in batch])
+        res['atom_map'] = torch.from_numpy(atom_map)
+    return res
+
+
 class PretrainTorsionDataset(torch.utils.data.Dataset):
 
-    def __init__(self, data_file):
+    def __init__(self, data_file, n_cpu=4):
         super().__init__()
-        self.data = open_data_file(data_file)
-        self.indexes = [ {'id': item['id']} for item in self.data ]  # to satify the requirements of inference.py
+        self.data_file = data_file
+        self.data = None if data_file is not None else []  # None until opened by preprocess, [] for no items, e.g. to transform streamed items
+        self.indexes = []  # to satify the requirements of inference.py
+        self.n_cpu = n_cpu  # processes used in preprocessing
         self.tor, self.global_tr, self.global_rot, self.crop = None, None, None, None
+        self.batch_noise = False
         # remove items with no torsion angles in either segment
         self.preprocess()
     
     def preprocess(self):
-        cleaned_data = []
-        cleaned_indexes = []
-        for item, index in zip(self.data, self.indexes):
-            if self._can_apply_torsion_noise(item["data"], 0) or self._can_apply_torsion_noise(item["data"], 1):
-                cleaned_data.append(item)
-                cleaned_indexes.append(index)
-        print(f"Removed {len(self.data) - len(cleaned_data)} items with no torsion angles. Original={len(self.data)} Cleaned={len(cleaned_data)}")
-        self.data = cleaned_data
-        self.indexes = cleaned_indexes
+        # items held in memory keep their torsion masks packed, columnar items are packed on access
+        if self.data_file is not None:
+            preprocess_items(self)
     
     @classmethod
     def _can_apply_torsion_noise(cls, data, chosen_segment):
+        if is_packed_torsion_mask(data['torsion_mask'][chosen_segment]):
+            return data['torsion_mask'][chosen_segment]['edges'] is not None
         return not ((data['torsion_mask'][chosen_segment]['edges'] is None) or all([edges is None for edges in data['torsion_mask'][chosen_segment]['edges']]))
 
     def set_torsion_noise(self, noise_level):
@@ -170,16 +366,25 @@ class PretrainTorsionDataset(torch.utils.data.Dataset):
 
     def set_rotation_noise(self, noise_level, max_theta):
         self.global_rot = GlobalRotationTransform(noise_level, max_theta)
+
+    def set_batch_noise(self):
+        # return clean items, the noise is applied to the collated batches by BatchNoiseTransform
+        self.batch_noise = True
     
     def set_crop(self, max_n_vertex_per_item, fragmentation_method):
         # crop all items before training
         self.crop = CropTransform(max_n_vertex_per_item-2, fragmentation_method) # 2 blocks are global blocks 
-        for item in tqdm(self.data, desc="Preprocessing, cropping large items", total=len(self.data)):
-            data = item['data']
-            if len(data['B']) > self.crop.max_blocks:
-                data, keep_blocks = self.crop(data)
-                item['data'] = data
-        self.preprocess()
+        if self.data_file is not None:
+            preprocess_items(self, desc="Preprocessing, cropping large items")
+
+    def _filter_item(self, item):
+        '''crops a single item and checks it as set_crop and preprocess do for the whole dataset, None if it is removed'''
+        if self.crop is not None and len(item['data']['B']) > self.crop.max_blocks:
+            item = dict(item)
+            item['data'], keep_blocks = self.crop(item['data'])
+        if self._can_apply_torsion_noise(item["data"], 0) or self._can_apply_torsion_noise(item["data"], 1):
+            return item
+        return None
 
     def __len__(self):
         return len(self.data)
@@ -189,6 +394,9 @@ class PretrainTorsionDataset(torch.utils.data.Dataset):
         return self.data[idx]
 
     def __getitem__(self, idx):
+        return self._transform_item(self.data[idx])
+
+    def _transform_item(self, item):
         '''
         an example of the returned data
         {
@@ -206,8 +414,7 @@ class PretrainTorsionDataset(torch.utils.data.Dataset):
             'noisy_segment': [1]
         }        
         '''
-        item = self.data[idx]
-        data = copy.deepcopy(item['data'])
+        data = _item_view(item)
         if 'modality' in item.keys():
             data['modality'] = item['modality']
         data['label'] = -1  # dummy label
@@ -224,6 +431,20 @@ class PretrainTorsionDataset(torch.utils.data.Dataset):
         if self._can_apply_torsion_noise(data, 1) and segment_length[1] > 2:
             choices.append(1)
         chosen_segment = np.random.choice(choices)
+
+        if self.batch_noise:
+            # clean coordinates, noised after collating by BatchNoiseTransform
+            parts = torsion_rotated_parts(data, chosen_segment)
+            if parts is None:
+                parts = np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            tor_edges, rotated_edge, rotated_atom = parts
+            data['noisy_segment'] = chosen_segment
+            data['noisy_atom_range'] = _noisy_atom_range(data, chosen_segment)
+            data['can_rotate'] = segment_length[0] > 2 and segment_length[1] > 2
+            data['tor_edges'] = tor_edges.T
+            data['tor_rotated'] = np.stack([rotated_edge, rotated_atom])
+            data['tor_align'] = data['torsion_mask'][chosen_segment]['type'] != 0 and len(tor_edges) > 0
+            return data
         
         if self.global_rot is not None:
             # segment length 2 means only one atom + global node, no need to rotate
@@ -253,7 +474,7 @@ class PretrainTorsionDataset(torch.utils.data.Dataset):
         return data
 
     @classmethod
-    def collate_fn(cls, batch):
+    def collate_fn(cls, batch, buffers=None):
         """
         an example of the returned batch
         {
@@ -285,42 +506,32 @@ class PretrainTorsionDataset(torch.utils.data.Dataset):
             types.append(torch.float)
             types.append(torch.float)
 
-        res = {}
-        for key, _type in zip(keys, types):
-            val = []
-            for item in batch:
-                if isinstance(item[key], np.ndarray):
-                    item[key] = item[key].tolist()
-                val.append(torch.tensor(item[key], dtype=_type))
-            res[key] = torch.cat(val, dim=0)
-        
-        res['tor_score'] = []
-        for item in batch:
-            if item['tor_score'] is not None:
-                res['tor_score'].append(torch.tensor(item['tor_score'], dtype=torch.float))
-        if len(res['tor_score']) == 0:
-            # Sometimes you get a batch with no torsion angles
-            res['tor_score'] = torch.zeros(0, dtype=torch.float)
+        res = {key: collate_cat(batch, key, _type, buffers) for key, _type in zip(keys, types)}
+
+        if 'noisy_atom_range' in batch[0]:
+            # clean items, the noise and its scores are added by BatchNoiseTransform
+            res.update(_collate_noise_inputs(batch, torsion=True))
+            res['tor_score'] = None
         else:
-            res['tor_score'] = torch.cat(res['tor_score'], dim=0)
-
-        keys_scalars = ['rot_score', 'tr_score', 'noisy_segment', 'tr_eps']
-        types_scalars = [torch.float, torch.float, torch.long, torch.float]
-        for key, _type in zip(keys_scalars, types_scalars):
-            val = [item[key] for item in batch]
-            val = np.array(val)
-            res[key] = torch.tensor(val, dtype=_type)
-        res['tor_edges'] = []
-        res['tor_batch'] = []
-        num_atoms = 0
-        for i, item in enumerate(batch):
-            res['tor_edges'].append(item['tor_edges'] + num_atoms)
-            num_atoms += len(item['A'])
-            res['tor_batch'].extend([i for _ in range(item['tor_edges'].shape[1])])
-        res['tor_edges'] = np.concatenate(res['tor_edges'], axis=1)
-        res['tor_edges'] = torch.tensor(res['tor_edges'], dtype=torch.long)
-        res['tor_batch'] = torch.tensor(res['tor_batch'], dtype=torch.long)
-        assert res['tor_edges'].shape[1] == res['tor_score'].shape[0] == res['tor_batch'].shape[0], "mismatch in tor score and number of tor edges"
+            tor_scores = [item['tor_score'] for item in batch if item['tor_score'] is not None]
+            if len(tor_scores) == 0:
+                # Sometimes you get a batch with no torsion angles
+                res['tor_score'] = torch.zeros(0, dtype=torch.float)
+            else:
+                res['tor_score'] = torch.from_numpy(np.concatenate(tor_scores, axis=0, dtype=np.float32))
+
+            keys_scalars = ['rot_score', 'tr_score', 'noisy_segment', 'tr_eps']
+            types_scalars = [torch.float, torch.float, torch.long, torch.float]
+            for key, _type in zip(keys_scalars, types_scalars):
+                res[key] = torch.from_numpy(np.array([item[key] for item in batch], dtype=TORCH_TO_NUMPY[_type]))
+            # shift the atom indexes of the torsion edges of each item by the atoms of the previous items
+            atom_offsets = np.cumsum([0] + [len(item['A']) for item in batch[:-1]])
+            num_tor_edges = [item['tor_edges'].shape[1] for item in batch]
+            tor_edges = np.concatenate([item['tor_edges'] for item in batch], axis=1, dtype=np.int64)
+            tor_edges += np.repeat(atom_offsets, num_tor_edges)
+            res['tor_edges'] = torch.from_numpy(tor_edges)
+            res['tor_batch'] = torch.from_numpy(np.repeat(np.arange(len(batch)), num_tor_edges))
+            assert res['tor_edges'].shape[1] == res['tor_score'].shape[0] == res['tor_batch'].shape[0], "mismatch in tor score and number of tor edges"
         res['label'] = torch.tensor([x['label'] for x in batch], dtype=torch.float)
         if 'modality' in batch[0].keys():
             res['modality'] = torch.tensor([x['modality'] for x in batch], dtype=torch.long)
@@ -333,30 +544,22 @@ class PretrainTorsionDataset(torch.utils.data.Dataset):
 
 
 class PretrainMaskedTorsionDataset(PretrainTorsionDataset):
-    def __init__(self, data_file, mask_proportion, mask_token, atom_mask_token, vocab_to_mask):
+    def __init__(self, data_file, mask_proportion, mask_token, atom_mask_token, vocab_to_mask, n_cpu=4):
         self.data_file = data_file
-        self.data = open_data_file(data_file)
-        self.indexes = [ {'id': item['id']} for item in self.data ]  # to satify the requirements of inference.py
+        self.data = None if data_file is not None else []  # None until opened by preprocess, [] for no items, e.g. to transform streamed items
+        self.indexes = []  # to satify the requirements of inference.py
+        self.n_cpu = n_cpu  # processes used in preprocessing
         self.tor, self.global_tr, self.global_rot, self.crop = None, None, None, None
+        self.batch_noise = False
         self.mask_proportion = mask_proportion
         self.mask_token = mask_token
         self.atom_mask_token = atom_mask_token
         self.vocab_to_mask = vocab_to_mask # list of vocab indices that can be masked
         self.idx_to_mask_block = dict(zip(self.vocab_to_mask, range(len(self.vocab_to_mask))))
+        self.mask_block_labels = np.full(max(self.vocab_to_mask, default=-1) + 1, -1, dtype=np.int64)  # idx_to_mask_block as an array
+        self.mask_block_labels[self.vocab_to_mask] = np.arange(len(self.vocab_to_mask))
         self.preprocess()
 
-    def preprocess(self):
-        super().preprocess()
-        missing_maskable_nodes = []
-        for idx, item in enumerate(self.data):
-            item['data'] = self.get_mask_for_item(item['data'])
-            can_mask0, can_mask1 = item["data"]["can_mask"]
-            if len(can_mask0) == 0 or len(can_mask1) == 0:
-                missing_maskable_nodes.append(idx)
-        print(f"Removed {len(missing_maskable_nodes)} items with no maskable nodes. Original={len(self.data)} Cleaned={len(self.data) - len(missing_maskable_nodes)}")
-        self.data = [self.data[i] for i in range(len(self.data)) if i not in missing_maskable_nodes]
-        self.indexes = [self.indexes[i] for i in range(len(self.indexes)) if i not in missing_maskable_nodes]
-    
     def get_mask_for_item(self, data):
         can_mask0 = np.where(np.logical_and(np.isin(np.array(data['B']), np.array(self.vocab_to_mask)), 
                 np.array(data["segment_ids"])==0))[0].tolist()
@@ -364,11 +567,22 @@ class PretrainMaskedTorsionDataset(PretrainTorsionDataset):
                 np.array(data["segment_ids"])==1))[0].tolist()
         data["can_mask"] = [can_mask0, can_mask1]
         return data
+
+    def _filter_item(self, item):
+        item = super()._filter_item(item)
+        if item is None:
+            return None
+        item['data'] = self.get_mask_for_item(item['data'])
+        can_mask0, can_mask1 = item["data"]["can_mask"]
+        if len(can_mask0) == 0 or len(can_mask1) == 0:
+            return None
+        return item
     
-    def __getitem__(self, idx):
-        data = super().__getitem__(idx)
-        data['X'] = data['X'].tolist()
-        B = np.array(data['B'])
+    def _transform_item(self, item):
+        data = super()._transform_item(item)
+        if "can_mask" not in data:  # items of columnar stores are built on access
+            data = self.get_mask_for_item(data)
+        B = np.asarray(data['B'])
         # # mask blocks on the non noisy side
         # if data['noisy_segment'] == 0:
         #     can_mask = data["can_mask"][1]
@@ -377,45 +591,21 @@ class PretrainMaskedTorsionDataset(PretrainTorsionDataset):
         can_mask = data["can_mask"][0] + data["can_mask"][1]
         num_to_select = max(1, int(self.mask_proportion * len(can_mask)))
         selected_indices = np.random.choice(can_mask, size=num_to_select, replace=False)
-        masked_blocks = np.zeros_like(data['B'], dtype=bool)
+        masked_blocks = np.zeros(len(B), dtype=bool)
         masked_blocks[selected_indices] = True
 
-        block_ids = sum([block_len*[block_id] for block_id, block_len in enumerate(data['block_lengths'])], [])
-        block_centers = scatter_mean(torch.tensor(data['X'], dtype=torch.float), torch.tensor(block_ids, dtype=torch.long), dim=0).tolist()
-        masked_A, masked_X = [], []
-        old_A_map = {}
-        curr_block = 0
-        curr_A = 0
-        for block_id in range(len(B)):
-            block_len = data['block_lengths'][block_id]
-            if masked_blocks[block_id]:
-                for A_i in range(block_len):
-                    old_A_map[curr_A+A_i] = len(masked_A)
-                masked_A.append(self.atom_mask_token)
-                masked_X.append(block_centers[block_id])
-            else:
-                for A_i in range(block_len):
-                    old_A_map[curr_A+A_i] = len(masked_A) + A_i
-                masked_A.extend(data['A'][curr_block:curr_block+block_len])
-                masked_X.extend(data['X'][curr_block:curr_block+block_len])
-            curr_block += block_len
-            curr_A += block_len
-        data['A'] = masked_A
-        data['X'] = masked_X
-        def map_atoms(x):
-            return old_A_map[x]  # Return the mapped value, or the original if not found
-        vectorized_map_values = np.vectorize(map_atoms)
-        data['tor_edges'] = vectorized_map_values(data['tor_edges'])
-
-        block_lengths = np.array(data['block_lengths'])
-        block_lengths[masked_blocks] = 1
-        data['block_lengths'] = block_lengths.tolist()
-
-        data['masked_labels'] = [self.idx_to_mask_block[b] for b in B[masked_blocks].tolist()]
-        new_blocks = B
-        new_blocks[masked_blocks] = self.mask_token
-        data['B'] = new_blocks.tolist()
-        data['masked_blocks'] = masked_blocks.tolist()
+        masked_X, data['A'], atom_map = _mask_blocks(data, masked_blocks, self.atom_mask_token)
+        if self.batch_noise:
+            # the atoms of masked blocks are merged into their centers after noising (see BatchNoiseTransform)
+            data['atom_map'] = atom_map
+        else:
+            data['X'] = masked_X
+            data['tor_edges'] = atom_map[np.asarray(data['tor_edges'], dtype=np.int64)]
+
+        data['block_lengths'] = np.where(masked_blocks, 1, data['block_lengths'])
+        data['masked_labels'] = self.mask_block_labels[B[masked_blocks]]
+        data['B'] = np.where(masked_blocks, self.mask_token, B)
+        data['masked_blocks'] = masked_blocks
 
         if 'block_embeddings' in data:
             block_embeddings = np.array(data['block_embeddings'])
@@ -436,24 +626,28 @@ class PretrainMaskedTorsionDataset(PretrainTorsionDataset):
         return data
 
     @classmethod
-    def collate_fn(cls, batch):
-        res = super().collate_fn(batch)
+    def collate_fn(cls, batch, buffers=None):
+        res = super().collate_fn(batch, buffers=buffers)
         keys = ['masked_blocks', 'masked_labels']
         types = [torch.bool, torch.long]
         for key, _type in zip(keys, types):
-            val = []
-            for item in batch:
-                val.append(torch.tensor(item[key], dtype=_type))
-                res[key] = torch.cat(val, dim=0)
+            res[key] = collate_cat(batch, key, _type, buffers)
         return res
 
 class PretrainAtomDataset(torch.utils.data.Dataset):
 
-    def __init__(self, data_file):
+    def __init__(self, data_file, n_cpu=4):
         super().__init__()
-        self.data = open_data_file(data_file)
-        self.indexes = [ {'id': item['id']} for item in self.data ]  # to satify the requirements of inference.py
-        self.atom_noise, self.global_tr, self.global_rot = None, None, None
+        self.data_file = data_file
+        self.data = open_data_file(data_file) if data_file is not None else []  # None for no items, e.g. to transform streamed items
+        self.indexes = [ {'id': item_id} for item_id in get_item_ids(self.data) ]  # to satify the requirements of inference.py
+        self.source_positions = np.arange(len(self.data))
+        self.n_cpu = n_cpu  # processes used in preprocessing
+        self.atom_noise, self.global_tr, self.global_rot, self.crop = None, None, None, None
+        self.batch_noise = False
+        if not isinstance(self.data, ColumnarStore):
+            for item in self.data:
+                item['data'] = _readonly_arrays(item['data'])
     
     def set_atom_noise(self, noise_level):
         self.atom_noise = GaussianNoiseTransform(noise_level)
@@ -463,14 +657,22 @@ class PretrainAtomDataset(torch.utils.data.Dataset):
 
     def set_rotation_noise(self, noise_level, max_theta):
         self.global_rot = GlobalRotationTransform(noise_level, max_theta)
+
+    def set_batch_noise(self):
+        # return clean items, the noise is applied to the collated batches by BatchNoiseTransform
+        self.batch_noise = True
     
     def set_crop(self, max_n_vertex_per_item, fragmentation_method):
         self.crop = CropTransform(max_n_vertex_per_item-2, fragmentation_method) # 2 blocks are global blocks
-        for item in tqdm(self.data, desc="Preprocessing, cropping large items", total=len(self.data)):
-            data = item['data']
-            if len(data['B']) > self.crop.max_blocks:
-                data, keep_blocks = self.crop(data)
-                item['data'] = data
+        if self.data_file is not None:
+            preprocess_items(self, desc="Preprocessing, cropping large items")
+
+    def _filter_item(self, item):
+        '''crops a single item as set_crop does for the whole dataset'''
+        if self.crop is not None and len(item['data']['B']) > self.crop.max_blocks:
+            item = dict(item)
+            item['data'], keep_blocks = self.crop(item['data'])
+        return item
 
     def __len__(self):
         return len(self.data)
@@ -480,6 +682,9 @@ class PretrainAtomDataset(torch.utils.data.Dataset):
         return self.data[idx]
     
     def __getitem__(self, idx):
+        return self._transform_item(self.data[idx])
+
+    def _transform_item(self, item):
         '''
         an example of the returned data
         {
@@ -497,8 +702,7 @@ class PretrainAtomDataset(torch.utils.data.Dataset):
             'noisy_segment': [1]
         }        
         '''
-        item = self.data[idx]
-        data = copy.deepcopy(item['data'])
+        data = _item_view(item)
         data['label'] = -1  # dummy label
 
         choices = []
@@ -514,6 +718,13 @@ class PretrainAtomDataset(torch.utils.data.Dataset):
             choices.append(1)
         chosen_segment = np.random.choice(choices)
 
+        if self.batch_noise:
+            # clean coordinates, noised after collating by BatchNoiseTransform
+            data['noisy_segment'] = chosen_segment
+            data['noisy_atom_range'] = _noisy_atom_range(data, chosen_segment)
+            data['can_rotate'] = segment_length[0] > 2 and segment_length[1] > 2
+            return data
+
         # segment length 2 means only one atom + global node, no need to rotate
         if self.global_rot is not None:
             if any([segment_length[0] <= 2, segment_length[1] <= 2]):
@@ -544,22 +755,22 @@ class PretrainAtomDataset(torch.utils.data.Dataset):
     
 
     @classmethod
-    def collate_fn(cls, batch):
+    def collate_fn(cls, batch, buffers=None):
         # FIXME: what to do when tor is empty?
-        keys = ['X', 'B', 'A', 'atom_positions', 'block_lengths', 'segment_ids', 'atom_score']
-        types = [torch.float, torch.long, torch.long, torch.long, torch.long, torch.long, torch.float]
-        res = {}
-        for key, _type in zip(keys, types):
-            val = []
-            for item in batch:
-                val.append(torch.tensor(item[key], dtype=_type))
-            res[key] = torch.cat(val, dim=0)
-        keys_scalars = ['rot_score', 'tr_score', 'noisy_segment', 'tr_eps', 'atom_eps']
-        types_scalars = [torch.float, torch.float, torch.long, torch.float, torch.float]
-        for key, _type in zip(keys_scalars, types_scalars):
-            val = [item[key] for item in batch]
-            val = np.array(val)
-            res[key] = torch.tensor(val, dtype=_type)
+        keys = ['X', 'B', 'A', 'atom_positions', 'block_lengths', 'segment_ids']
+        types = [torch.float, torch.long, torch.long, torch.long, torch.long, torch.long]
+        if 'noisy_atom_range' in batch[0]:
+            # clean items, the noise and its scores are added by BatchNoiseTransform
+            res = {key: collate_cat(batch, key, _type, buffers) for key, _type in zip(keys, types)}
+            res.update(_collate_noise_inputs(batch, torsion=False))
+        else:
+            keys.append('atom_score')
+            types.append(torch.float)
+            res = {key: collate_cat(batch, key, _type, buffers) for key, _type in zip(keys, types)}
+            keys_scalars = ['rot_score', 'tr_score', 'noisy_segment', 'tr_eps', 'atom_eps']
+            types_scalars = [torch.float, torch.float, torch.long, torch.float, torch.float]
+            for key, _type in zip(keys_scalars, types_scalars):
+                res[key] = torch.from_numpy(np.array([item[key] for item in batch], dtype=TORCH_TO_NUMPY[_type]))
         res['label'] = torch.tensor([x['label'] for x in batch], dtype=torch.float)
         lengths = [len(item['B']) for item in batch]
         res['lengths'] = torch.tensor(lengths, dtype=torch.long)
@@ -0,0 +1,135 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+
+LEVELS = ['bottom', 'top']
+N_EDGE_TYPES = 4  # intra / inter / global_normal / global_global
+META_FILE = 'meta.json'
+FORMAT_VERSION = 1
+
+
+def edge_store_path(data_file):
+    return data_file.rstrip('/') + '.edges'
+
+
+class EdgeStoreWriter:
+    '''
+    Writes the edges of each item, as precompute_edges (models/pretrain_model.py) builds them, into a directory:
+        meta.json: number of items, fingerprint and settings the edges were built with
+        {bottom, top}_edges.bin: [n_edges, 2] int32 edges of all items with indexes local to the item,
+            for each item its edges of type 0 to 3 one after another
+        {bottom, top}_offsets.npy: [n_items * 4 + 1], start of the edges of each (item, type)
+    '''
+    def __init__(self, path, fingerprint, settings):
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, META_FILE)):
+            os.remove(os.path.join(path, META_FILE))  # invalid until closed
+        self.path = path
+        self.fingerprint = fingerprint
+        self.settings = settings
+        self.files = {level: open(os.path.join(path, f'{level}_edges.bin'), 'wb') for level in LEVELS}
+        self.offsets = {level: [np.zeros(1, dtype=np.int64)] for level in LEVELS}
+        self.n_items = 0
+
+    def add_batch(self, precomputed_edges):
+        '''splits the precomputed edges of a batch into its items'''
+        batch_id, block_id = precomputed_edges['batch_id'].numpy(), precomputed_edges['block_id'].numpy()
+        bs = int(batch_id.max()) + 1 if len(batch_id) else 0
+        for level, node_batch_id in zip(LEVELS, [batch_id[block_id], batch_id]):
+            edges = precomputed_edges[f'{level}_edges'].numpy()
+            edge_type = precomputed_edges[f'{level}_edge_type'].numpy()
+            # nodes of an item are contiguous, edges never cross items
+            node_offsets = np.searchsorted(node_batch_id, np.arange(bs))
+            edge_item = node_batch_id[edges[0]]
+            key = edge_item * N_EDGE_TYPES + edge_type
+            order = np.argsort(key, kind='stable')  # keeps the order of the edges within each (item, type)
+            local = (edges[:, order] - node_offsets[edge_item[order]]).T.astype(np.int32)
+            self.files[level].write(np.ascontiguousarray(local).tobytes())
+            counts = np.bincount(key, minlength=bs * N_EDGE_TYPES)
+            self.offsets[level].append(self.offsets[level][-1][-1] + np.cumsum(counts))
+        self.n_items += bs
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        for level in LEVELS:
+            np.save(os.path.join(self.path, f'{level}_offsets.npy'), np.concatenate(self.offsets[level]))
+        meta = {
+            'version': FORMAT_VERSION,
+            'n_items': self.n_items,
+            'fingerprint': self.fingerprint,
+            'settings': self.settings,
+        }
+        # written last, so an interrupted build is not recognized as an edge store
+        with open(os.path.join(self.path, META_FILE), 'w') as fout:
+            json.dump(meta, fout, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EdgeStore:
+    '''Read-only, memory-mapped view of a directory written by EdgeStoreWriter'''
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, META_FILE))
+
+    def _open(self):
+        with open(os.path.join(self.path, META_FILE), 'r') as fin:
+            meta = json.load(fin)
+        assert meta['version'] == FORMAT_VERSION, f'Unsupported edge store version {meta["version"]}'
+        self.n_items, self.fingerprint, self.settings = meta['n_items'], meta['fingerprint'], meta['settings']
+        self.edges, self.offsets = {}, {}
+        for level in LEVELS:
+            self.offsets[level] = np.load(os.path.join(self.path, f'{level}_offsets.npy'), mmap_mode='r')
+            n_edges = int(self.offsets[level][-1])
+            if n_edges == 0:  # np.memmap cannot map empty files
+                self.edges[level] = np.zeros((0, 2), dtype=np.int32)
+            else:
+                self.edges[level] = np.memmap(os.path.join(self.path, f'{level}_edges.bin'), dtype=np.int32, mode='r', shape=(n_edges, 2))
+
+    def __getstate__(self):
+        # memory maps are reopened instead of copied when sent to DataLoader workers
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self.n_items
+
+    def precomputed_edges(self, indexes, lengths, block_lengths):
+        '''
+        precomputed_edges of a batch of the items at the given positions, in the layout of precompute_edges.
+        lengths and block_lengths are those of the collated batch.
+        '''
+        batch_id = torch.repeat_interleave(torch.arange(len(lengths)), lengths)  # [Nb]
+        block_id = torch.repeat_interleave(torch.arange(len(block_lengths)), block_lengths)  # [Nu]
+        res = {'batch_id': batch_id, 'block_id': block_id}
+        n_nodes = {
+            'bottom': np.bincount(batch_id[block_id].numpy(), minlength=len(indexes)),
+            'top': np.asarray(lengths),
+        }
+        for level in LEVELS:
+            node_offsets = np.concatenate([[0], np.cumsum(n_nodes[level])[:-1]])
+            offsets = self.offsets[level]
+            edges, edge_type = [], []
+            for t in range(N_EDGE_TYPES):  # edges of the batch are grouped by type, like in precompute_edges
+                for i, idx in enumerate(indexes):
+                    start, end = offsets[idx * N_EDGE_TYPES + t], offsets[idx * N_EDGE_TYPES + t + 1]
+                    edges.append(self.edges[level][start:end] + node_offsets[i])
+                    edge_type.append(np.full(end - start, t))
+            res[f'{level}_edges'] = torch.from_numpy(np.concatenate(edges, axis=0, dtype=np.int64).T.copy())
+            res[f'{level}_edge_type'] = torch.from_numpy(np.concatenate(edge_type, dtype=np.int64))
+        return res
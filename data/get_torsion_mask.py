@@ -7,9 +7,7 @@ import multiprocessing
 
 from .dataset import data_to_blocks
 from .pdb_utils import VOCAB
-from .torsion import get_side_chain_torsion_mask_block, get_segment_torsion_mask
-
-RESIDUES = set([x[0] for x in VOCAB.aas] + [x[0] for x in VOCAB.bases])
+from .torsion import get_packed_torsion_mask, pack_torsion_masks
 
 def process_one(item):
     """
@@ -26,27 +24,19 @@ def process_one(item):
             {
                 'type': 0=sidechain, 1=segment,
                 'edges': [n_rotatable_edges, 2],
-                'mask_rotate': [n_rotatable_edges, n_atoms]
-            } for each segment id
+                'rotate_atoms': [n_rotated],
+                'rotate_offsets': [n_rotatable_edges + 1]
+            } for each segment id, atom indexes local to the segment (see pack_torsion_mask)
         ]
     }
     """
-    list_of_masks = []
-    list_of_blocks = data_to_blocks(item["data"])
-    for blocks in list_of_blocks:
-        block_ids = set([block.symbol for block in blocks])
-        rot_sidechains = len(block_ids.intersection(RESIDUES)) > 0
-        if rot_sidechains:
-            # protein or nucleic acid
-            edges, mask_rotate = get_side_chain_torsion_mask_block(blocks)
-        else:
-            edges, mask_rotate = get_segment_torsion_mask(blocks)
-        list_of_masks.append({
-            "type": 0 if rot_sidechains else 1,
-            "edges": edges,
-            "mask_rotate": mask_rotate,
-        })
-    item["data"]["torsion_mask"] = list_of_masks
+    item["data"]["torsion_mask"] = [get_packed_torsion_mask(blocks) for blocks in data_to_blocks(item["data"])]
+    return item
+
+
+def pack_one(item):
+    """Packs the dense torsion masks of an item processed before"""
+    item["data"] = pack_torsion_masks(item["data"])
     return item
 
 
@@ -56,7 +46,10 @@ def main(args):
         dataset = pickle.load(f)
     
     with multiprocessing.Pool(args.num_workers) as pool:
-        results = list(tqdm(pool.imap(process_one, dataset), total=len(dataset), desc="Processing torsion edges"))
+        if args.pack:
+            results = list(tqdm(pool.imap(pack_one, dataset), total=len(dataset), desc="Packing torsion masks"))
+        else:
+            results = list(tqdm(pool.imap(process_one, dataset), total=len(dataset), desc="Processing torsion edges"))
 
     with open(args.output_file, "wb") as f:
         pickle.dump(results, f)
@@ -67,6 +60,7 @@ def parse():
     parser.add_argument("--output_file", type=str, required=True)
     parser.add_argument("--fragmentation_method", type=str, default=None, choices=["PS_300", "PS_500"])
     parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--pack", action="store_true", default=False, help="only pack the dense torsion masks of a dataset processed before")
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ import os
 from typing import Dict, List, Tuple, Optional
 
 import numpy as np
+from scipy.spatial import cKDTree
 from Bio.PDB import PDBParser, PDBIO
 from Bio.PDB.Structure import Structure as BStructure
 from Bio.PDB.Model import Model as BModel
@@ -556,14 +557,11 @@ class Complex(Protein):
             for chain in chains:
                 for residue in self.peptides[chain]:
                     res_list.append((chain, residue))
-        # calculate distance
-        dist = dist_matrix_from_residues(
-            [tup[1] for tup in rec_residues],
-            [tup[1] for tup in lig_residues]
-        )  # [Nrec, Nlig]
-        is_interacting = dist < dist_th
-        rec_index = np.nonzero(is_interacting.sum(axis=1) > 0)[0]
-        lig_index = np.nonzero(is_interacting.sum(axis=0) > 0)[0]
+        # residues within the distance threshold
+        coords, masks = coords_from_residues([tup[1] for tup in rec_residues + lig_residues])
+        midpoint = len(rec_residues)
+        rec_index, lig_index = interface_from_coords(
+            coords[:midpoint], masks[:midpoint], coords[midpoint:], masks[midpoint:], dist_th)
 
         rec_inter = [rec_residues[i] for i in rec_index]
         lig_inter = [lig_residues[i] for i in lig_index]
@@ -647,4 +645,28 @@ def dist_matrix_from_residues(residue_list1, residue_list2):
     midpoint = len(residue_list1)
     coords1, masks1 = coords[:midpoint], mask[:midpoint]
     coords2, masks2 = coords[midpoint:], mask[midpoint:]
-    return dist_matrix_from_coords(coords1, masks1, coords2, masks2)
\ No newline at end of file
+    return dist_matrix_from_coords(coords1, masks1, coords2, masks2)
+
+
+def interface_from_coords(coords1, masks1, coords2, masks2, dist_th):
+    '''
+    indexes of the blocks of each side closer than dist_th to a block of the other side, with the distance
+    of dist_matrix_from_coords (minimum over the atom slots m of the distance between the m-th atoms of both
+    blocks), found with a KD-tree query per atom slot instead of the dense [N1, N2, M] distance tensor
+    Returns:
+        indexes1, indexes2: sorted indexes of the blocks on the interface
+    '''
+    on_interface1 = np.zeros(len(coords1), dtype=bool)
+    on_interface2 = np.zeros(len(coords2), dtype=bool)
+    if len(coords1) == 0 or len(coords2) == 0:
+        return np.nonzero(on_interface1)[0], np.nonzero(on_interface2)[0]
+    for m in range(min(coords1.shape[1], coords2.shape[1])):
+        blocks1, blocks2 = np.nonzero(masks1[:, m])[0], np.nonzero(masks2[:, m])[0]
+        if len(blocks1) == 0 or len(blocks2) == 0:
+            continue
+        pairs = cKDTree(coords1[blocks1, m]).sparse_distance_matrix(
+            cKDTree(coords2[blocks2, m]), dist_th, output_type='ndarray')
+        pairs = pairs[pairs['v'] < dist_th]  # the query includes pairs at exactly dist_th
+        on_interface1[blocks1[pairs['i']]] = True
+        on_interface2[blocks2[pairs['j']]] = True
+    return np.nonzero(on_interface1)[0], np.nonzero(on_interface2)[0]
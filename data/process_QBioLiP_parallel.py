@@ -7,6 +7,7 @@ import pandas as pd
 import itertools
 import multiprocessing
 from joblib import Parallel, delayed, cpu_count
+from scipy.spatial import cKDTree
 
 from .converter.atom_blocks_to_frag_blocks import atom_blocks_to_frag_blocks
 from .converter.pdb_to_list_blocks import pdb_to_list_blocks_and_atom_array
@@ -91,6 +92,34 @@ def residue_to_pd_rows(chain: str, residue: Residue):
     return rows
 
 
+def interacting_chain_pairs(list_blocks, dist_th):
+    '''
+    pairs (i, j), i < j, of the chains with atoms closer than dist_th, in the order of itertools.combinations.
+    Pairs of chains whose bounding boxes are further apart are dropped without looking at their atoms, the others
+    are checked with a KD-tree of the atoms of each chain. blocks_interface finds no interface for the dropped pairs.
+    '''
+    coords = [np.array([unit.get_coord() for block in blocks for unit in block.units], dtype=float).reshape(-1, 3) for blocks in list_blocks]
+    chains = [i for i in range(len(coords)) if len(coords[i]) > 0]
+    if len(chains) < 2:
+        return []
+    lower = np.array([coords[i].min(axis=0) for i in chains])  # [C, 3]
+    upper = np.array([coords[i].max(axis=0) for i in chains])
+    gap = np.maximum(np.maximum(lower[:, None] - upper[None, :], lower[None, :] - upper[:, None]), 0)  # [C, C, 3]
+    box_close = np.linalg.norm(gap, axis=-1) < dist_th
+
+    trees, pairs = {}, []
+    for a, b in itertools.combinations(range(len(chains)), 2):
+        if not box_close[a, b]:
+            continue
+        i, j = chains[a], chains[b]
+        if j not in trees:
+            trees[j] = cKDTree(coords[j])
+        dist, _ = trees[j].query(coords[i], distance_upper_bound=dist_th)  # inf if no atom within dist_th
+        if np.any(dist < dist_th):
+            pairs.append((i, j))
+    return pairs
+
+
 def process_one_PP(protein_file_name, data_dir_rec, data_dir_lig, interface_dist_th):
     items = []
     prot_fname = os.path.join(data_dir_rec, protein_file_name)
@@ -104,7 +133,7 @@ def process_one_PP(protein_file_name, data_dir_rec, data_dir_lig, interface_dist
         print(f'{protein_file_name} does not have at least 2 protein chains')
         return None
     
-    pairs = list(itertools.combinations(range(len(list_blocks)), 2))
+    pairs = interacting_chain_pairs(list_blocks, interface_dist_th)
     for i, j in pairs:
         blocks1, blocks2, indexes1, indexes2 = blocks_interface(list_blocks[i], list_blocks[j], interface_dist_th, return_indexes=True)
         if len(blocks1) >= 4 and len(blocks2) >= 4: # Minimum interface size
@@ -0,0 +1,294 @@
+import os
+import glob
+import gzip
+import json
+import argparse
+import itertools
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from utils.logger import print_log
+from .columnar import ColumnarStore, is_columnar, iter_data_file
+
+
+def list_shards(path):
+    '''
+    shard files of a dataset path, which is either a single data file (.pkl, .jsonl.gz or columnar directory),
+    a directory containing such files or a glob pattern, e.g. "data/train_*.jsonl.gz"
+    '''
+    if is_columnar(path):
+        return [path]
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    else:
+        files = sorted(glob.glob(path))
+    files = [f for f in files if is_columnar(f) or f.endswith('.pkl') or f.endswith('.jsonl.gz')]
+    if len(files) == 0:
+        raise ValueError(f'No data files found for {path}')
+    return files
+
+
+def count_index_path(data_file):
+    return data_file + '.count'
+
+
+def count_items(data_file, count=True):
+    '''
+    number of items of a data file. It is read from the metadata of columnar stores and from the index
+    {data_file}.count of .pkl and .jsonl.gz files, which is written when they are first counted (the file
+    is streamed then). Returns None if the index is missing or outdated and count is False.
+    '''
+    if is_columnar(data_file):
+        return len(ColumnarStore(data_file))
+    stat = os.stat(data_file)
+    index_file = count_index_path(data_file)
+    try:
+        with open(index_file, 'r') as fin:
+            index = json.load(fin)
+        if index['size'] == stat.st_size and index['mtime_ns'] == stat.st_mtime_ns:
+            return index['n_items']
+    except (OSError, ValueError, KeyError):
+        pass
+    if not count:
+        return None
+    if data_file.endswith('.jsonl.gz'):
+        with gzip.open(data_file, 'rb') as f:
+            n_items = sum(1 for _ in f)
+    else:
+        n_items = sum(1 for _ in iter_data_file(data_file))
+    try:
+        # concurrent counts (e.g. DDP ranks) each write their own file, the rename is atomic
+        tmp = f'{index_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump({'n_items': n_items, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}, fout)
+        os.replace(tmp, index_file)
+    except OSError as e:
+        print_log(f'Cannot save the number of items of {data_file} to {index_file} ({e})', level='WARN')
+    return n_items
+
+
+def _rank_and_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+class StreamingDataset(torch.utils.data.IterableDataset):
+    '''
+    Streams the items of sharded data files through the transforms of pretraining datasets
+    (PretrainTorsionDataset, PretrainMaskedTorsionDataset, PretrainAtomDataset), so that the item list
+    is never loaded as a whole. Each source is a (dataset, path) pair: the dataset is created without
+    items (data_file=None) and configured as usual (set_noise), its _filter_item and _transform_item
+    are applied to the items of the shards under path (see list_shards). Several sources are mixed,
+    like MixDatasetWrapper does for in-memory datasets.
+
+    Shards are read sequentially. Columnar stores are split into virtual shards of items_per_shard
+    items, .pkl and .jsonl.gz files are one shard each (a .pkl shard is loaded as a whole). Every epoch
+    the shards are permuted with (seed, epoch) and dealt to the (DDP rank, DataLoader worker) slots:
+    each shard goes whole to the slot that misses the most items of its share of the epoch. If the shard
+    sizes are known (see count_items), the shares are then made exact: a slot with too many items hands
+    the end of its last shard on to the slots with too few, so every item is read once per epoch, apart
+    from those of the last incomplete batches. Only these split shards are read in part, which for .pkl
+    and .jsonl.gz files means skipping (parsing) the items before the part. If the size of a file is not
+    known (num_items is given and the file has no count index), whole shards are dealt round-robin, and
+    slots that share a shard (fewer shards than slots) read every n-th item of it.
+    The items of a slot pass a bounded shuffle buffer, so at most shuffle_buffer items (plus one .pkl shard)
+    are resident per worker.
+
+    An epoch holds num_items // world_size items per rank (rounded down to full batches, so that
+    all ranks run the same number of steps). num_items defaults to the number of items in the shards.
+    A slot that runs out of items (filtered items, unknown shard sizes or num_items beyond the number of
+    items) reads on into the shards of the next slots.
+    set_epoch(epoch, resume_index) resumes an epoch after the first resume_index items of this rank,
+    as DistributedSamplerResume does for map-style datasets. batch_size must be the batch size of
+    the DataLoader, which assigns whole batches to its workers in turn.
+    '''
+    def __init__(self, sources, shuffle=True, shuffle_buffer=1000, seed=0, num_items=None, items_per_shard=1024, batch_size=1):
+        super().__init__()
+        self.datasets = [dataset for dataset, _ in sources]
+        self.shards = []  # (dataset index, data file, start, end), start and end are None for whole files
+        self.shard_sizes = []  # None if unknown
+        for i, (_, path) in enumerate(sources):
+            for data_file in list_shards(path):
+                if is_columnar(data_file):
+                    n = count_items(data_file)
+                    for start in range(0, n, items_per_shard):
+                        self.shards.append((i, data_file, start, min(start + items_per_shard, n)))
+                        self.shard_sizes.append(min(start + items_per_shard, n) - start)
+                else:
+                    # files are only counted if the number of items of the epoch is not given
+                    self.shards.append((i, data_file, None, None))
+                    self.shard_sizes.append(count_items(data_file, count=num_items is None))
+        if num_items is None:
+            num_items = sum(self.shard_sizes)
+        self.num_items = num_items
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer if shuffle else 0
+        self.seed = seed
+        self.batch_size = batch_size
+        self.epoch = 0
+        self.resume_index = 0
+        self.collate_fn = self.datasets[0].collate_fn
+        self._stores = {}
+
+    def set_epoch(self, epoch, resume_index=None):
+        self.epoch = epoch
+        self.resume_index = 0 if resume_index is None else resume_index
+
+    def _num_batches(self, world_size):
+        # per rank, dropping the last incomplete batch
+        return self.num_items // world_size // self.batch_size
+
+    def __len__(self):
+        return self._num_batches(_rank_and_world_size()[1]) * self.batch_size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_stores'] = {}  # memory maps are reopened in the workers
+        return state
+
+    def _read_shard(self, shard, start=0, stop=None, step=1):
+        dataset_idx, data_file, shard_start, shard_end = shard
+        if shard_start is None:
+            yield from itertools.islice(iter_data_file(data_file), start, stop, step)
+            return
+        if data_file not in self._stores:
+            self._stores[data_file] = ColumnarStore(data_file)
+        store = self._stores[data_file]
+        stop = shard_end if stop is None else min(shard_start + stop, shard_end)
+        for idx in range(shard_start + start, stop, step):
+            yield store[idx]
+
+    def _deal_shards(self, order, shares):
+        '''
+        parts of the shards read by each slot, [n_slots] lists of (shard index, start, n_items or None for the rest, step)
+        '''
+        n_slots = len(shares)
+        sizes = [self.shard_sizes[i] for i in order]
+        if any(size is None for size in sizes):
+            if len(order) >= n_slots:
+                return [[(i, 0, None, 1) for i in order[slot::n_slots]] for slot in range(n_slots)]
+            # slots sharing a shard take every n-th item of it
+            return [[(order[slot % len(order)], slot // len(order), None, len(range(slot % len(order), n_slots, len(order))))]
+                    for slot in range(n_slots)]
+
+        parts, n_dealt, spare = [[] for _ in range(n_slots)], [0] * n_slots, []
+        for i, size in zip(order, sizes):
+            missing = [share - n for share, n in zip(shares, n_dealt)]
+            slot = int(np.argmax(missing))
+            if missing[slot] <= 0:
+                spare.append((i, 0, size, 1))
+                continue
+            parts[slot].append((i, 0, size, 1))
+            n_dealt[slot] += size
+        # slots with more items than their share hand the end of their last shards on
+        for slot in range(n_slots):
+            while n_dealt[slot] > shares[slot]:
+                i, start, n, step = parts[slot].pop()
+                excess = min(n, n_dealt[slot] - shares[slot])
+                if n > excess:
+                    parts[slot].append((i, start, n - excess, step))
+                spare.insert(0, (i, start + n - excess, excess, step))
+                n_dealt[slot] -= excess
+        # to the slots with less
+        for slot in range(n_slots):
+            while n_dealt[slot] < shares[slot] and len(spare) > 0:
+                i, start, n, step = spare.pop(0)
+                taken = min(n, shares[slot] - n_dealt[slot])
+                parts[slot].append((i, start, taken, step))
+                if n > taken:
+                    spare.insert(0, (i, start + taken, n - taken, step))
+                n_dealt[slot] += taken
+        return parts
+
+    def _read_parts(self, parts, slot):
+        '''(dataset, item) of the parts of the slot, then of the parts of the next slots, over and over'''
+        while True:
+            n_read = 0
+            for parts_of_slot in parts[slot:] + parts[:slot]:
+                for i, start, n, step in parts_of_slot:
+                    shard = self.shards[i]
+                    dataset = self.datasets[shard[0]]
+                    stop = None if n is None else start + n * step
+                    for item in self._read_shard(shard, start, stop, step):
+                        n_read += 1
+                        yield dataset, item
+            if n_read == 0:
+                return
+
+    def _iter_items(self, items, rng):
+        '''filtered raw items, passed through the shuffle buffer'''
+        buffer = []
+        for dataset, item in items:
+            item = dataset._filter_item(item)
+            if item is None:
+                continue
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append((dataset, item))
+                continue
+            if self.shuffle_buffer > 0:
+                i = rng.randint(len(buffer) + 1)
+                if i < len(buffer):
+                    buffer[i], (dataset, item) = (dataset, item), buffer[i]
+            yield dataset, item
+        if self.shuffle:
+            rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        rank, world_size = _rank_and_world_size()
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        yield from self.iter_slot(rank, world_size, worker_id, num_workers)
+
+    def iter_slot(self, rank, world_size, worker_id, num_workers):
+        '''transformed items of a DataLoader worker of a DDP rank in the current epoch'''
+        if len(self.shards) == 0:
+            return
+
+        # the DataLoader takes batches from its workers in turn, starting with worker 0, so batch i of the epoch
+        # comes from the stream with role i % num_workers. A resumed epoch starts with the role of the next batch
+        num_batches = self._num_batches(world_size)
+        resumed_batches = self.resume_index // self.batch_size
+        role = (worker_id + resumed_batches) % num_workers
+        role_items = [(num_batches // num_workers + (r < num_batches % num_workers)) * self.batch_size for r in range(num_workers)]
+        n_items = role_items[role]
+        n_skip = (resumed_batches // num_workers + (role < resumed_batches % num_workers)) * self.batch_size
+        slot = rank * num_workers + role
+
+        order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.shards)) if self.shuffle else np.arange(len(self.shards))
+        parts = self._deal_shards([int(i) for i in order], role_items * world_size)
+        items = self._read_parts(parts, slot)
+        rng = np.random.RandomState((self.seed, self.epoch, slot))
+
+        n_yielded = 0
+        while n_yielded < n_items:
+            # the first pass reads the share of the slot, the buffer is emptied before reading on
+            n_before = n_yielded
+            for dataset, item in self._iter_items(itertools.islice(items, n_items - n_yielded), rng):
+                if n_yielded >= n_items:
+                    break
+                n_yielded += 1
+                if n_yielded <= n_skip:
+                    continue
+                yield dataset._transform_item(item)
+            if n_yielded == n_before:  # every item read is filtered out
+                break
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Count the items of .pkl and .jsonl.gz shards once, so that streaming starts without reading them')
+    parser.add_argument('--data', type=str, nargs='+', required=True, help='data files, directories of data files or glob patterns')
+    return parser.parse_args()
+
+
+def main(args):
+    for path in args.data:
+        for data_file in list_shards(path):
+            print_log(f'{data_file}: {count_items(data_file)} items')
+
+
+if __name__ == '__main__':
+    main(parse())
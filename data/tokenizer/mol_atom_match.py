@@ -145,11 +145,10 @@ def get_atom_map(
     return gm.mapping
 
 
-def struct_to_topology(
+def struct_to_adjacency(
         atoms: List[str],
         coordinates: List[Tuple[float, float, float]]
-    ) -> nx.Graph:
-    node_ids = list(range(len(atoms)))
+    ) -> np.ndarray:
     coordinates = np.array(coordinates) # [N, 3]
     dist = coordinates[:, np.newaxis, :] - coordinates[np.newaxis, :, :]  # [N, N, 3]
     dist = np.linalg.norm(dist, axis=-1) # [N, N]
@@ -157,11 +156,16 @@ def struct_to_topology(
     radius = np.array([atomic_radii[atom] for atom in atoms])  # [N]
     dist_bond = (radius[:, np.newaxis] + radius[np.newaxis, :]) * 1.3  # [N, N]
 
-    adj_mat = np.logical_and(0.1 < dist, dist_bond > dist)
+    return np.logical_and(0.1 < dist, dist_bond > dist)
+
 
+def adjacency_to_topology(
+        atoms: List[str],
+        adj_mat: np.ndarray
+    ) -> nx.Graph:
     g = nx.Graph()
 
-    for i in node_ids:
+    for i in range(len(atoms)):
         g.add_node(i, atom=atoms[i])
 
     for i, j in zip(*np.nonzero(adj_mat)):
@@ -170,6 +174,13 @@ def struct_to_topology(
     return g
 
 
+def struct_to_topology(
+        atoms: List[str],
+        coordinates: List[Tuple[float, float, float]]
+    ) -> nx.Graph:
+    return adjacency_to_topology(atoms, struct_to_adjacency(atoms, coordinates))
+
+
 def struct_to_bonds(
         atoms: List[str],
         coordinates: List[Tuple[float, float, float]],
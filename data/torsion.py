@@ -1,9 +1,60 @@
 import networkx as nx
 import numpy as np
 import copy
+from functools import lru_cache
 from scipy.spatial.transform import Rotation as R
 import torch
-from .tokenizer.mol_atom_match import struct_to_topology
+from .pdb_utils import VOCAB
+from .tokenizer.mol_atom_match import struct_to_adjacency, adjacency_to_topology, struct_to_topology
+
+NUCLEOTIDES = {"DA", "DT", "DC", "DG", "<G>", "RU", "RA", "RG", "RC", "RI"}
+# residues whose side chain torsion masks are looked up in a table of the bond graphs seen before
+STANDARD_RESIDUES = set([x[0] for x in VOCAB.aas] + [x[0] for x in VOCAB.bases])
+
+def _bridges(n_nodes, edges):
+    """
+    Finds the bridges of a connected graph with a single depth-first search from node 0.
+    Args:
+        n_nodes: number of nodes, 0 to n_nodes - 1
+        edges: [n_edges, 2]
+    Returns:
+        order: [n_nodes], preorder index of each node, the subtree of a node holds the nodes with
+         order[node] <= order < order[node] + subtree_size[node]
+        subtree_size: [n_nodes]
+        bridge_child: [n_edges], for bridges the node of the edge below the other one in the search tree, -1 otherwise
+    """
+    adj = [[] for _ in range(n_nodes)]
+    for idx, (u, v) in enumerate(edges):
+        adj[u].append((v, idx))
+        adj[v].append((u, idx))
+    order, low = [-1] * n_nodes, [0] * n_nodes
+    subtree_size, parent_edge = [1] * n_nodes, [-1] * n_nodes
+    bridge_child = [-1] * len(edges)
+    order[0] = 0
+    timer = 1
+    stack = [(0, iter(adj[0]))]
+    while stack:
+        node, neighbors = stack[-1]
+        for nbr, idx in neighbors:
+            if idx == parent_edge[node]:
+                continue
+            if order[nbr] == -1:
+                parent_edge[nbr] = idx
+                order[nbr] = low[nbr] = timer
+                timer += 1
+                stack.append((nbr, iter(adj[nbr])))
+                break
+            low[node] = min(low[node], order[nbr])
+        else:
+            stack.pop()
+            if stack:
+                parent = stack[-1][0]
+                low[parent] = min(low[parent], low[node])
+                subtree_size[parent] += subtree_size[node]
+                if low[node] > order[parent]:  # no edge from the subtree reaches above it
+                    bridge_child[parent_edge[node]] = node
+    return np.array(order), np.array(subtree_size), bridge_child
+
 
 def get_torsion_mask(atoms, coords):
     """
@@ -18,10 +69,14 @@ def get_torsion_mask(atoms, coords):
         edges: [n_edges, 2]
         mask_edges: [n_edges], True if the edge is rotatable
         mask_rotate: [n_rotatable_edges, n_atoms], True if the atom is part of the 
-         part that gets rotated, n_rotatable_edges = sum(mask_edges)
+         part that gets rotated (the smaller one, the one with atom 0 for equal sizes),
+         n_rotatable_edges = sum(mask_edges)
     """
-    G = struct_to_topology(atoms, coords) # gets bonds
-    to_rotate = []
+    return get_graph_torsion_mask(struct_to_topology(atoms, coords)) # gets bonds
+
+
+def get_graph_torsion_mask(G):
+    """get_torsion_mask for the bond graph G of the atoms, with nodes 0 to n_atoms - 1"""
     edges = list(nx.edges(G))
     mask_edges, mask_rotate = [], []
     original_num_components = nx.number_connected_components(G)
@@ -30,23 +85,22 @@ def get_torsion_mask(atoms, coords):
         # this is normally because there are two molecules there
         mask_edges = [False] * len(edges)
         return np.array(edges), np.array(mask_edges), np.array(mask_rotate)
-    for i in range(0, len(edges)):
-        G2 = G.copy()
-        G2.remove_edge(*edges[i])
-        if nx.number_connected_components(G2) == 2:
-            l1 = list(sorted(nx.connected_components(G2), key=len)[0])
-            l2 = list(sorted(nx.connected_components(G2), key=len)[1])
-            if len(l1) > 1 and len(l2) > 1:
-                to_rotate = []
-                for i in range(len(G.nodes())):
-                    if i in l1:
-                        to_rotate.append(True)
-                    else:
-                        to_rotate.append(False)
-                mask_rotate.append(to_rotate)
-                mask_edges.append(True)
-            else:
-                mask_edges.append(False)
+    n_atoms = len(G.nodes())
+    if n_atoms > 0:
+        # breaking a bond disconnects the molecule iff it is a bridge, the two parts are the subtree
+        # of its lower atom in the search tree and the rest
+        order, subtree_size, bridge_child = _bridges(n_atoms, edges)
+    for idx in range(len(edges)):
+        child = bridge_child[idx]
+        if child == -1:
+            mask_edges.append(False)
+            continue
+        n_below = subtree_size[child]
+        n_above = n_atoms - n_below
+        if n_below > 1 and n_above > 1:
+            below = (order >= order[child]) & (order < order[child] + n_below)
+            mask_rotate.append(below if n_below < n_above else ~below)
+            mask_edges.append(True)
         else:
             mask_edges.append(False)
     return np.array(edges), np.array(mask_edges), np.array(mask_rotate)
@@ -122,6 +176,78 @@ def get_segment_torsion_mask(blocks):
     return edges[mask_edges].tolist(), mask_rotate.tolist()
 
 
+def _side_chain_torsion_mask(symbol, atoms, atom_pos, adj_mat):
+    """
+    Gets the side chain torsion mask of a block from its bonds.
+    Returns:
+        rotatable_edges: [n_rotatable_edges, 2]
+        sidechain_mask_rotate: [n_rotatable_edges, n_atoms], True if the atom is
+         part of the part that gets rotated
+    """
+    backbone_atom_mask = get_backbone_mask(atoms, atom_pos, is_nucleotide=symbol in NUCLEOTIDES)
+    edges, mask_edges, mask_rotate = get_graph_torsion_mask(adjacency_to_topology(atoms, adj_mat))
+
+    sidechain_mask_rotate = []
+    sidechain_mask_edges = mask_edges.copy()
+    mask_rotate_idx = 0
+    for idx, (u, v) in enumerate(edges):
+        if mask_edges[idx] == False:
+            continue
+        if backbone_atom_mask[u] and backbone_atom_mask[v]:
+            # if both are backbone atoms, then we don't want to rotate
+            sidechain_mask_edges[idx] = False
+            mask_rotate_idx += 1
+        else:
+            # (side chain atom, side chain atom) or (side chain atom, backbone atom)
+            # make sure that the rotated atoms are not in the backbone
+            mask_rotate_ = mask_rotate[mask_rotate_idx]
+            backbone_atoms = mask_rotate_[backbone_atom_mask] # False = backbone atom, True = side chain atom
+            if not np.any(backbone_atoms):
+                sidechain_mask_rotate.append(mask_rotate_)
+            else:
+                mask_rotate_ = np.bitwise_not(mask_rotate_)
+                backbone_atoms = mask_rotate_[backbone_atom_mask] # False = backbone atom, True = side chain atom
+                if np.any(backbone_atoms):
+                    print("Error: faulty residue, backbone atoms are being rotated.") # some erroneous cases where the number of CA's are not correct
+                    sidechain_mask_edges[idx] = False
+                    mask_rotate_idx += 1
+                    continue
+                sidechain_mask_rotate.append(mask_rotate_)
+            mask_rotate_idx += 1
+
+    if len(edges) == 0:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros((0, len(atoms)), dtype=bool)
+    return edges[sidechain_mask_edges], np.array(sidechain_mask_rotate, dtype=bool).reshape(-1, len(atoms))
+
+
+@lru_cache(maxsize=4096)
+def _residue_template(symbol, atoms, atom_pos, bonds):
+    # the masks only depend on the residue type, the atom names and the bonds between them
+    return _side_chain_torsion_mask(symbol, list(atoms), list(atom_pos), np.frombuffer(bonds, dtype=bool).reshape(len(atoms), len(atoms)))
+
+
+def get_block_side_chain_torsion_mask(block):
+    """
+    Gets the side chain torsion mask of a single block. Bonds are perceived from the coordinates, standard
+    amino acids and nucleotides with bonds seen before are looked up in a table of residue templates
+    instead of analysing their bond graph again.
+    Args:
+        block: Block
+    Returns:
+        rotatable_edges: [n_rotatable_edges, 2], indexes of the atoms of the block
+        sidechain_mask_rotate: [n_rotatable_edges, n_atoms], True if the atom is
+         part of the part that gets rotated
+    """
+    atoms = [unit.element for unit in block.units]
+    coords = [unit.coordinate for unit in block.units]
+    atom_pos = [unit.pos_code for unit in block.units]
+    adj_mat = struct_to_adjacency(atoms, coords)
+    if block.symbol in STANDARD_RESIDUES:
+        edges, mask_rotate = _residue_template(block.symbol, tuple(atoms), tuple(atom_pos), adj_mat.tobytes())
+        return edges.copy(), mask_rotate.copy()
+    return _side_chain_torsion_mask(block.symbol, atoms, atom_pos, adj_mat)
+
+
 def get_side_chain_torsion_mask(blocks):
     """
     Gets the side chain torsion mask for each block.
@@ -132,72 +258,33 @@ def get_side_chain_torsion_mask(blocks):
         sidechain_mask_rotate: [n_rotatable_edges, n_atoms], True if the atom is 
          part of the part that gets rotated
     """
-    all_edges, all_sidechain_mask_edges, all_sidechain_mask_rotate = [], [], []
+    all_edges, all_sidechain_mask_rotate = [], []
     total_atoms = len([unit for block in blocks for unit in block.units])
     curr_atom = 0
     for block in blocks:
-        atoms = [unit.element for unit in block.units]
-        coords = [unit.coordinate for unit in block.units]
-        atom_pos = [unit.pos_code for unit in block.units]
-        is_nucleotide = block.symbol in {"DA", "DT", "DC", "DG", "<G>", "RU", "RA", "RG", "RC", "RI"}
-        backbone_atom_mask = get_backbone_mask(atoms, atom_pos, is_nucleotide=is_nucleotide)
-
+        n_atoms = len(block.units)
         try:
-            edges, mask_edges, mask_rotate = get_torsion_mask(atoms, coords)
+            edges, sidechain_mask_rotate = get_block_side_chain_torsion_mask(block)
         except Exception as e:
             print(f"Error: {e} for block {block.symbol}")
-            curr_atom += len(atoms)
-            continue
-
-        sidechain_mask_rotate = []
-        sidechain_mask_edges = mask_edges.copy()
-        mask_rotate_idx = 0
-        for idx, (u, v) in enumerate(edges):
-            if mask_edges[idx] == False:
-                continue
-            if backbone_atom_mask[u] and backbone_atom_mask[v]:
-                # if both are backbone atoms, then we don't want to rotate
-                sidechain_mask_edges[idx] = False
-                mask_rotate_idx += 1
-            else:
-                # (side chain atom, side chain atom) or (side chain atom, backbone atom)
-                # make sure that the rotated atoms are not in the backbone
-                mask_rotate_ = mask_rotate[mask_rotate_idx]
-                backbone_atoms = mask_rotate_[backbone_atom_mask] # False = backbone atom, True = side chain atom
-                if not np.any(backbone_atoms):
-                    sidechain_mask_rotate.append(mask_rotate_)
-                else:
-                    mask_rotate_ = np.bitwise_not(mask_rotate_)
-                    backbone_atoms = mask_rotate_[backbone_atom_mask] # False = backbone atom, True = side chain atom
-                    if np.any(backbone_atoms):
-                        print("Error: faulty residue, backbone atoms are being rotated.") # some erroneous cases where the number of CA's are not correct
-                        sidechain_mask_edges[idx] = False
-                        mask_rotate_idx += 1
-                        continue
-                    sidechain_mask_rotate.append(mask_rotate_)
-                mask_rotate_idx += 1
-        
-        if len(edges) == 0:
-            curr_atom += len(atoms)
+            curr_atom += n_atoms
             continue
         all_edges.append(edges+curr_atom)
-        all_sidechain_mask_edges.append(sidechain_mask_edges)
         start_pad = curr_atom
-        end_pad = total_atoms - len(atoms) - start_pad
+        end_pad = total_atoms - n_atoms - start_pad
         for mask in sidechain_mask_rotate:
             padded_mask = np.concatenate([np.zeros(start_pad, dtype=bool), mask, np.zeros(end_pad, dtype=bool)])
             all_sidechain_mask_rotate.append(padded_mask)
-        curr_atom += len(atoms)
+        curr_atom += n_atoms
     
     if len(all_edges) == 0:
         return None, None
     all_edges = np.concatenate(all_edges, axis=0)
-    all_sidechain_mask_edges = np.concatenate(all_sidechain_mask_edges)
     all_sidechain_mask_rotate = np.array(all_sidechain_mask_rotate)
 
-    if all_edges[all_sidechain_mask_edges].shape == (0, 2):
+    if all_edges.shape == (0, 2):
         return None, None
-    return all_edges[all_sidechain_mask_edges], all_sidechain_mask_rotate
+    return all_edges, all_sidechain_mask_rotate
 
 
 def get_side_chain_torsion_mask_block(blocks):
@@ -213,55 +300,152 @@ def get_side_chain_torsion_mask_block(blocks):
     """
     all_edges, all_sidechain_mask_rotate = [], []
     for block in blocks:
-        atoms = [unit.element for unit in block.units]
-        coords = [unit.coordinate for unit in block.units]
-        atom_pos = [unit.pos_code for unit in block.units]
-        is_nucleotide = block.symbol in {"DA", "DT", "DC", "DG", "<G>", "RU", "RA", "RG", "RC", "RI"}
-        backbone_atom_mask = get_backbone_mask(atoms, atom_pos, is_nucleotide=is_nucleotide)
-
         try:
-            edges, mask_edges, mask_rotate = get_torsion_mask(atoms, coords)
+            edges, sidechain_mask_rotate = get_block_side_chain_torsion_mask(block)
         except Exception as e:
             print(f"Error: {e} for block {block.symbol}")
             all_edges.append(None)
             all_sidechain_mask_rotate.append(None)
             continue
 
-        sidechain_mask_rotate = []
-        sidechain_mask_edges = mask_edges.copy()
-        mask_rotate_idx = 0
-        for idx, (u, v) in enumerate(edges):
-            if mask_edges[idx] == False:
-                continue
-            if backbone_atom_mask[u] and backbone_atom_mask[v]:
-                # if both are backbone atoms, then we don't want to rotate
-                sidechain_mask_edges[idx] = False
-                mask_rotate_idx += 1
-            else:
-                # (side chain atom, side chain atom) or (side chain atom, backbone atom)
-                # make sure that the rotated atoms are not in the backbone
-                mask_rotate_ = mask_rotate[mask_rotate_idx]
-                backbone_atoms = mask_rotate_[backbone_atom_mask] # False = backbone atom, True = side chain atom
-                if not np.any(backbone_atoms):
-                    sidechain_mask_rotate.append(mask_rotate_.tolist())
-                else:
-                    mask_rotate_ = np.bitwise_not(mask_rotate_)
-                    backbone_atoms = mask_rotate_[backbone_atom_mask] # False = backbone atom, True = side chain atom
-                    if np.any(backbone_atoms):
-                        print("Error: faulty residue, backbone atoms are being rotated.") # some erroneous cases where the number of CA's are not correct
-                        sidechain_mask_edges[idx] = False
-                        mask_rotate_idx += 1
-                        continue
-                    sidechain_mask_rotate.append(mask_rotate_.tolist())
-                mask_rotate_idx += 1
-        
-        if len(edges) == 0 or sidechain_mask_edges.sum() == 0:
+        if len(edges) == 0:
             # no edges or no rotatable edges
             all_edges.append(None)
             all_sidechain_mask_rotate.append(None)
             continue
-        all_edges.append(edges[sidechain_mask_edges].tolist())
-        all_sidechain_mask_rotate.append(sidechain_mask_rotate)
+        all_edges.append(edges.tolist())
+        all_sidechain_mask_rotate.append(sidechain_mask_rotate.tolist())
     
     assert len(all_edges) == len(all_sidechain_mask_rotate) == len(blocks)
-    return all_edges, all_sidechain_mask_rotate
\ No newline at end of file
+    return all_edges, all_sidechain_mask_rotate
+
+
+def is_packed_torsion_mask(torsion_mask):
+    return 'rotate_offsets' in torsion_mask
+
+
+def pack_torsion_mask(torsion_mask, block_lengths):
+    """
+    Packs the dense torsion mask of a segment (edges and mask_rotate of get_side_chain_torsion_mask_block for
+    type 0, of get_segment_torsion_mask for type 1) into index lists, with atom indexes local to the segment,
+    i.e. counted from the first atom after its global block. Packed masks are returned as they are.
+    Args:
+        torsion_mask: {'type', 'edges', 'mask_rotate'}
+        block_lengths: [n_blocks], number of atoms of each block of the segment, without its global block
+    Returns:
+        {
+            'type': 0=sidechain, 1=segment,
+            'edges': [n_rotatable_edges, 2] uint16 (int32 for segments of more than 65535 atoms),
+                None if there are no rotatable edges,
+            'rotate_atoms': [n_rotated] uint16 (int32), atoms of the parts that get rotated, one edge after another,
+            'rotate_offsets': [n_rotatable_edges + 1] int32, the part of edge i is rotate_atoms[rotate_offsets[i]:rotate_offsets[i+1]]
+        }
+    """
+    if is_packed_torsion_mask(torsion_mask):
+        return torsion_mask
+    edges, rotated_edge, rotated_atom = [], [], []
+    n_edges = 0
+    if torsion_mask['type'] == 0:
+        block_offsets = np.concatenate([[0], np.cumsum(block_lengths)])
+        block_masks = [] if torsion_mask['edges'] is None else zip(torsion_mask['edges'], torsion_mask['mask_rotate'])
+        for i, (block_edges, mask_rotate) in enumerate(block_masks):
+            if block_edges is None:
+                continue
+            edge_local, atom_local = np.nonzero(np.asarray(mask_rotate, dtype=bool))
+            edges.append(np.asarray(block_edges) + block_offsets[i])
+            rotated_edge.append(edge_local + n_edges)
+            rotated_atom.append(atom_local + block_offsets[i])
+            n_edges += len(block_edges)
+    elif torsion_mask['edges'] is not None:
+        edges.append(np.asarray(torsion_mask['edges']))
+        n_edges = len(edges[0])
+        edge_local, atom_local = np.nonzero(np.asarray(torsion_mask['mask_rotate'], dtype=bool).reshape(n_edges, -1))
+        rotated_edge.append(edge_local)
+        rotated_atom.append(atom_local)
+    if n_edges == 0:
+        return {'type': torsion_mask['type'], 'edges': None, 'rotate_atoms': None, 'rotate_offsets': None}
+    counts = np.bincount(np.concatenate(rotated_edge), minlength=n_edges)
+    index_dtype = _index_dtype(np.sum(block_lengths))
+    return {
+        'type': torsion_mask['type'],
+        'edges': np.concatenate(edges, axis=0).astype(index_dtype),
+        'rotate_atoms': np.concatenate(rotated_atom).astype(index_dtype),
+        'rotate_offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int32),
+    }
+
+
+def _index_dtype(n_atoms):
+    # 2 bytes per atom index unless the segment is very large
+    return np.uint16 if n_atoms <= np.iinfo(np.uint16).max else np.int32
+
+
+def crop_torsion_mask(torsion_mask, block_lengths, keep_blocks):
+    """
+    The packed torsion mask of a segment restricted to some of its blocks, sliced from the mask of the whole segment.
+    Side chain masks (type 0) only have edges within blocks, the edges of the kept blocks are kept as they are.
+    Segment masks (type 1) change if blocks are removed (bonds between blocks are cut), they are only kept if all
+    blocks are.
+    Args:
+        torsion_mask: packed or dense torsion mask of the segment
+        block_lengths: [n_blocks], number of atoms of each block of the segment, without its global block
+        keep_blocks: [n_kept], sorted indexes of the kept blocks among them
+    Returns:
+        packed torsion mask of the kept blocks, None if it cannot be sliced
+    """
+    block_lengths = np.asarray(block_lengths)
+    torsion_mask = pack_torsion_mask(torsion_mask, block_lengths)
+    if len(keep_blocks) == len(block_lengths):
+        return torsion_mask
+    if torsion_mask['type'] != 0:
+        return None
+    if torsion_mask['edges'] is None:
+        return torsion_mask
+    kept_block = np.zeros(len(block_lengths), dtype=bool)
+    kept_block[keep_blocks] = True
+    kept_atom = np.repeat(kept_block, block_lengths)
+    new_index = np.cumsum(kept_atom) - 1
+    edges = np.asarray(torsion_mask['edges'], dtype=np.int64)
+    counts = np.diff(torsion_mask['rotate_offsets'])
+    keep_edge = kept_atom[edges[:, 0]]
+    if not keep_edge.any():
+        return {'type': 0, 'edges': None, 'rotate_atoms': None, 'rotate_offsets': None}
+    keep_rotated = np.repeat(keep_edge, counts)
+    index_dtype = _index_dtype(np.sum(kept_atom))
+    return {
+        'type': 0,
+        'edges': new_index[edges[keep_edge]].astype(index_dtype),
+        'rotate_atoms': new_index[np.asarray(torsion_mask['rotate_atoms'], dtype=np.int64)[keep_rotated]].astype(index_dtype),
+        'rotate_offsets': np.concatenate([[0], np.cumsum(counts[keep_edge])]).astype(np.int32),
+    }
+
+
+def pack_torsion_masks(data):
+    """replaces the dense torsion masks of the data of an item by packed ones"""
+    if 'torsion_mask' not in data or all([is_packed_torsion_mask(mask) for mask in data['torsion_mask']]):
+        return data
+    segment_ids, block_lengths = np.asarray(data['segment_ids']), np.asarray(data['block_lengths'])
+    data['torsion_mask'] = [
+        pack_torsion_mask(mask, block_lengths[segment_ids == segment][1:])  # without the global block
+        for segment, mask in enumerate(data['torsion_mask'])
+    ]
+    return data
+
+
+def get_packed_torsion_mask(blocks):
+    """
+    Gets the packed torsion mask (see pack_torsion_mask) of a segment, of the side chains
+    for proteins and nucleic acids, of the whole segment otherwise
+    Args:
+        blocks: [n_blocks], list of blocks of the segment
+    """
+    rot_sidechains = len(set([block.symbol for block in blocks]).intersection(STANDARD_RESIDUES)) > 0
+    if rot_sidechains:
+        edges, mask_rotate = get_side_chain_torsion_mask_block(blocks)
+    else:
+        edges, mask_rotate = get_segment_torsion_mask(blocks)
+    torsion_mask = {
+        "type": 0 if rot_sidechains else 1,
+        "edges": edges,
+        "mask_rotate": mask_rotate,
+    }
+    return pack_torsion_mask(torsion_mask, [len(block) for block in blocks])
@@ -4,6 +4,7 @@ from data.dataset import PDBDataset, ProtInterfaceDataset
 from models.prediction_model import PredictionModel
 from models.pretrain_model import DenoisePretrainModel
 from models.prot_interface_model import ProteinInterfaceModel
+from models.edge_cache import load_edge_store
 from trainers.abs_trainer import Trainer
 import torch
 import json
@@ -43,6 +44,8 @@ def main(args):
         model = PredictionModel.load_from_pretrained(args.model_ckpt)
     model = model.to("cpu")
     batch_size = args.batch_size
+    # edges precomputed with python -m models.edge_cache, if they match the model
+    edge_store = None if isinstance(dataset, ProtInterfaceDataset) else load_edge_store(dataset, model)
 
     embeddings = []
     for idx in tqdm(range(0, len(dataset), batch_size), desc="Embedding data", total=len(dataset)//batch_size+1):
@@ -53,10 +56,13 @@ def main(args):
             for item in items:
                 outputs.append({"id": item["id"]})
             if isinstance(dataset, ProtInterfaceDataset):
-                batch_items = [item["prot_data"] for item in items]
+                batch_items = [dataset[i]["prot"] for i in range(idx, min(idx+batch_size, len(dataset)))]
             else:
                 batch_items = [item["data"] for item in items]
             batch = PDBDataset.collate_fn(batch_items)
+            if edge_store is not None:
+                batch['precomputed_edges'] = edge_store.precomputed_edges(
+                    range(idx, min(idx+batch_size, len(dataset))), batch['lengths'], batch['block_lengths'])
             batch = Trainer.to_device(batch, "cpu")
             return_obj = model.infer(batch)
             
@@ -80,10 +86,13 @@ def main(args):
                 print("CUDA out of memory, reducing batch size to 1 for this batch.")
                 outputs = []
                 # go through the batch one by one
-                for item in items:
+                for i, item in zip(range(idx, min(idx+batch_size, len(dataset))), items):
                     try:
                         output = {"id": item["id"]}
-                        batch = PDBDataset.collate_fn([item["data"] if not isinstance(dataset, ProtInterfaceDataset) else item["prot_data"]])
+                        batch = PDBDataset.collate_fn([dataset[i]["prot"] if isinstance(dataset, ProtInterfaceDataset) else item["data"]])
+                        if edge_store is not None:
+                            batch['precomputed_edges'] = edge_store.precomputed_edges(
+                                [i], batch['lengths'], batch['block_lengths'])
                         batch = Trainer.to_device(batch, "cuda")
                         return_obj = model.infer(batch)
                         output["graph_embedding"] = return_obj.graph_repr[0].detach().cpu().numpy()
@@ -23,9 +23,12 @@ class InteractionModule(torch.nn.Module):
         max_edge_length=20, 
         max_global_edge_length=20,
         max_torsion_edge_length=5,
+        factorize_edge_features=False,
     ):
         super(InteractionModule, self).__init__()
         self.ns, self.nv = ns, nv
+        # project node scalars once per node instead of once per edge in the first layer of the edge MLPs
+        self.factorize_edge_features = factorize_edge_features
         self.edge_size = edge_size
         self.num_conv_layers = num_conv_layers
         self.sh_irreps = o3.Irreps.spherical_harmonics(lmax=sh_lmax)
@@ -165,24 +168,34 @@ class InteractionModule(torch.nn.Module):
         edge_length = edge_vec.norm(dim=-1)
         edge_length_embedding = self.edge_embedder(edge_length)
 
+        factorize = getattr(self, 'factorize_edge_features', False)  # for checkpoints pickled before the option
+        if factorize:
+            edge_embed = torch.cat((edge_length_embedding, edge_type_attr), dim=1)
+
         for l in range(self.num_conv_layers):
             assert not torch.any(torch.isnan(edge_length_embedding)), "nans in edge_length_embedding"
             assert not torch.any(torch.isnan(edge_type_attr)), "nans in edge_type_attr"
             assert not torch.any(torch.isnan(node_attr)), "nans in node_attr"
 
-            edge_attr = torch.cat(
-                (
-                    edge_length_embedding,
-                    edge_type_attr,
-                    node_attr[edges[0], : self.ns],
-                    node_attr[edges[1], : self.ns],
-                ),
-                dim=1,
-            )
+            if factorize:
+                update = self.layers[l](
+                    node_attr, edges, None, edge_sh,
+                    edge_feat=self.layers[l].factorized_fc(edge_embed, node_attr[:, : self.ns], edges),
+                )
+            else:
+                edge_attr = torch.cat(
+                    (
+                        edge_length_embedding,
+                        edge_type_attr,
+                        node_attr[edges[0], : self.ns],
+                        node_attr[edges[1], : self.ns],
+                    ),
+                    dim=1,
+                )
 
-            update = self.layers[l](
-                node_attr, edges, edge_attr, edge_sh,
-            )
+                update = self.layers[l](
+                    node_attr, edges, edge_attr, edge_sh,
+                )
             node_attr = F.pad(node_attr, (0, update.shape[-1]-node_attr.shape[-1])) 
 
             # update features with residual updates
@@ -203,18 +216,25 @@ class InteractionModule(torch.nn.Module):
             if self.return_atom_noise:
                 # Local denoising
                 local_edge_length_embedding = self.local_denoise_edge_embedder(edge_length)
-                edge_attr = torch.cat(
-                    (
-                        local_edge_length_embedding,
-                        edge_type_attr,
-                        node_attr[edges[0], : self.ns],
-                        node_attr[edges[1], : self.ns],
-                    ),
-                    dim=1,
-                )
-                pred = self.local_denoise_predictor(
-                    node_attr, edges, edge_attr, edge_sh,
-                )
+                if factorize:
+                    edge_feat = self.local_denoise_predictor.factorized_fc(
+                        torch.cat((local_edge_length_embedding, edge_type_attr), dim=1), node_attr[:, : self.ns], edges)
+                    pred = self.local_denoise_predictor(
+                        node_attr, edges, None, edge_sh, edge_feat=edge_feat,
+                    )
+                else:
+                    edge_attr = torch.cat(
+                        (
+                            local_edge_length_embedding,
+                            edge_type_attr,
+                            node_attr[edges[0], : self.ns],
+                            node_attr[edges[1], : self.ns],
+                        ),
+                        dim=1,
+                    )
+                    pred = self.local_denoise_predictor(
+                        node_attr, edges, edge_attr, edge_sh,
+                    )
                 atom_noise = pred[:, :3] + pred[:, 3:]
             else:
                 atom_noise = None
@@ -0,0 +1,74 @@
+"""
+Benchmarks the factorized edge features of InteractionModule (factorize_edge_features, --factorize_edge_features
+of train.py) against concatenating the node features of each edge, and checks that both give the same outputs.
+The saving is the [n_edges, 2 * ns + 2 * edge_size] input of the first layer of the edge MLPs, so it grows with
+the number of edges per node (k) and shows on GPU, where the e3nn tensor products do not dominate the time.
+    python -m models.ATOMICA.benchmark_edge_features --n_nodes 2000 --k 8 16 32 64
+"""
+import copy
+import time
+import argparse
+
+import torch
+from torch_cluster import knn_graph
+
+from .atomica import InteractionModule
+
+
+def timeit(model, inputs, n_rep):
+    '''mean forward and backward time and peak memory (CUDA only) of the model'''
+    model(*inputs).sum().backward()  # warm up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    fwd, bwd = 0, 0
+    for _ in range(n_rep):
+        start = time.perf_counter()
+        out = model(*inputs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        mid = time.perf_counter()
+        out.sum().backward()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        fwd, bwd = fwd + mid - start, bwd + time.perf_counter() - mid
+    peak = torch.cuda.max_memory_allocated() / 2**20 if torch.cuda.is_available() else None
+    return fwd / n_rep, bwd / n_rep, peak
+
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    model = InteractionModule(ns=args.hidden_size, nv=args.hidden_size // 2, num_conv_layers=args.n_layers,
+                              sh_lmax=2, edge_size=args.edge_size).to(device).eval()
+    factorized = copy.deepcopy(model)
+    factorized.factorize_edge_features = True
+    for k in args.k:
+        coords = torch.randn(args.n_nodes, 3, device=device) * 10
+        batch_id = torch.zeros(args.n_nodes, dtype=torch.long, device=device)
+        edges = knn_graph(coords, k=k, batch=batch_id)
+        node_attr = torch.randn(args.n_nodes, args.hidden_size, device=device)
+        edge_type_attr = torch.randn(edges.shape[1], args.edge_size, device=device)
+        inputs = (node_attr, coords, batch_id, None, edges, edge_type_attr)
+        with torch.no_grad():
+            diff = (model(*inputs) - factorized(*inputs)).abs().max().item()
+        print(f'k={k}, edges={edges.shape[1]}, max abs diff {diff:.2e}')
+        for name, m in [('concat', model), ('factorized', factorized)]:
+            fwd, bwd, peak = timeit(m, inputs, args.n_rep)
+            memory = '' if peak is None else f', peak memory {peak:.0f}MB'
+            print(f'\t{name:<10}: forward {fwd * 1000:.1f}ms, backward {bwd * 1000:.1f}ms{memory}')
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Benchmark the factorized edge features of InteractionModule')
+    parser.add_argument('--n_nodes', type=int, default=500)
+    parser.add_argument('--k', type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument('--hidden_size', type=int, default=32)
+    parser.add_argument('--edge_size', type=int, default=16)
+    parser.add_argument('--n_layers', type=int, default=2)
+    parser.add_argument('--n_rep', type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse())
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch_scatter import scatter_sum
@@ -10,12 +11,13 @@ from .utils import batchify, unbatchify
 class ATOMICAEncoder(nn.Module):
     def __init__(self, hidden_size, edge_size, n_layers=3, return_atom_noise=False, return_global_noise=False, 
                  return_torsion_noise=False, dropout=0.0, max_torsion_neighbors=9,
-                 max_edge_length=20, max_global_edge_length=20, max_torsion_edge_length=5) -> None:
+                 max_edge_length=20, max_global_edge_length=20, max_torsion_edge_length=5, factorize_edge_features=False) -> None:
         super().__init__()
         self.encoder = InteractionModule(ns=hidden_size, nv=hidden_size//2, num_conv_layers=n_layers, sh_lmax=2, edge_size=edge_size, 
                                          return_atom_noise=return_atom_noise, return_global_noise=return_global_noise, 
                                          return_torsion_noise=return_torsion_noise, dropout=dropout, max_torsion_neighbors=max_torsion_neighbors,
-                                         max_edge_length=max_edge_length, max_global_edge_length=max_global_edge_length, max_torsion_edge_length=max_torsion_edge_length)
+                                         max_edge_length=max_edge_length, max_global_edge_length=max_global_edge_length, max_torsion_edge_length=max_torsion_edge_length,
+                                         factorize_edge_features=factorize_edge_features)
         self.return_noise = any([return_atom_noise, return_global_noise, return_torsion_noise])
 
     def forward(self, H, Z, batch_id, perturb_mask, edges, edge_attr, tor_edges=None, tor_batch=None):
@@ -32,23 +34,65 @@ class ATOMICAEncoder(nn.Module):
 
 
 class AttentionPooling(nn.Module):
-    def __init__(self, hidden_size, num_heads=4, dropout=0.0, num_layers=4):
+    def __init__(self, hidden_size, num_heads=4, dropout=0.0, num_layers=4, variable_length=False):
         super().__init__()
         self.attention_layers = nn.ModuleList([nn.MultiheadAttention(hidden_size, num_heads=num_heads, dropout=dropout, batch_first=True) for _ in range(num_layers)])
         self.norms = nn.ModuleList([nn.LayerNorm(hidden_size) for _ in range(num_layers)])
         self.graph_repr_fc = nn.Linear(hidden_size, hidden_size)
         self.dropout = nn.Dropout(dropout)
         self.num_layers = num_layers
-    
-    def forward(self, block_repr, batch_id):
-        block_repr_, batchify_mask = batchify(block_repr, batch_id)
+        # attend only within each graph, without padding all graphs to the largest one
+        self.variable_length = variable_length
+
+    def _attend(self, block_repr_, key_padding_mask=None):
         for layer in range(self.num_layers):
-            block_repr_attn, _ = self.attention_layers[layer](block_repr_, block_repr_, block_repr_)
+            block_repr_attn, _ = self.attention_layers[layer](block_repr_, block_repr_, block_repr_, key_padding_mask=key_padding_mask)
             block_repr_attn = self.dropout(block_repr_attn)
             block_repr_ = block_repr_ + block_repr_attn # residual connection
             block_repr_ = self.norms[layer](block_repr_)
+        return block_repr_
+
+    def _attend_variable_length(self, block_repr, batch_id):
+        '''
+        Graphs are grouped into buckets of similar length (next power of 2) and each bucket is
+        padded only to its own longest graph, with padded positions masked out of the attention.
+        The cost is at most ~4x sum(n_i^2) instead of B * max_len^2, and it does not need batch_id to be sorted.
+        '''
+        n_blocks = scatter_sum(torch.ones_like(batch_id), batch_id)  # [B]
+        # position of each block inside its graph
+        order = torch.argsort(batch_id, stable=True)
+        offsets = torch.cumsum(n_blocks, dim=0) - n_blocks
+        pos = torch.empty_like(batch_id)
+        pos[order] = torch.arange(len(batch_id), device=batch_id.device) - offsets[batch_id[order]]
 
-        block_repr = unbatchify(block_repr_, batchify_mask)
+        bucket = torch.ceil(torch.log2(n_blocks.clamp(min=1).float())).long()
+        bucket[n_blocks == 0] = -1
+        out_idx, out_repr = [], []
+        for b in torch.unique(bucket).tolist():
+            if b < 0:
+                continue
+            in_bucket = bucket == b
+            graph_rank = torch.cumsum(in_bucket.long(), dim=0) - 1  # index of the graph inside the bucket
+            idx = torch.nonzero(in_bucket[batch_id]).squeeze(-1)
+            row, col = graph_rank[batch_id[idx]], pos[idx]
+            max_len = n_blocks[in_bucket].max().item()
+            padded = block_repr.new_zeros(in_bucket.sum().item(), max_len, block_repr.shape[-1])
+            padded[row, col] = block_repr[idx]
+            padding_mask = torch.ones(padded.shape[:2], dtype=torch.bool, device=block_repr.device)
+            padding_mask[row, col] = False
+            padded = self._attend(padded, key_padding_mask=padding_mask)
+            out_idx.append(idx)
+            out_repr.append(padded[row, col])
+        out_idx = torch.cat(out_idx)
+        return torch.cat(out_repr)[torch.argsort(out_idx)]
+
+    def forward(self, block_repr, batch_id):
+        if getattr(self, 'variable_length', False):  # for models pickled before the option
+            block_repr = self._attend_variable_length(block_repr, batch_id)
+        else:
+            block_repr_, batchify_mask = batchify(block_repr, batch_id)
+            block_repr_ = self._attend(block_repr_)
+            block_repr = unbatchify(block_repr_, batchify_mask)
         graph_repr = scatter_sum(block_repr, batch_id, dim=0)
         graph_repr = self.graph_repr_fc(graph_repr)
         graph_repr = F.normalize(graph_repr, dim=-1)
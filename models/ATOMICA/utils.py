@@ -34,85 +34,72 @@ class EquivariantLayerNorm(nn.Module):
             "component",
         ], "normalization needs to be 'norm' or 'component'"
         self.normalization = normalization
+        self._build_index()
 
     def __repr__(self):
         return f"{self.__class__.__name__}({self.irreps}, eps={self.eps})"
 
+    def _build_index(self, device=None):
+        # channel -> (irrep entry, irrep copy) maps, so that forward needs no loop over the irreps
+        channel_entry, channel_copy, divisor, scalar_channels = [], [], [], []
+        ix, iw = 0, 0
+        for i, (mul, ir) in enumerate(self.irreps):
+            d = ir.dim
+            channel_entry.append(torch.full((mul * d,), i, dtype=torch.long))
+            channel_copy.append(torch.arange(iw, iw + mul).repeat_interleave(d))
+            # mean over copies, and over components if normalization is "component"
+            divisor.append(mul * d if self.normalization == "component" else mul)
+            if ir.l == 0 and ir.p == 1:
+                scalar_channels.append(torch.arange(ix, ix + mul))
+            ix += mul * d
+            iw += mul
+        is_scalar = [ir.l == 0 and ir.p == 1 for _, ir in self.irreps]
+        buffers = {
+            "channel_entry": torch.cat(channel_entry) if channel_entry else torch.zeros(0, dtype=torch.long),
+            "channel_copy": torch.cat(channel_copy) if channel_copy else torch.zeros(0, dtype=torch.long),
+            "entry_mul": torch.tensor([mul for mul, _ in self.irreps], dtype=torch.float),
+            "entry_divisor": torch.tensor(divisor, dtype=torch.float),
+            "entry_is_scalar": torch.tensor(is_scalar, dtype=torch.bool),
+            "scalar_channels": torch.cat(scalar_channels) if scalar_channels else torch.zeros(0, dtype=torch.long),
+        }
+        buffers["channel_onehot"] = F.one_hot(buffers["channel_entry"], len(self.irreps)).float()
+        for name, value in buffers.items():
+            # not persistent, state dicts stay the same as for the looped implementation
+            self.register_buffer(name, value.to(device), persistent=False)
+
     @torch.cuda.amp.autocast(enabled=False)
     def forward(self, node_input, **kwargs):
-        # batch, *size, dim = node_input.shape  # TODO: deal with batch
-        # node_input = node_input.reshape(batch, -1, dim)  # [batch, sample, stacked features]
         # node_input has shape [batch * nodes, dim], but with variable nr of nodes.
-        # the node_input batch slices this into separate graphs
         dim = node_input.shape[-1]
-
-        fields = []
-        ix = 0
-        iw = 0
-        ib = 0
-
-        for (
-            mul,
-            ir,
-        ) in (
-            self.irreps
-        ):  # mul is the multiplicity (number of copies) of some irrep type (ir)
-            d = ir.dim
-            # field = node_input[:, ix: ix + mul * d]  # [batch * sample, mul * repr]
-            field = node_input.narrow(1, ix, mul * d)
-            ix += mul * d
-
-            # [batch * sample, mul, repr]
-            field = field.reshape(-1, mul, d)
-
-            # For scalars first compute and subtract the mean
-            if ir.l == 0 and ir.p == 1:
-                # Compute the mean
-                field_mean = torch.mean(field, dim=1, keepdim=True)  # [batch, mul, 1]]
-                # Subtract the mean
-                field = field - field_mean
-
-            # Then compute the rescaling factor (norm of each feature vector)
-            # Rescaling of the norms themselves based on the option "normalization"
-            if self.normalization == "norm":
-                field_norm = field.pow(2).sum(-1)  # [batch * sample, mul]
-            elif self.normalization == "component":
-                field_norm = field.pow(2).mean(-1)  # [batch * sample, mul]
-            else:
-                raise ValueError(
-                    "Invalid normalization option {}".format(self.normalization)
-                )
-            field_norm = torch.mean(field_norm, dim=1, keepdim=True)
-
-            # Then apply the rescaling (divide by the sqrt of the squared_norm, i.e., divide by the norm
-            field_norm = (field_norm + self.eps).pow(-0.5)  # [batch, mul]
-
-            if self.affine:
-                weight = self.affine_weight[None, iw : iw + mul]  # [batch, mul]
-                iw += mul
-                field_norm = field_norm * weight  # [batch, mul]
-
-            field = field * field_norm.reshape(
-                -1, mul, 1
-            )  # [batch * sample, mul, repr]
-
-            if self.affine and d == 1 and ir.p == 1:  # scalars
-                bias = self.affine_bias[ib : ib + mul]  # [batch, mul]
-                ib += mul
-                field += bias.reshape(mul, 1)  # [batch * sample, mul, repr]
-
-            # Save the result, to be stacked later with the rest
-            fields.append(field.reshape(-1, mul * d))  # [batch * sample, mul * repr]
-
-        if ix != dim:
+        if not hasattr(self, "channel_entry"):  # modules pickled before the index tensors existed
+            self._build_index(node_input.device)
+        if self.channel_entry.shape[0] != dim:
             fmt = (
                 "`ix` should have reached node_input.size(-1) ({}), but it ended at {}"
             )
-            msg = fmt.format(dim, ix)
+            msg = fmt.format(dim, self.channel_entry.shape[0])
             raise AssertionError(msg)
 
-        output = torch.cat(fields, dim=-1)  # [batch * sample, stacked features]
-        return output
+        # [dim, n_entries] one-hot, sums over the channels of each irrep entry in a single matmul
+        channel_to_entry = self.channel_onehot.to(node_input.dtype)
+        entry_sum = lambda x: x @ channel_to_entry  # [batch * sample, n_entries]
+
+        # For scalars first compute and subtract the mean
+        field_mean = entry_sum(node_input) / self.entry_mul.to(node_input.dtype)
+        field_mean = field_mean * self.entry_is_scalar
+        field = node_input - field_mean @ channel_to_entry.T
+
+        # Then compute the rescaling factor (norm of each feature vector), averaged over the copies
+        field_norm = entry_sum(field.pow(2)) / self.entry_divisor.to(node_input.dtype)
+        field_norm = (field_norm + self.eps).pow(-0.5)  # [batch * sample, n_entries]
+
+        scale = field_norm @ channel_to_entry.T  # [batch * sample, dim]
+        if not self.affine:
+            return field * scale
+        scale = scale * self.affine_weight[self.channel_copy]
+        bias = torch.zeros(dim, dtype=field.dtype, device=field.device)
+        bias = bias.index_copy(0, self.scalar_channels, self.affine_bias.to(field.dtype))
+        return torch.addcmul(bias, field, scale)  # bias only on the scalar channels
 
 
 class TensorProductConvLayer(torch.nn.Module):
@@ -159,6 +146,21 @@ class TensorProductConvLayer(torch.nn.Module):
             self.norm_type = "none"
             self.norm_layer = None
 
+    def factorized_fc(self, edge_embed, node_scalars, edge_index):
+        """
+        Same as self.fc(torch.cat([edge_embed, node_scalars[edge_src], node_scalars[edge_dst]], dim=-1)),
+        but the node columns of the first linear layer are applied once per node and then gathered
+        edge_embed: [E, n_edge_features - 2 * ns], node_scalars: [N, ns]
+        """
+        edge_src, edge_dst = edge_index
+        first = self.fc[0]
+        ns = node_scalars.shape[-1]
+        w_edge, w_src, w_dst = torch.split(first.weight, [first.in_features - 2 * ns, ns, ns], dim=1)
+        node_proj = F.linear(node_scalars, torch.cat([w_src, w_dst], dim=0))  # [N, 2 * hidden]
+        node_src, node_dst = node_proj.chunk(2, dim=-1)
+        hidden = F.linear(edge_embed, w_edge, first.bias) + node_src[edge_src] + node_dst[edge_dst]
+        return self.fc[1:](hidden)
+
     def forward(
         self,
         node_attr,
@@ -168,9 +170,11 @@ class TensorProductConvLayer(torch.nn.Module):
         node_attr_dst=None,
         out_nodes=None,
         reduce="mean",
+        edge_feat=None,
     ):
         edge_src, edge_dst = edge_index
-        edge_feat = self.fc(edge_attr)
+        if edge_feat is None:  # otherwise tensor product weights are precomputed, e.g. by factorized_fc
+            edge_feat = self.fc(edge_attr)
         assert not torch.any(torch.isnan(edge_feat)), "nans in edge_feat"
         assert not torch.any(torch.isnan(edge_sh)), "nans in edge_sh"
         assert not torch.any(torch.isnan(node_attr)), "nans in node_attr"
@@ -6,6 +6,17 @@ from .prot_interface_model import ProteinInterfaceModel
 import torch
 
 def create_model(args):
+    model = _create_model(args)
+    # models loaded from checkpoints keep their settings unless the flags are given
+    for m in ([model.cmplx_model, model.prot_model] if isinstance(model, ProteinInterfaceModel) else [model]):
+        if args.factorize_edge_features:
+            m.set_factorize_edge_features(True)
+        if args.variable_length_pooling:
+            m.set_variable_length_pooling(True)
+    return model
+
+
+def _create_model(args):
     if 'pretrain' in args.task.lower():
         params = {
             "atom_hidden_size": args.atom_hidden_size,
@@ -28,6 +39,8 @@ def create_model(args):
             "num_masked_block_classes": args.num_nodes,
             "mask_weight": args.mask_weight,
             "modality_embedding": args.modality_embedding,
+            "factorize_edge_features": args.factorize_edge_features,
+            "variable_length_pooling": args.variable_length_pooling,
         }
         if args.block_embedding_size is None and args.block_embedding0_size is None and args.block_embedding1_size is None:
             if args.pretrain_ckpt:
@@ -94,6 +107,8 @@ def create_model(args):
                 edge_size=args.edge_size,
                 n_layers=args.n_layers,
                 fragmentation_method=args.fragmentation_method,
+                factorize_edge_features=args.factorize_edge_features,
+                variable_length_pooling=args.variable_length_pooling,
                 **add_params
             )
         return model
@@ -157,5 +172,7 @@ def create_model(args):
                 global_message_passing=args.global_message_passing,
                 fragmentation_method=args.fragmentation_method,
                 dropout=args.dropout,
+                factorize_edge_features=args.factorize_edge_features,
+                variable_length_pooling=args.variable_length_pooling,
                 **add_params
             )
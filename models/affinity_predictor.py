@@ -4,8 +4,7 @@ from torch_scatter import scatter_sum, scatter_mean
 import torch
 
 from data.pdb_utils import VOCAB
-from .pretrain_model import DenoisePretrainModel
-from .ATOMICA.utils import batchify
+from .pretrain_model import DenoisePretrainModel, get_batch_block_id
 from .prediction_model import PredictionModel, PredictionReturnValue
 
 
@@ -96,6 +95,8 @@ class AffinityPredictor(PredictionModel):
             fragmentation_method=pretrained_model.fragmentation_method if hasattr(pretrained_model, "fragmentation_method") else None, # for backward compatibility
             bottom_global_message_passing=kwargs.get('bottom_global_message_passing', pretrained_model.bottom_global_message_passing),
             global_message_passing=kwargs.get('global_message_passing', pretrained_model.global_message_passing),
+            factorize_edge_features=kwargs.get('factorize_edge_features', getattr(pretrained_model, 'factorize_edge_features', False)),
+            variable_length_pooling=kwargs.get('variable_length_pooling', getattr(pretrained_model, 'variable_length_pooling', False)),
             nonlinearity=kwargs['nonlinearity'],
             num_affinity_pred_layers=kwargs['num_affinity_pred_layers'],
             affinity_pred_dropout=kwargs['affinity_pred_dropout'],
@@ -148,16 +149,13 @@ class AffinityPredictor(PredictionModel):
         })
         return config_dict
 
-    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, label, block_embeddings, block_embeddings0, block_embeddings1) -> PredictionReturnValue:
+    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, label, block_embeddings, block_embeddings0, block_embeddings1, precomputed_edges=None) -> PredictionReturnValue:
         # batch_id and block_id
         with torch.no_grad():
-            batch_id = torch.zeros_like(segment_ids)  # [Nb]
-            batch_id[torch.cumsum(lengths, dim=0)[:-1]] = 1
-            batch_id.cumsum_(dim=0)  # [Nb], item idx in the batch
-
-            block_id = torch.zeros_like(A) # [Nu]
-            block_id[torch.cumsum(block_lengths, dim=0)[:-1]] = 1
-            block_id.cumsum_(dim=0)  # [Nu], block (residue) id of each unit (atom)
+            if precomputed_edges is None:
+                batch_id, block_id = get_batch_block_id(lengths, block_lengths, segment_ids, A)
+            else:
+                batch_id, block_id = precomputed_edges['batch_id'], precomputed_edges['block_id']
 
             # transform blocks to single units
             bottom_batch_id = batch_id[block_id]  # [Nu]
@@ -181,7 +179,7 @@ class AffinityPredictor(PredictionModel):
         # bottom level message passing
         edges, edge_attr = self.get_edges(bottom_B, bottom_batch_id, bottom_segment_ids, 
                                           Z, bottom_block_id, self.bottom_global_message_passing, 
-                                          top=False)
+                                          top=False, precomputed_edges=precomputed_edges)
         bottom_block_repr = self.encoder(
             bottom_H_0, Z, bottom_batch_id, None, edges, edge_attr, 
         )
@@ -190,14 +188,13 @@ class AffinityPredictor(PredictionModel):
         top_Z = scatter_mean(Z, block_id, dim=0)  # [Nb, n_channel, 3]
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
         edges, edge_attr = self.get_edges(B, batch_id, segment_ids, top_Z, top_block_id, 
-                                          self.global_message_passing, top=True)
+                                          self.global_message_passing, top=True, precomputed_edges=precomputed_edges)
         if self.bottom_global_message_passing:
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr, block_id)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr, block_id)
         else:
             atom_mask = A != VOCAB.get_atom_global_idx()
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr[atom_mask], block_id[atom_mask])
-        block_repr_from_bottom = self.atom_block_attn(top_H_0.unsqueeze(1), batched_bottom_block_repr)
-        top_H_0 = top_H_0 + block_repr_from_bottom.squeeze(1)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr[atom_mask], block_id[atom_mask])
+        top_H_0 = top_H_0 + block_repr_from_bottom
         top_H_0 = self.atom_block_attn_norm(top_H_0)
 
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
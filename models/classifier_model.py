@@ -30,6 +30,8 @@ class ClassifierModel(PredictionModel):
             fragmentation_method=pretrained_model.fragmentation_method if hasattr(pretrained_model, "fragmentation_method") else None, # for backward compatibility
             bottom_global_message_passing=kwargs.get('bottom_global_message_passing', pretrained_model.bottom_global_message_passing),
             global_message_passing=kwargs.get('global_message_passing', pretrained_model.global_message_passing),
+            factorize_edge_features=kwargs.get('factorize_edge_features', getattr(pretrained_model, 'factorize_edge_features', False)),
+            variable_length_pooling=kwargs.get('variable_length_pooling', getattr(pretrained_model, 'variable_length_pooling', False)),
             nonlinearity=kwargs['nonlinearity'],
             num_pred_layers=kwargs['num_pred_layers'],
             pred_dropout=kwargs['pred_dropout'],
@@ -70,8 +72,8 @@ class ClassifierModel(PredictionModel):
         })
         return config_dict
     
-    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, label, block_embeddings=None, block_embeddings0=None, block_embeddings1=None) -> PredictionReturnValue:
-        return_value = super().forward(Z, B, A, block_lengths, lengths, segment_ids)
+    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, label, block_embeddings=None, block_embeddings0=None, block_embeddings1=None, precomputed_edges=None) -> PredictionReturnValue:
+        return_value = super().forward(Z, B, A, block_lengths, lengths, segment_ids, precomputed_edges=precomputed_edges)
         logits = self.classifier_ffn(return_value.graph_repr).squeeze(-1)
         loss = F.binary_cross_entropy_with_logits(logits, label)
         return loss, F.sigmoid(logits)
@@ -121,6 +123,8 @@ class MultiClassClassifierModel(PredictionModel):
             fragmentation_method=pretrained_model.fragmentation_method if hasattr(pretrained_model, "fragmentation_method") else None, # for backward compatibility
             bottom_global_message_passing=kwargs.get('bottom_global_message_passing', pretrained_model.bottom_global_message_passing),
             global_message_passing=kwargs.get('global_message_passing', pretrained_model.global_message_passing),
+            factorize_edge_features=kwargs.get('factorize_edge_features', getattr(pretrained_model, 'factorize_edge_features', False)),
+            variable_length_pooling=kwargs.get('variable_length_pooling', getattr(pretrained_model, 'variable_length_pooling', False)),
             num_classes=kwargs['num_classes'],
         )
         print(f"""Pretrained model params: hidden_size={model.hidden_size},
@@ -149,8 +153,8 @@ class MultiClassClassifierModel(PredictionModel):
         config_dict['num_classes'] = self.num_classes
         return config_dict
     
-    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, label, block_embeddings=None, block_embeddings0=None, block_embeddings1=None) -> PredictionReturnValue:
-        return_value = super().forward(Z, B, A, block_lengths, lengths, segment_ids)
+    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, label, block_embeddings=None, block_embeddings0=None, block_embeddings1=None, precomputed_edges=None) -> PredictionReturnValue:
+        return_value = super().forward(Z, B, A, block_lengths, lengths, segment_ids, precomputed_edges=precomputed_edges)
         logits = self.classifier_ffn(return_value.graph_repr)
         prob = F.softmax(logits, dim=1)
         return F.cross_entropy(logits, label), prob
@@ -195,8 +199,8 @@ class RegressionPredictor(PredictionModel):
             model.energy_ffn.requires_grad_(requires_grad=True)
         return model
     
-    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, label, block_embeddings=None, block_embeddings0=None, block_embeddings1=None) -> PredictionReturnValue:
-        return_value = super().forward(Z, B, A, block_lengths, lengths, segment_ids)
+    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, label, block_embeddings=None, block_embeddings0=None, block_embeddings1=None, precomputed_edges=None) -> PredictionReturnValue:
+        return_value = super().forward(Z, B, A, block_lengths, lengths, segment_ids, precomputed_edges=precomputed_edges)
         pred_energy = self.energy_ffn(return_value.graph_repr).squeeze(-1)
         return F.mse_loss(pred_energy, label), pred_energy  # since we are supervising pK=-log_10(Kd), whereas the energy is RTln(Kd)
     
@@ -0,0 +1,121 @@
+'''
+Edges of datasets with fixed coordinates (fine-tuning without noise, embedding), computed once and stored
+next to the data file ({data_file}.edges, see data/edge_store.py), instead of on every forward:
+    python -m models.edge_cache --data_file data/train.pkl --model_config model_config.json
+The store records a fingerprint of the edge settings of the model and of the data file, with_edge_cache
+uses it only if both match.
+'''
+import os
+import json
+import hashlib
+import argparse
+
+import torch
+from tqdm import tqdm
+
+from utils.logger import print_log
+from data.pdb_utils import VOCAB
+from data.columnar import is_columnar, META_FILE
+from data.dataset import PDBDataset, EdgeCacheDataset, MixDatasetWrapper, collate_cat, get_item_ids
+from data.edge_store import EdgeStore, EdgeStoreWriter, edge_store_path
+from .pretrain_model import create_edge_constructor, precompute_edges
+
+
+def edge_settings(edge_constructor, bottom_global_message_passing, global_message_passing):
+    '''everything the edges of an item depend on, besides its coordinates'''
+    return {
+        'constructor': type(edge_constructor).__name__,
+        'k_neighbors': edge_constructor.k_neighbors,
+        'global_node_id_vocab': [int(i) for i in edge_constructor.global_node_id_vocab],
+        'delete_self_loop': edge_constructor.delete_self_loop,
+        'bottom_global_message_passing': bool(bottom_global_message_passing),
+        'global_message_passing': bool(global_message_passing),
+    }
+
+
+def edge_fingerprint(dataset, settings):
+    fingerprint = hashlib.sha1()
+    fingerprint.update(json.dumps(settings, sort_keys=True).encode())
+    # the items are identified by their ids and the size and modification time of the data file
+    # (of the metadata for columnar stores, which is written last)
+    data_file = dataset.data_file
+    stat = os.stat(os.path.join(data_file, META_FILE) if is_columnar(data_file) else data_file)
+    fingerprint.update(f'|{stat.st_size}|{stat.st_mtime_ns}|'.encode())
+    fingerprint.update('\n'.join(str(item_id) for item_id in get_item_ids(dataset.data)).encode())
+    return fingerprint.hexdigest()
+
+
+def _collate_coordinates(batch):
+    keys = ['X', 'B', 'A', 'block_lengths', 'segment_ids']
+    types = [torch.float, torch.long, torch.long, torch.long, torch.long]
+    res = {key: collate_cat(batch, key, _type) for key, _type in zip(keys, types)}
+    res['lengths'] = torch.tensor([len(item['B']) for item in batch], dtype=torch.long)
+    return res
+
+
+def build_edge_cache(dataset, edge_constructor, bottom_global_message_passing, global_message_passing, batch_size=32):
+    '''computes the edges of every item of the dataset and writes them to {data_file}.edges'''
+    settings = edge_settings(edge_constructor, bottom_global_message_passing, global_message_passing)
+    path = edge_store_path(dataset.data_file)
+    with EdgeStoreWriter(path, edge_fingerprint(dataset, settings), settings) as writer:
+        for start in tqdm(range(0, len(dataset), batch_size), desc=f'Building edges of {dataset.data_file}'):
+            batch = _collate_coordinates([dataset[i] for i in range(start, min(start + batch_size, len(dataset)))])
+            writer.add_batch(precompute_edges(
+                edge_constructor, batch['X'], batch['B'], batch['A'], batch['block_lengths'], batch['lengths'],
+                batch['segment_ids'], bottom_global_message_passing, global_message_passing))
+    return EdgeStore(path)
+
+
+def load_edge_store(dataset, model):
+    '''the edge store of the dataset if it matches the edge settings of the model and the data file, otherwise None'''
+    data_file = getattr(dataset, 'data_file', None)
+    if data_file is None or isinstance(dataset, MixDatasetWrapper):
+        return None
+    path = edge_store_path(data_file)
+    if not EdgeStore.exists(path):
+        return None
+    store = EdgeStore(path)
+    settings = edge_settings(model.edge_constructor, model.bottom_global_message_passing, model.global_message_passing)
+    if store.fingerprint != edge_fingerprint(dataset, settings):
+        print_log(f'Edges in {path} were built with other settings or data, ignored', level='WARN')
+        return None
+    return store
+
+
+def with_edge_cache(dataset, model):
+    '''wraps the dataset to read the edges from its edge store if there is a matching one'''
+    store = load_edge_store(dataset, model)
+    if store is None:
+        return dataset
+    print_log(f'Using precomputed edges from {store.path}')
+    return EdgeCacheDataset(dataset, store)
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Precompute the edges of a dataset with fixed coordinates')
+    parser.add_argument('--data_file', type=str, required=True, help='.pkl, .jsonl.gz or columnar dataset')
+    parser.add_argument('--model_config', type=str, default=None, help='config of the model (edge settings are read from it)')
+    parser.add_argument('--k_neighbors', type=int, default=9)
+    parser.add_argument('--global_message_passing', action="store_true", default=False)
+    parser.add_argument('--bottom_global_message_passing', action="store_true", default=False)
+    parser.add_argument('--fragmentation_method', type=str, default=None, choices=['PS_300'])
+    parser.add_argument('--batch_size', type=int, default=32)
+    return parser.parse_args()
+
+
+def main(args):
+    if args.model_config is not None:
+        with open(args.model_config, 'r') as f:
+            config = json.load(f)
+        for key in ['k_neighbors', 'global_message_passing', 'bottom_global_message_passing', 'fragmentation_method']:
+            setattr(args, key, config.get(key, getattr(args, key)))
+    VOCAB.load_tokenizer(args.fragmentation_method)
+    edge_constructor = create_edge_constructor(
+        args.k_neighbors, args.global_message_passing or args.bottom_global_message_passing)
+    store = build_edge_cache(PDBDataset(args.data_file), edge_constructor, args.bottom_global_message_passing,
+                             args.global_message_passing, batch_size=args.batch_size)
+    print_log(f'Saved the edges of {len(store)} items to {store.path}')
+
+
+if __name__ == '__main__':
+    main(parse())
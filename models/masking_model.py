@@ -3,20 +3,21 @@ import torch
 from torch_scatter import scatter_mean
 import json
 
-from .pretrain_model import DenoisePretrainModel
+from .pretrain_model import DenoisePretrainModel, get_batch_block_id
 from data.pdb_utils import VOCAB
-from .ATOMICA.utils import batchify
 
 
 class MaskedNodeModel(DenoisePretrainModel):
 
     def __init__(self, atom_hidden_size, block_hidden_size, edge_size, k_neighbors,
                  n_layers, num_masked_block_classes, dropout=0.0, bottom_global_message_passing=False, 
-                 global_message_passing=False, fragmentation_method=None) -> None:
+                 global_message_passing=False, fragmentation_method=None, factorize_edge_features=False,
+                 variable_length_pooling=False) -> None:
         super().__init__(
             atom_hidden_size=atom_hidden_size, block_hidden_size=block_hidden_size, edge_size=edge_size, 
             k_neighbors=k_neighbors, n_layers=n_layers, dropout=dropout, 
             bottom_global_message_passing=bottom_global_message_passing, global_message_passing=global_message_passing,
+            factorize_edge_features=factorize_edge_features, variable_length_pooling=variable_length_pooling,
             atom_noise=False, translation_noise=False, rotation_noise=False, 
             torsion_noise=False, fragmentation_method=fragmentation_method, num_masked_block_classes=num_masked_block_classes)
         assert not any([self.atom_noise, self.translation_noise, self.rotation_noise, self.torsion_noise]), 'Masking model should not have any denoising heads'
@@ -35,6 +36,8 @@ class MaskedNodeModel(DenoisePretrainModel):
             fragmentation_method=pretrained_model.fragmentation_method if hasattr(pretrained_model, "fragmentation_method") else None, # for backward compatibility
             bottom_global_message_passing=kwargs.get('bottom_global_message_passing', pretrained_model.bottom_global_message_passing),
             global_message_passing=kwargs.get('global_message_passing', pretrained_model.global_message_passing),
+            factorize_edge_features=kwargs.get('factorize_edge_features', getattr(pretrained_model, 'factorize_edge_features', False)),
+            variable_length_pooling=kwargs.get('variable_length_pooling', getattr(pretrained_model, 'variable_length_pooling', False)),
             num_masked_block_classes=kwargs['num_masked_block_classes'],
         )
         print(f"""Pretrained model params: hidden_size={model.hidden_size},
@@ -63,6 +66,8 @@ class MaskedNodeModel(DenoisePretrainModel):
             'k_neighbors': self.k_neighbors,
             'global_message_passing': self.global_message_passing,
             'bottom_global_message_passing': self.bottom_global_message_passing,
+            'factorize_edge_features': getattr(self, 'factorize_edge_features', False),
+            'variable_length_pooling': getattr(self, 'variable_length_pooling', False),
             'fragmentation_method': self.fragmentation_method,
             'num_masked_block_classes': self.num_masked_block_classes,
             'model_type': self.__class__.__name__,
@@ -90,15 +95,12 @@ class MaskedNodeModel(DenoisePretrainModel):
         else:
             raise ValueError(f"Model type {model_type} not recognized")
     
-    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, masked_blocks, masked_labels, return_logits=False):
+    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, masked_blocks, masked_labels, return_logits=False, precomputed_edges=None):
         with torch.no_grad():
-            batch_id = torch.zeros_like(segment_ids)  # [Nb]
-            batch_id[torch.cumsum(lengths, dim=0)[:-1]] = 1
-            batch_id.cumsum_(dim=0)  # [Nb], item idx in the batch
-
-            block_id = torch.zeros_like(A) # [Nu]
-            block_id[torch.cumsum(block_lengths, dim=0)[:-1]] = 1
-            block_id.cumsum_(dim=0)  # [Nu], block (residue) id of each unit (atom)
+            if precomputed_edges is None:
+                batch_id, block_id = get_batch_block_id(lengths, block_lengths, segment_ids, A)
+            else:
+                batch_id, block_id = precomputed_edges['batch_id'], precomputed_edges['block_id']
 
             # transform blocks to single units
             bottom_batch_id = batch_id[block_id]  # [Nu]
@@ -114,23 +116,21 @@ class MaskedNodeModel(DenoisePretrainModel):
         # bottom level message passing
         edges, edge_attr = self.get_edges(bottom_B, bottom_batch_id, bottom_segment_ids, 
                                           Z, bottom_block_id, self.bottom_global_message_passing, 
-                                          top=False)
+                                          top=False, precomputed_edges=precomputed_edges)
         bottom_block_repr = self.encoder(bottom_H_0, Z, bottom_batch_id, None, edges, edge_attr)
         
         # top level message passing 
         top_Z = scatter_mean(Z, block_id, dim=0)  # [Nb, n_channel, 3]
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
         edges, edge_attr = self.get_edges(B, batch_id, segment_ids, top_Z, top_block_id, 
-                                          self.global_message_passing, top=True)
+                                          self.global_message_passing, top=True, precomputed_edges=precomputed_edges)
 
         if self.bottom_global_message_passing:
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr, block_id)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr, block_id)
         else:
             atom_mask = A != VOCAB.get_atom_global_idx()
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr[atom_mask], block_id[atom_mask])
-
-        block_repr_from_bottom = self.atom_block_attn(top_H_0.unsqueeze(1), batched_bottom_block_repr)
-        top_H_0 = top_H_0 + block_repr_from_bottom.squeeze(1)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr[atom_mask], block_id[atom_mask])
+        top_H_0 = top_H_0 + block_repr_from_bottom
         top_H_0 = self.atom_block_attn_norm(top_H_0)
 
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
@@ -3,8 +3,7 @@ import torch
 from torch_scatter import scatter_mean
 
 from data.pdb_utils import VOCAB
-from .pretrain_model import DenoisePretrainModel
-from .ATOMICA.utils import batchify
+from .pretrain_model import DenoisePretrainModel, get_batch_block_id
 import json
 
 PredictionReturnValue = namedtuple(
@@ -14,11 +13,13 @@ PredictionReturnValue = namedtuple(
 
 class PredictionModel(DenoisePretrainModel):
     def __init__(self, atom_hidden_size, block_hidden_size, edge_size, k_neighbors,
-                 n_layers, dropout=0.0, bottom_global_message_passing=False, global_message_passing=False, fragmentation_method=None) -> None:
+                 n_layers, dropout=0.0, bottom_global_message_passing=False, global_message_passing=False, fragmentation_method=None,
+                 factorize_edge_features=False, variable_length_pooling=False) -> None:
         super().__init__(
             atom_hidden_size=atom_hidden_size, block_hidden_size=block_hidden_size, edge_size=edge_size, 
             k_neighbors=k_neighbors, n_layers=n_layers, dropout=dropout, 
             bottom_global_message_passing=bottom_global_message_passing, global_message_passing=global_message_passing,
+            factorize_edge_features=factorize_edge_features, variable_length_pooling=variable_length_pooling,
             atom_noise=False, translation_noise=False, rotation_noise=False, 
             torsion_noise=False, fragmentation_method=fragmentation_method, num_masked_block_classes=None)
         assert not any([self.atom_noise, self.translation_noise, self.rotation_noise, self.torsion_noise]), 'Prediction model should not have any denoising heads'
@@ -37,6 +38,8 @@ class PredictionModel(DenoisePretrainModel):
             fragmentation_method=pretrained_model.fragmentation_method if hasattr(pretrained_model, "fragmentation_method") else None, # for backward compatibility
             bottom_global_message_passing=kwargs.get('bottom_global_message_passing', pretrained_model.bottom_global_message_passing),
             global_message_passing=kwargs.get('global_message_passing', pretrained_model.global_message_passing),
+            factorize_edge_features=kwargs.get('factorize_edge_features', getattr(pretrained_model, 'factorize_edge_features', False)),
+            variable_length_pooling=kwargs.get('variable_length_pooling', getattr(pretrained_model, 'variable_length_pooling', False)),
         )
         print(f"""Pretrained model params: hidden_size={model.hidden_size},
                edge_size={model.edge_size}, k_neighbors={model.k_neighbors}, 
@@ -69,6 +72,8 @@ class PredictionModel(DenoisePretrainModel):
             'k_neighbors': self.k_neighbors,
             'global_message_passing': self.global_message_passing,
             'bottom_global_message_passing': self.bottom_global_message_passing,
+            'factorize_edge_features': getattr(self, 'factorize_edge_features', False),
+            'variable_length_pooling': getattr(self, 'variable_length_pooling', False),
             'fragmentation_method': self.fragmentation_method,
             'model_type': self.__class__.__name__,
         }
@@ -106,16 +111,13 @@ class PredictionModel(DenoisePretrainModel):
             raise ValueError(f"Model type {model_type} not recognized")
 
     ########## overload ##########
-    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, return_graph_repr=True) -> PredictionReturnValue:
+    def forward(self, Z, B, A, block_lengths, lengths, segment_ids, return_graph_repr=True, precomputed_edges=None) -> PredictionReturnValue:
         # batch_id and block_id
         with torch.no_grad():
-            batch_id = torch.zeros_like(segment_ids)  # [Nb]
-            batch_id[torch.cumsum(lengths, dim=0)[:-1]] = 1
-            batch_id.cumsum_(dim=0)  # [Nb], item idx in the batch
-
-            block_id = torch.zeros_like(A) # [Nu]
-            block_id[torch.cumsum(block_lengths, dim=0)[:-1]] = 1
-            block_id.cumsum_(dim=0)  # [Nu], block (residue) id of each unit (atom)
+            if precomputed_edges is None:
+                batch_id, block_id = get_batch_block_id(lengths, block_lengths, segment_ids, A)
+            else:
+                batch_id, block_id = precomputed_edges['batch_id'], precomputed_edges['block_id']
 
             # transform blocks to single units
             bottom_batch_id = batch_id[block_id]  # [Nu]
@@ -130,7 +132,7 @@ class PredictionModel(DenoisePretrainModel):
         # bottom level message passing
         edges, edge_attr = self.get_edges(bottom_B, bottom_batch_id, bottom_segment_ids, 
                                           Z, bottom_block_id, self.bottom_global_message_passing, 
-                                          top=False)
+                                          top=False, precomputed_edges=precomputed_edges)
         bottom_block_repr = self.encoder(
             bottom_H_0, Z, bottom_batch_id, None, edges, edge_attr, 
         )
@@ -139,14 +141,13 @@ class PredictionModel(DenoisePretrainModel):
         top_Z = scatter_mean(Z, block_id, dim=0)  # [Nb, n_channel, 3]
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
         edges, edge_attr = self.get_edges(B, batch_id, segment_ids, top_Z, top_block_id, 
-                                          self.global_message_passing, top=True)
+                                          self.global_message_passing, top=True, precomputed_edges=precomputed_edges)
         if self.bottom_global_message_passing:
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr, block_id)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr, block_id)
         else:
             atom_mask = A != VOCAB.get_atom_global_idx()
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr[atom_mask], block_id[atom_mask])
-        block_repr_from_bottom = self.atom_block_attn(top_H_0.unsqueeze(1), batched_bottom_block_repr)
-        top_H_0 = top_H_0 + block_repr_from_bottom.squeeze(1)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr[atom_mask], block_id[atom_mask])
+        top_H_0 = top_H_0 + block_repr_from_bottom
         top_H_0 = self.atom_block_attn_norm(top_H_0)
 
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
@@ -179,5 +180,6 @@ class PredictionModel(DenoisePretrainModel):
             block_lengths=batch['block_lengths'],
             lengths=batch['lengths'],
             segment_ids=batch['segment_ids'],
+            precomputed_edges=batch.get('precomputed_edges', None),
         )
         return return_value
\ No newline at end of file
@@ -14,7 +14,6 @@ from data.dataset import MODALITIES
 from .tools import BlockEmbedding, KNNBatchEdgeConstructor
 from .ATOMICA.encoder import ATOMICAEncoder, AttentionPooling
 from .tools import CrossAttention
-from .ATOMICA.utils import batchify
 
 
 ReturnValue = namedtuple(
@@ -78,12 +77,100 @@ def construct_edges(edge_constructor, B, batch_id, segment_ids, X, block_id, com
 
     return intra_edges, inter_edges, global_normal_edges, global_global_edges
 
+
+def create_edge_constructor(k_neighbors, global_message_passing):
+    return KNNBatchEdgeConstructor(
+        k_neighbors=k_neighbors,
+        global_message_passing=global_message_passing,
+        global_node_id_vocab=[VOCAB.symbol_to_idx(VOCAB.GLB), VOCAB.get_atom_global_idx()], # global edges are only constructed for the global block, but not the global atom
+        delete_self_loop=True)
+
+
+def get_batch_block_id(lengths, block_lengths, segment_ids, A):
+    '''item index of each block (batch_id, [Nb]) and block index of each unit (block_id, [Nu])'''
+    batch_id = torch.zeros_like(segment_ids)  # [Nb]
+    batch_id[torch.cumsum(lengths, dim=0)[:-1]] = 1
+    batch_id.cumsum_(dim=0)  # [Nb], item idx in the batch
+
+    block_id = torch.zeros_like(A) # [Nu]
+    block_id[torch.cumsum(block_lengths, dim=0)[:-1]] = 1
+    block_id.cumsum_(dim=0)  # [Nu], block (residue) id of each unit (atom)
+    return batch_id, block_id
+
+
+def get_typed_edges(edge_constructor, B, batch_id, segment_ids, Z, block_id, global_message_passing):
+    '''edges of one level of the graph and their types (0: intra, 1: inter, 2: global-normal, 3: global-global)'''
+    # the sparse constructor scales with O(Nk), so the batch no longer needs to be spliced
+    complexity = -1 if edge_constructor.sparse else 2000**2
+    intra_edges, inter_edges, global_normal_edges, global_global_edges = construct_edges(
+                edge_constructor, B, batch_id, segment_ids, Z, block_id, complexity=complexity)
+    if global_message_passing:
+        edges = torch.cat([intra_edges, inter_edges, global_normal_edges, global_global_edges], dim=1)
+        edge_type = torch.cat([
+            torch.zeros_like(intra_edges[0]),
+            torch.ones_like(inter_edges[0]),
+            torch.ones_like(global_normal_edges[0]) * 2,
+            torch.ones_like(global_global_edges[0]) * 3])
+    else:
+        edges = torch.cat([intra_edges, inter_edges], dim=1)
+        edge_type = torch.cat([torch.zeros_like(intra_edges[0]), torch.ones_like(inter_edges[0])])
+    return edges, edge_type
+
+
+@torch.no_grad()
+def precompute_edges(edge_constructor, Z, B, A, block_lengths, lengths, segment_ids,
+                     bottom_global_message_passing, global_message_passing):
+    '''
+    batch_id, block_id and the typed edges of the unit (bottom) and block (top) level, exactly as the forward
+    of DenoisePretrainModel builds them. They only depend on the coordinates and the batch layout, so they can be
+    built before the batch reaches the model and passed to its forward as precomputed_edges.
+    '''
+    batch_id, block_id = get_batch_block_id(lengths, block_lengths, segment_ids, A)
+    bottom_edges, bottom_edge_type = get_typed_edges(
+        edge_constructor, B[block_id], batch_id[block_id], segment_ids[block_id], Z,
+        torch.arange(0, len(block_id), device=block_id.device), bottom_global_message_passing)
+    top_Z = scatter_mean(Z, block_id, dim=0)  # [Nb, n_channel, 3]
+    top_edges, top_edge_type = get_typed_edges(
+        edge_constructor, B, batch_id, segment_ids, top_Z,
+        torch.arange(0, len(batch_id), device=batch_id.device), global_message_passing)
+    return {
+        'batch_id': batch_id,
+        'block_id': block_id,
+        'bottom_edges': bottom_edges,
+        'bottom_edge_type': bottom_edge_type,
+        'top_edges': top_edges,
+        'top_edge_type': top_edge_type,
+    }
+
+
+class PrecomputeEdgesCollate:
+    '''
+    collate_fn for the DataLoader, which adds batch['precomputed_edges'] (see precompute_edges) to the batches of
+    the wrapped collate_fn. With num_workers > 0 the edges are then built on CPU inside the worker processes,
+    overlapping with the compute of the previous step, instead of on the main process in the forward of the model.
+    '''
+    def __init__(self, collate_fn, model):
+        self.collate_fn = collate_fn
+        self.edge_constructor = deepcopy(model.edge_constructor)
+        self.bottom_global_message_passing = model.bottom_global_message_passing
+        self.global_message_passing = model.global_message_passing
+
+    def __call__(self, batch, **kwargs):
+        batch = self.collate_fn(batch, **kwargs)
+        if 'precomputed_edges' in batch:  # read from an edge store (see models/edge_cache.py)
+            return batch
+        batch['precomputed_edges'] = precompute_edges(
+            self.edge_constructor, batch['X'], batch['B'], batch['A'], batch['block_lengths'],
+            batch['lengths'], batch['segment_ids'], self.bottom_global_message_passing, self.global_message_passing)
+        return batch
+
 class DenoisePretrainModel(nn.Module):
 
     def __init__(self, atom_hidden_size, block_hidden_size, edge_size=16, k_neighbors=9, n_layers=3,
                  dropout=0.0, bottom_global_message_passing=False, global_message_passing=False, fragmentation_method=None,
                  atom_noise=True, translation_noise=True, rotation_noise=True, torsion_noise=True, num_masked_block_classes=None, 
-                 atom_weight=1, translation_weight=1, rotation_weight=1, torsion_weight=1, mask_weight=1, modality_embedding=False) -> None:
+                 atom_weight=1, translation_weight=1, rotation_weight=1, torsion_weight=1, mask_weight=1, modality_embedding=False,
+                 factorize_edge_features=False, variable_length_pooling=False) -> None:
         super().__init__()
 
         # model parameters
@@ -99,6 +186,8 @@ class DenoisePretrainModel(nn.Module):
         # message passing parameters
         self.global_message_passing = global_message_passing
         self.bottom_global_message_passing = bottom_global_message_passing
+        self.factorize_edge_features = factorize_edge_features
+        self.variable_length_pooling = variable_length_pooling
 
         # block embedding parameters
         self.fragmentation_method = fragmentation_method
@@ -130,11 +219,8 @@ class DenoisePretrainModel(nn.Module):
         if self.use_modality_embedding:
             self.modality_embedding = nn.Embedding(len(MODALITIES), block_hidden_size)
 
-        self.edge_constructor = KNNBatchEdgeConstructor(
-            k_neighbors=k_neighbors,
-            global_message_passing=self.global_message_passing or self.bottom_global_message_passing,
-            global_node_id_vocab=[self.global_block_id, VOCAB.get_atom_global_idx()], # global edges are only constructed for the global block, but not the global atom
-            delete_self_loop=True)
+        self.edge_constructor = create_edge_constructor(
+            k_neighbors, self.global_message_passing or self.bottom_global_message_passing)
         self.edge_embedding_bottom = nn.Embedding(4, edge_size)  # [intra / inter / global_global / global_normal]
         self.edge_embedding_top = nn.Embedding(4, edge_size)  # [intra / inter / global_global / global_normal]
         
@@ -142,14 +228,17 @@ class DenoisePretrainModel(nn.Module):
             atom_hidden_size, edge_size, n_layers=n_layers, dropout=dropout,
             return_atom_noise=atom_noise, return_global_noise=translation_noise or rotation_noise,
             return_torsion_noise=torsion_noise, max_torsion_neighbors=k_neighbors, 
-            max_edge_length=5, max_global_edge_length=20, max_torsion_edge_length=5
+            max_edge_length=5, max_global_edge_length=20, max_torsion_edge_length=5,
+            factorize_edge_features=factorize_edge_features
         )
         self.top_encoder = ATOMICAEncoder(
-            block_hidden_size, edge_size, n_layers=n_layers, dropout=dropout, max_edge_length=5
+            block_hidden_size, edge_size, n_layers=n_layers, dropout=dropout, max_edge_length=5,
+            factorize_edge_features=factorize_edge_features
         )
         self.atom_block_attn = CrossAttention(block_hidden_size, atom_hidden_size, block_hidden_size, num_heads=4, dropout=dropout)
         self.atom_block_attn_norm = nn.LayerNorm(block_hidden_size)
-        self.attention_pooling = AttentionPooling(block_hidden_size, num_heads=4, dropout=dropout, num_layers=4)
+        self.attention_pooling = AttentionPooling(block_hidden_size, num_heads=4, dropout=dropout, num_layers=4,
+                                                  variable_length=variable_length_pooling)
 
         if self.atom_noise:
             self.top_scale_noise_ffn = nn.Sequential(
@@ -206,6 +295,8 @@ class DenoisePretrainModel(nn.Module):
             'k_neighbors': self.k_neighbors,
             'global_message_passing': self.global_message_passing,
             'bottom_global_message_passing': self.bottom_global_message_passing,
+            'factorize_edge_features': getattr(self, 'factorize_edge_features', False),  # for checkpoints pickled before the option
+            'variable_length_pooling': getattr(self, 'variable_length_pooling', False),
             'fragmentation_method': self.fragmentation_method,
             'atom_noise': self.atom_noise,
             'translation_noise': self.translation_noise,
@@ -231,25 +322,30 @@ class DenoisePretrainModel(nn.Module):
         model.load_state_dict(torch.load(weights_path, map_location=torch.device('cpu')))
         return model
 
-
-    def get_edges(self, B, batch_id, segment_ids, Z, block_id, global_message_passing, top):
-        intra_edges, inter_edges, global_normal_edges, global_global_edges = construct_edges(
-                    self.edge_constructor, B, batch_id, segment_ids, Z, block_id, complexity=2000**2)
-        if global_message_passing:
-            edges = torch.cat([intra_edges, inter_edges, global_normal_edges, global_global_edges], dim=1)
-            edge_attr = torch.cat([
-                torch.zeros_like(intra_edges[0]),
-                torch.ones_like(inter_edges[0]),
-                torch.ones_like(global_normal_edges[0]) * 2,
-                torch.ones_like(global_global_edges[0]) * 3])
-        else:
-            edges = torch.cat([intra_edges, inter_edges], dim=1)
-            edge_attr = torch.cat([torch.zeros_like(intra_edges[0]), torch.ones_like(inter_edges[0])])
+    def set_factorize_edge_features(self, factorize_edge_features):
+        '''switches the factorized edge features of the encoders (see InteractionModule), the parameters are the same'''
+        self.factorize_edge_features = factorize_edge_features
+        for encoder in [self.encoder, self.top_encoder]:
+            encoder.encoder.factorize_edge_features = factorize_edge_features
+
+    def set_variable_length_pooling(self, variable_length_pooling):
+        '''switches the padding-free attention pooling (see AttentionPooling), the parameters are the same'''
+        self.variable_length_pooling = variable_length_pooling
+        self.attention_pooling.variable_length = variable_length_pooling
+
+
+    def get_edges(self, B, batch_id, segment_ids, Z, block_id, global_message_passing, top, precomputed_edges=None):
+        if precomputed_edges is None:
+            edges, edge_type = get_typed_edges(
+                self.edge_constructor, B, batch_id, segment_ids, Z, block_id, global_message_passing)
+        else:  # built in the collate step, see PrecomputeEdgesCollate
+            level = 'top' if top else 'bottom'
+            edges, edge_type = precomputed_edges[f'{level}_edges'], precomputed_edges[f'{level}_edge_type']
         
         if top:
-            edge_attr = self.edge_embedding_top(edge_attr)
+            edge_attr = self.edge_embedding_top(edge_type)
         else:
-            edge_attr = self.edge_embedding_bottom(edge_attr)
+            edge_attr = self.edge_embedding_bottom(edge_type)
 
         return edges, edge_attr
     
@@ -257,19 +353,16 @@ class DenoisePretrainModel(nn.Module):
     def forward(self, Z, B, A, block_lengths, lengths, segment_ids, 
                 receptor_segment=None, atom_score=None, atom_eps=None, tr_score=None, 
                 tr_eps=None, rot_score=None,tor_edges=None, tor_score=None, tor_batch=None,
-                masked_blocks=None, masked_labels=None, modality=None,
+                masked_blocks=None, masked_labels=None, modality=None, precomputed_edges=None,
                 ) -> ReturnValue:
         with torch.no_grad():
             assert tor_edges.shape[1] == tor_score.shape[0], f"tor_edges {tor_edges.shape} and tor_score {tor_score.shape} should have the same length"
             assert self.atom_noise or self.translation_noise or self.rotation_noise or self.torsion_noise, 'At least one type of noise should be enabled, otherwise the model is not denoising'
 
-            batch_id = torch.zeros_like(segment_ids)  # [Nb]
-            batch_id[torch.cumsum(lengths, dim=0)[:-1]] = 1
-            batch_id.cumsum_(dim=0)  # [Nb], item idx in the batch
-
-            block_id = torch.zeros_like(A) # [Nu]
-            block_id[torch.cumsum(block_lengths, dim=0)[:-1]] = 1
-            block_id.cumsum_(dim=0)  # [Nu], block (residue) id of each unit (atom)
+            if precomputed_edges is None:
+                batch_id, block_id = get_batch_block_id(lengths, block_lengths, segment_ids, A)
+            else:
+                batch_id, block_id = precomputed_edges['batch_id'], precomputed_edges['block_id']
 
             # transform blocks to single units
             bottom_batch_id = batch_id[block_id]  # [Nu]
@@ -291,7 +384,7 @@ class DenoisePretrainModel(nn.Module):
         # bottom level message passing
         edges, edge_attr = self.get_edges(bottom_B, bottom_batch_id, bottom_segment_ids, 
                                           Z_perturbed, bottom_block_id, self.bottom_global_message_passing, 
-                                          top=False)
+                                          top=False, precomputed_edges=precomputed_edges)
         bottom_block_repr, trans_noise, rot_noise, pred_noise, tor_noise = self.encoder(
             bottom_H_0, Z_perturbed, bottom_batch_id, perturb_mask, edges, edge_attr, 
             tor_edges=tor_edges, tor_batch=tor_batch)
@@ -300,16 +393,14 @@ class DenoisePretrainModel(nn.Module):
         top_Z = scatter_mean(Z_perturbed, block_id, dim=0)  # [Nb, n_channel, 3]
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
         edges, edge_attr = self.get_edges(B, batch_id, segment_ids, top_Z, top_block_id, 
-                                          self.global_message_passing, top=True)
+                                          self.global_message_passing, top=True, precomputed_edges=precomputed_edges)
 
         if self.bottom_global_message_passing:
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr, block_id)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr, block_id)
         else:
             atom_mask = A != VOCAB.get_atom_global_idx()
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr[atom_mask], block_id[atom_mask])
-
-        block_repr_from_bottom = self.atom_block_attn(top_H_0.unsqueeze(1), batched_bottom_block_repr)
-        top_H_0 = top_H_0 + block_repr_from_bottom.squeeze(1)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr[atom_mask], block_id[atom_mask])
+        top_H_0 = top_H_0 + block_repr_from_bottom
         top_H_0 = self.atom_block_attn_norm(top_H_0)
 
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
@@ -419,11 +510,13 @@ class DenoisePretrainModelWithBlockEmbedding(DenoisePretrainModel):
                  atom_noise=True, translation_noise=True, rotation_noise=True, torsion_noise=True, num_masked_block_classes=None, 
                  atom_weight=1, translation_weight=1, rotation_weight=1, torsion_weight=1, mask_weight=1, modality_embedding=False,
                  num_projector_layers=3, projector_hidden_size=32, projector_dropout=0,
-                 block_embedding_size=None, block_embedding0_size=None, block_embedding1_size=None) -> None:
+                 block_embedding_size=None, block_embedding0_size=None, block_embedding1_size=None,
+                 factorize_edge_features=False, variable_length_pooling=False) -> None:
         super().__init__(
             atom_hidden_size, block_hidden_size, edge_size, k_neighbors, n_layers, dropout, bottom_global_message_passing, global_message_passing, fragmentation_method,
             atom_noise, translation_noise, rotation_noise, torsion_noise, num_masked_block_classes, 
             atom_weight, translation_weight, rotation_weight, torsion_weight, mask_weight, modality_embedding,
+            factorize_edge_features=factorize_edge_features, variable_length_pooling=variable_length_pooling,
         )
         self.num_projector_layers = num_projector_layers
         self.projector_hidden_size = projector_hidden_size
@@ -492,19 +585,16 @@ class DenoisePretrainModelWithBlockEmbedding(DenoisePretrainModel):
                 receptor_segment=None, atom_score=None, atom_eps=None, tr_score=None, 
                 tr_eps=None, rot_score=None,tor_edges=None, tor_score=None, tor_batch=None,
                 masked_blocks=None, masked_labels=None, modality=None,
-                block_embeddings=None, block_embeddings0=None, block_embeddings1=None,
+                block_embeddings=None, block_embeddings0=None, block_embeddings1=None, precomputed_edges=None,
                 ) -> ReturnValue:
         with torch.no_grad():
             assert tor_edges.shape[1] == tor_score.shape[0], f"tor_edges {tor_edges.shape} and tor_score {tor_score.shape} should have the same length"
             assert self.atom_noise or self.translation_noise or self.rotation_noise or self.torsion_noise, 'At least one type of noise should be enabled, otherwise the model is not denoising'
 
-            batch_id = torch.zeros_like(segment_ids)  # [Nb]
-            batch_id[torch.cumsum(lengths, dim=0)[:-1]] = 1
-            batch_id.cumsum_(dim=0)  # [Nb], item idx in the batch
-
-            block_id = torch.zeros_like(A) # [Nu]
-            block_id[torch.cumsum(block_lengths, dim=0)[:-1]] = 1
-            block_id.cumsum_(dim=0)  # [Nu], block (residue) id of each unit (atom)
+            if precomputed_edges is None:
+                batch_id, block_id = get_batch_block_id(lengths, block_lengths, segment_ids, A)
+            else:
+                batch_id, block_id = precomputed_edges['batch_id'], precomputed_edges['block_id']
 
             # transform blocks to single units
             bottom_batch_id = batch_id[block_id]  # [Nu]
@@ -536,7 +626,7 @@ class DenoisePretrainModelWithBlockEmbedding(DenoisePretrainModel):
         # bottom level message passing
         edges, edge_attr = self.get_edges(bottom_B, bottom_batch_id, bottom_segment_ids, 
                                           Z_perturbed, bottom_block_id, self.bottom_global_message_passing, 
-                                          top=False)
+                                          top=False, precomputed_edges=precomputed_edges)
         bottom_block_repr, trans_noise, rot_noise, pred_noise, tor_noise = self.encoder(
             bottom_H_0, Z_perturbed, bottom_batch_id, perturb_mask, edges, edge_attr, 
             tor_edges=tor_edges, tor_batch=tor_batch)
@@ -545,16 +635,14 @@ class DenoisePretrainModelWithBlockEmbedding(DenoisePretrainModel):
         top_Z = scatter_mean(Z_perturbed, block_id, dim=0)  # [Nb, n_channel, 3]
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
         edges, edge_attr = self.get_edges(B, batch_id, segment_ids, top_Z, top_block_id, 
-                                          self.global_message_passing, top=True)
+                                          self.global_message_passing, top=True, precomputed_edges=precomputed_edges)
 
         if self.bottom_global_message_passing:
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr, block_id)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr, block_id)
         else:
             atom_mask = A != VOCAB.get_atom_global_idx()
-            batched_bottom_block_repr, _ = batchify(bottom_block_repr[atom_mask], block_id[atom_mask])
-
-        block_repr_from_bottom = self.atom_block_attn(top_H_0.unsqueeze(1), batched_bottom_block_repr)
-        top_H_0 = top_H_0 + block_repr_from_bottom.squeeze(1)
+            block_repr_from_bottom = self.atom_block_attn.segment_forward(top_H_0, bottom_block_repr[atom_mask], block_id[atom_mask])
+        top_H_0 = top_H_0 + block_repr_from_bottom
         top_H_0 = self.atom_block_attn_norm(top_H_0)
 
         top_block_id = torch.arange(0, len(batch_id), device=batch_id.device)
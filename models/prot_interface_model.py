@@ -44,6 +44,8 @@ class ProteinInterfaceModel(nn.Module):
             fragmentation_method=pretrained_model.fragmentation_method if hasattr(pretrained_model, "fragmentation_method") else None, # for backward compatibility
             bottom_global_message_passing=kwargs.get('bottom_global_message_passing', pretrained_model.bottom_global_message_passing),
             global_message_passing=kwargs.get('global_message_passing', pretrained_model.global_message_passing),
+            factorize_edge_features=kwargs.get('factorize_edge_features', getattr(pretrained_model, 'factorize_edge_features', False)),
+            variable_length_pooling=kwargs.get('variable_length_pooling', getattr(pretrained_model, 'variable_length_pooling', False)),
         )
         print(f"""Pretrained model params: hidden_size={model.hidden_size},
                edge_size={model.edge_size}, k_neighbors={model.k_neighbors}, 
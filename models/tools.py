@@ -3,7 +3,8 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch_scatter import scatter_sum, scatter_min
+from torch_scatter import scatter_sum, scatter_min, scatter_max, scatter_mean
+from torch_cluster import knn
 from .ATOMICA.utils import GaussianEmbedding
 from copy import copy
 
@@ -93,7 +94,20 @@ def _unit_edges_from_block_edges(unit_block_id, block_src_dst, Z=None, k=None):
     return (unit_src, unit_dst), (edge_id, unit_edge_src_start, unit_edge_src_id)
 
 
-def _block_edge_dist(X, block_id, src_dst):
+def _block_bounding_spheres(X, block_id):
+    '''
+    :param X: [N, 3], coordinates
+    :param block_id [N], id of block of each unit
+    :return: centroids [Nb, 3], radii [Nb] and the unit closest to the centroid of each block [Nb]
+    '''
+    centroids = scatter_mean(X, block_id, dim=0)  # [Nb, 3]
+    unit_dist = torch.norm(X - centroids[block_id], dim=-1)  # [N]
+    radii = scatter_max(unit_dist, block_id, dim=0)[0]  # [Nb]
+    center_unit = scatter_min(unit_dist, block_id, dim=0)[1]  # [Nb]
+    return centroids, radii, center_unit
+
+
+def _block_edge_dist(X, block_id, src_dst, k_neighbors=None, chunk_size=2**22):
     '''
     Several units constitute a block.
     This function calculates the distance of edges between blocks
@@ -102,12 +116,46 @@ def _block_edge_dist(X, block_id, src_dst):
     :param X: [N, 3], coordinates.
     :param block_id [N], id of block of each unit. Assume X is sorted so that block_id starts from 0 to Nb - 1
     :param src_dst: [Eb, 2], all edges (block level) that needs distance calculation, represented in (src, dst)
+    :param k_neighbors: if given, the distances are only used to select the k nearest dst of each src. Block
+        pairs that cannot be among them by the triangle inequality on the block bounding spheres are not
+        expanded to unit pairs, and get their lower bound (larger than the k-th distance) instead.
+    :param chunk_size: maximal number of unit pairs expanded at once, which bounds the peak memory
     '''
-    (unit_src, unit_dst), (edge_id, _, _) = _unit_edges_from_block_edges(block_id, src_dst)
-    # calculate unit-pair distances
-    src_x, dst_x = X[unit_src], X[unit_dst]  # [Eu, 3]
-    dist = torch.norm(src_x - dst_x, dim=-1)  # [Eu]
-    dist = scatter_min(dist, edge_id)[0]  # [Eb]
+    dist = torch.zeros(src_dst.shape[0], *X.shape[1:-1], device=X.device, dtype=X.dtype)  # [Eb]
+    if src_dst.shape[0] == 0:
+        return dist
+
+    exact = torch.ones(src_dst.shape[0], dtype=torch.bool, device=X.device)
+    if k_neighbors is not None and X.dim() == 2:
+        centroids, radii, center_unit = _block_bounding_spheres(X, block_id)
+        src, dst = src_dst[:, 0], src_dst[:, 1]
+        lower = torch.norm(centroids[src] - centroids[dst], dim=-1) - radii[src] - radii[dst]
+        upper = torch.norm(X[center_unit[src]] - X[center_unit[dst]], dim=-1)  # distance of an actual unit pair
+        # k-th smallest upper bound of each src, no pruning if it has less than k candidates
+        order = torch.argsort(upper, stable=True)
+        order = order[torch.argsort(src[order], stable=True)]
+        sorted_src = src[order]
+        rank = torch.arange(len(order), device=X.device) - torch.searchsorted(sorted_src, sorted_src)
+        kth_upper = torch.full((centroids.shape[0],), float('inf'), device=X.device, dtype=X.dtype)
+        kth_upper[sorted_src[rank == k_neighbors - 1]] = upper[order[rank == k_neighbors - 1]]
+        # tolerance guards against rounding in the bounds
+        exact = lower <= kth_upper[src] + 1e-3
+        dist[~exact] = lower[~exact]
+
+    # expand the remaining block pairs to unit pairs in chunks of about chunk_size pairs
+    exact_idx = torch.nonzero(exact).flatten()
+    if len(exact_idx) == 0:
+        return dist
+    block_n_units = scatter_sum(torch.ones_like(block_id), block_id)  # [Nb]
+    n_pairs = block_n_units[src_dst[exact_idx, 0]] * block_n_units[src_dst[exact_idx, 1]]  # [Eb']
+    chunk_id = torch.div(torch.cumsum(n_pairs, dim=0) - 1, chunk_size, rounding_mode='floor')  # [Eb']
+    chunk_lengths = torch.unique_consecutive(chunk_id, return_counts=True)[1].tolist()
+    for chunk_idx in torch.split(exact_idx, chunk_lengths):
+        (unit_src, unit_dst), (edge_id, _, _) = _unit_edges_from_block_edges(block_id, src_dst[chunk_idx])
+        # calculate unit-pair distances
+        src_x, dst_x = X[unit_src], X[unit_dst]  # [Eu, 3]
+        unit_dist = torch.norm(src_x - dst_x, dim=-1)  # [Eu]
+        dist[chunk_idx] = scatter_min(unit_dist, edge_id, dim=0, dim_size=len(chunk_idx))[0]  # [Eb]
 
     return dist
 
@@ -177,6 +225,68 @@ def _knn_edges(dist, src_dst, k_neighbors, batch_info):
     return edges  # [2, E]
 
 
+def _sparse_knn_edges(X, batch_id, query_mask, target_mask, k_neighbors, exclude_self):
+    '''
+    KNN edges found by spatial search (torch_cluster.knn) instead of a dense [N, max_n] distance matrix.
+    Each query node is connected to its k nearest target nodes in the same graph.
+
+    :param X: [N, 3], coordinates
+    :param batch_id: [N], graph id of each node, sorted
+    :param query_mask: [N], nodes that receive edges (src)
+    :param target_mask: [N], candidate neighbors (dst)
+    :param exclude_self: remove self-loops (query and target sets overlap)
+    '''
+    query_idx = torch.nonzero(query_mask).flatten()
+    target_idx = torch.nonzero(target_mask).flatten()
+    if len(query_idx) == 0 or len(target_idx) == 0:
+        return torch.zeros((2, 0), dtype=torch.long, device=X.device)
+
+    # one more neighbor is searched as the node itself is always among the nearest
+    k = k_neighbors + 1 if exclude_self else k_neighbors
+    row, col = knn(X[target_idx], X[query_idx], k, batch_x=batch_id[target_idx], batch_y=batch_id[query_idx])
+    src, dst = query_idx[row], target_idx[col]
+    if exclude_self:
+        not_self = src != dst
+        src, dst = src[not_self], dst[not_self]
+
+    # sort by (src, dist) as topk does, and drop the extra neighbor left by coordinate duplicates
+    dist = torch.norm(X[src] - X[dst], dim=-1)
+    order = torch.argsort(dist, stable=True)
+    order = order[torch.argsort(src[order], stable=True)]
+    src, dst = src[order], dst[order]
+    rank = torch.arange(len(src), device=src.device) - torch.searchsorted(src, src)
+    is_valid = rank < k_neighbors
+
+    edges = torch.stack([src[is_valid], dst[is_valid]])  # message passed from dst to src
+    return edges  # [2, E]
+
+
+def _group_pairs(query_idx, query_key, target_idx, target_key):
+    '''
+    All (query, target) pairs sharing the same key, with memory linear in the number of pairs
+
+    :param query_idx: [Nq], node index of queries
+    :param query_key: [Nq], group key of queries
+    :param target_idx: [Nt], node index of targets
+    :param target_key: [Nt], group key of targets
+    '''
+    target_key, order = torch.sort(target_key, stable=True)
+    target_idx = target_idx[order]
+    start = torch.searchsorted(target_key, query_key)
+    counts = torch.searchsorted(target_key, query_key, right=True) - start  # [Nq]
+    src = torch.repeat_interleave(query_idx, counts)
+    # position of each pair inside its group, shifted to the start of the group in target_idx
+    shift = torch.repeat_interleave(start - (torch.cumsum(counts, dim=0) - counts), counts)
+    dst = target_idx[torch.arange(len(src), device=src.device) + shift]
+    return src, dst
+
+
+def _sort_edges(src, dst, N):
+    # row-major order (src, dst), the same order as torch.nonzero on the dense adjacency
+    order = torch.argsort(src * N + dst)
+    return torch.stack([src[order], dst[order]])
+
+
 def _radial_edges(dist, src_dst, dist_cut_off):
     '''
     :param dist: [Ef], given distance of edges
@@ -197,6 +307,7 @@ class BatchEdgeConstructor:
         global nodes will connect to each other regardless of the segments they are in (global_global_edges)
     Additionally consider edges between adjacent nodes in the sequence in the same segment (seq_edges)
     '''
+    sparse = False  # whether edges are built without the dense [N, n] adjacency
 
     def __init__(self, global_node_id_vocab=[], delete_self_loop=True) -> None:
         self.global_node_id_vocab = copy(global_node_id_vocab)
@@ -323,17 +434,81 @@ class BatchEdgeConstructor:
 
 
 class KNNBatchEdgeConstructor(BatchEdgeConstructor):
-    def __init__(self, k_neighbors, global_message_passing=True, global_node_id_vocab=[], delete_self_loop=True) -> None:
+    '''
+    With sparse=True and one unit per block (as in the models, where block_id is the identity), intra / inter
+    KNN edges are found by spatial search and global edges are enumerated per segment, giving the same edge
+    sets as the dense construction with O(Nk) time and memory. Otherwise falls back to the dense O(Nn) path.
+    '''
+    sparse = True  # default for checkpoints pickled before the option existed
+
+    def __init__(self, k_neighbors, global_message_passing=True, global_node_id_vocab=[], delete_self_loop=True, sparse=True) -> None:
         super().__init__(global_node_id_vocab, delete_self_loop)
         self.k_neighbors = k_neighbors
         self.global_message_passing = global_message_passing
+        self.sparse = sparse
+
+    def _can_use_sparse(self, batch_id, X, block_id):
+        # block-level distances reduce to point distances only if each block has a single unit
+        return self.sparse and X.dim() == 2 and block_id.shape[0] == batch_id.shape[0]
+
+    def _sparse_edges(self, S, batch_id, segment_ids, X):
+        N = batch_id.shape[0]
+        if len(self.global_node_id_vocab):
+            is_global = sequential_or(*[S == global_node_id for global_node_id in self.global_node_id_vocab]) # [N]
+        else:
+            is_global = torch.zeros_like(S, dtype=torch.bool)
+        not_global = torch.logical_not(is_global)
+        segments, seg_rank = torch.unique(segment_ids, return_inverse=True)
+
+        # knn edges, looping over segments (normally two)
+        intra_edges, inter_edges = [], []
+        for seg in segments:
+            in_seg = segment_ids == seg
+            intra_edges.append(_sparse_knn_edges(
+                X, batch_id, in_seg & not_global, in_seg & not_global,
+                self.k_neighbors, exclude_self=self.delete_self_loop))
+            inter_edges.append(_sparse_knn_edges(
+                X, batch_id, in_seg & not_global, torch.logical_not(in_seg) & not_global,
+                self.k_neighbors, exclude_self=False))
+        intra_edges = torch.cat(intra_edges, dim=1)
+        inter_edges = torch.cat(inter_edges, dim=1)
+        # restore the row-major order of the dense construction, keeping the per-row distance order
+        intra_edges = intra_edges[:, torch.argsort(intra_edges[0], stable=True)]
+        inter_edges = inter_edges[:, torch.argsort(inter_edges[0], stable=True)]
+
+        if not self.global_message_passing:
+            return intra_edges, inter_edges, None, None, None
+
+        gni = torch.arange(N, device=batch_id.device)
+        global_idx = gni[is_global]
+        # global nodes connect to all nodes in the same segment of the same graph
+        seg_key = batch_id * len(segments) + seg_rank
+        src, dst = _group_pairs(global_idx, seg_key[is_global], gni, seg_key)
+        if self.delete_self_loop:
+            src, dst = src[src != dst], dst[src != dst]
+        reverse = not_global[dst]  # edges from global to global nodes are already included in both directions
+        global_normal_edges = _sort_edges(torch.cat([src, dst[reverse]]), torch.cat([dst, src[reverse]]), N)
+        # global nodes connect to each other regardless of the segments
+        src, dst = _group_pairs(global_idx, batch_id[is_global], global_idx, batch_id[is_global])
+        if self.delete_self_loop:
+            src, dst = src[src != dst], dst[src != dst]
+        global_global_edges = _sort_edges(src, dst, N)
+
+        return intra_edges, inter_edges, global_normal_edges, global_global_edges, None
+
+    @torch.no_grad()
+    def __call__(self, S, batch_id, segment_ids, **kwargs):
+        X, block_id = kwargs['X'], kwargs['block_id']
+        if self._can_use_sparse(batch_id, X, block_id):
+            return self._sparse_edges(S, batch_id, segment_ids, X)
+        return super().__call__(S, batch_id, segment_ids, **kwargs)
 
     def _construct_intra_edges(self, S, batch_id, segment_ids, **kwargs):
         all_intra_edges = super()._construct_intra_edges(S, batch_id, segment_ids)
         X, block_id = kwargs['X'], kwargs['block_id']
         # knn
         src_dst = all_intra_edges.T
-        dist = _block_edge_dist(X, block_id, src_dst)
+        dist = _block_edge_dist(X, block_id, src_dst, k_neighbors=self.k_neighbors)
         intra_edges = _knn_edges(
             dist, src_dst, self.k_neighbors,
             (self.offsets, batch_id, self.max_n, self.gni2lni))
@@ -344,7 +519,7 @@ class KNNBatchEdgeConstructor(BatchEdgeConstructor):
         X, block_id = kwargs['X'], kwargs['block_id']
         # knn
         src_dst = all_inter_edges.T
-        dist = _block_edge_dist(X, block_id, src_dst)
+        dist = _block_edge_dist(X, block_id, src_dst, k_neighbors=self.k_neighbors)
         inter_edges = _knn_edges(
             dist, src_dst, self.k_neighbors,
             (self.offsets, batch_id, self.max_n, self.gni2lni))
@@ -453,6 +628,53 @@ class CrossAttention(nn.Module):
         output = self.dropout(output)
         
         return output
+
+    def segment_forward(self, query, key_value, kv_segment, pad_to_max=True):
+        '''
+        Attention of each query over the entries of the packed key_value stream that belong to it
+        (e.g. each block over its atoms), using a segment softmax instead of padding with batchify.
+
+        :param query: [Nq, dim_query], one query per segment
+        :param key_value: [Nkv, dim_kv]
+        :param kv_segment: [Nkv], index of the query that each key_value belongs to
+        :param pad_to_max: also attend to the zero vectors batchify pads every segment with up to the longest one,
+            so that the output equals forward(query.unsqueeze(1), batchify(key_value, kv_segment)[0]).squeeze(1).
+            The padded keys are identical, so they are accounted for in closed form rather than materialized.
+        :return: [Nq, dim_out]
+        '''
+        n_query = query.shape[0]
+        n_heads, head_dim = self.num_heads, self.dim_out // self.num_heads
+        query = self.query_proj(query).view(n_query, n_heads, head_dim)
+        key = self.key_proj(key_value).view(-1, n_heads, head_dim)
+        value = self.value_proj(key_value).view(-1, n_heads, head_dim)
+
+        scores = (query[kv_segment] * key).sum(-1) * self.scale  # [Nkv, num_heads]
+        seg_max = scatter_max(scores, kv_segment, dim=0, dim_size=n_query)[0]  # [Nq, num_heads]
+        n_kv = scatter_sum(torch.ones_like(kv_segment), kv_segment, dim=0, dim_size=n_query)  # [Nq]
+        if pad_to_max:
+            n_pad = (n_kv.max() - n_kv).unsqueeze(-1)  # [Nq, 1]
+            pad_score = (query * self.key_proj.bias.view(n_heads, head_dim)).sum(-1) * self.scale  # [Nq, num_heads]
+            seg_max = torch.where(n_kv.unsqueeze(-1) > 0, seg_max, pad_score)  # segments with only padding
+            seg_max = torch.where(n_pad > 0, torch.maximum(seg_max, pad_score), seg_max)
+        seg_max = seg_max.detach()  # only for numerical stability
+
+        exp_scores = torch.exp(scores - seg_max[kv_segment])
+        denom = scatter_sum(exp_scores, kv_segment, dim=0, dim_size=n_query)  # [Nq, num_heads]
+        if pad_to_max:
+            exp_pad = n_pad * torch.exp(pad_score - seg_max)
+            denom = denom + exp_pad
+        denom = denom.clamp(min=torch.finfo(denom.dtype).tiny)
+
+        attn_weights = self.dropout(exp_scores / denom[kv_segment])
+        attn_output = scatter_sum(attn_weights.unsqueeze(-1) * value, kv_segment, dim=0, dim_size=n_query)  # [Nq, num_heads, head_dim]
+        if pad_to_max:
+            pad_weights = self.dropout(exp_pad / denom)
+            attn_output = attn_output + pad_weights.unsqueeze(-1) * self.value_proj.bias.view(n_heads, head_dim)
+
+        output = self.output_proj(attn_output.view(n_query, self.dim_out))
+        output = self.dropout(output)
+
+        return output
     
 class CrossAttentionWithSpatialEncoding(nn.Module):
     def __init__(self, dim_query, dim_kv, dim_out, num_heads, dropout):
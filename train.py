@@ -11,12 +11,14 @@ from utils.logger import print_log
 from utils.random_seed import setup_seed, SEED
 from data.dataset import (
     PDBBindBenchmark, MixDatasetWrapper, DynamicBatchWrapper,
-    BalancedDynamicBatchWrapper, PretrainBalancedDynamicBatchWrapper,
+    BalancedDynamicBatchWrapper, PretrainBalancedDynamicBatchWrapper, BucketedDynamicBatchWrapper,
     LabelledPDBDataset, MultiClassLabelledPDBDataset,
-    ProtInterfaceDataset
+    ProtInterfaceDataset, CollateBuffers, BufferedCollate
 )
 from data.distributed_sampler import DistributedSamplerResume
 import models
+from models.pretrain_model import PrecomputeEdgesCollate
+from models.edge_cache import with_edge_cache
 import trainers
 from utils.nn_utils import count_parameters
 from data.pdb_utils import VOCAB
@@ -37,6 +39,9 @@ def parse():
     parser.add_argument('--valid_set2', type=str, default=None, help='path to another valid set if task is PretrainMix')
     parser.add_argument('--train_set3', type=str, default=None, help='path to the third train set')
     parser.add_argument('--valid_set3', type=str, default=None, help='path to the third valid set')
+    parser.add_argument('--streaming', action='store_true', default=False, help='stream the train sets from their shards instead of loading them, for pretraining tasks. A train set path may then be a data file, a directory of data files or a glob pattern')
+    parser.add_argument('--shuffle_buffer', type=int, default=1000, help='number of items per worker in the shuffle buffer of streaming')
+    parser.add_argument('--stream_num_items', type=int, default=None, help='number of items per epoch when streaming, default to the number of items in the shards')
 
     # training related
     parser.add_argument('--lr', type=float, default=1e-3, help='learning rate')
@@ -54,10 +59,14 @@ def parse():
     parser.add_argument('--max_n_vertex_per_item', type=int, default=None, help='if max_n_vertex_per_gpu is specified, larger items will be randomly cropped')
     parser.add_argument('--valid_max_n_vertex_per_gpu', type=int, default=None, help='form batch with dynamic size constrained by the total number of vertexes')
     parser.add_argument('--balanced_sampler', action='store_true', default=False, help='use balanced sampler')
+    parser.add_argument('--bucketed_sampler', action='store_true', default=False, help='form dynamic batches of items with similar sizes, constrained by the number of vertexes and estimated edges')
+    parser.add_argument('--max_n_edge_per_gpu', type=int, default=None, help='edge budget of a batch for the bucketed sampler, default to max_n_vertex_per_gpu times the median number of edges per vertex')
     parser.add_argument('--patience', type=int, default=-1, help='patience before early stopping')
     parser.add_argument('--save_topk', type=int, default=-1, help='save topk checkpoint. -1 for saving all ckpt that has a better validation metric than its previous epoch')
     parser.add_argument('--shuffle', action='store_true', help='shuffle data')
     parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--pin_memory', action='store_true', default=False, help='collate training batches into pinned memory, reusing the buffers if num_workers is 0')
+    parser.add_argument('--collate_edges', action='store_true', default=False, help='build the graph edges in the collate step (inside the DataLoader workers) instead of the forward of the model')
     parser.add_argument('--seed', type=int, default=SEED)
     parser.add_argument('--cycle_steps', type=int, default=100000, help='number of steps per cycle in lr_scheduler.CosineAnnealingWarmRestarts')
 
@@ -75,6 +84,8 @@ def parse():
     parser.add_argument('--bottom_global_message_passing', action="store_true", default=False, help='message passing between global nodes and normal nodes at the bottom level')
     parser.add_argument('--global_message_passing', action="store_true", default=False, help='message passing between global nodes and normal nodes at the top level')
     parser.add_argument('--fragmentation_method', type=str, default=None, choices=['PS_300'], help='fragmentation method for small molecules')
+    parser.add_argument('--factorize_edge_features', action='store_true', default=False, help='apply the node part of the edge MLPs once per node instead of once per edge (same parameters, saves memory at large k_neighbors)')
+    parser.add_argument('--variable_length_pooling', action='store_true', default=False, help='attention pooling within each graph instead of padding all graphs of a batch to the largest one (same parameters, for batches of very different sizes)')
 
     # for pretraining
     parser.add_argument('--atom_noise', type=float, default=0, help='apply noise to atom coordinates')
@@ -82,6 +93,7 @@ def parse():
     parser.add_argument('--rotation_noise', type=float, default=0, help='apply global rotation noise')
     parser.add_argument('--torsion_noise', type=float, default=0, help='max torsion rotation noise')
     parser.add_argument('--max_rotation', type=float, default=np.pi/4, help='max global rotation angle')
+    parser.add_argument('--batch_noise', action='store_true', default=False, help='apply the noise to the collated batches on the device instead of per item in the DataLoader workers')
     parser.add_argument('--tr_weight', type=float, default=1.0, help='Weight of translation loss')
     parser.add_argument('--rot_weight', type=float, default=1.0, help='Weight of rotation loss')
     parser.add_argument('--tor_weight', type=float, default=1.0, help='Weight of torsional loss')
@@ -229,6 +241,31 @@ def create_dataset(task, path, path2=None, path3=None, fragment=None):
     return dataset
 
 
+def create_streaming_dataset(task, paths, args):
+    from data.dataset_pretrain import PretrainTorsionDataset, PretrainMaskedTorsionDataset, PretrainAtomDataset
+    from data.streaming import StreamingDataset
+    if task == 'pretrain_torsion':
+        dataset_cls, dataset_args = PretrainTorsionDataset, {}
+    elif task == 'pretrain_torsion_masking':
+        dataset_cls = PretrainMaskedTorsionDataset
+        dataset_args = {
+            "mask_proportion": 0,
+            "mask_token": VOCAB.symbol_to_idx(VOCAB.MASK),
+            "vocab_to_mask": [VOCAB.symbol_to_idx(x[0]) for x in VOCAB.aas + VOCAB.bases + VOCAB.sms + VOCAB.frags],
+            "atom_mask_token": VOCAB.get_atom_mask_idx(),
+        }
+    elif task == 'pretrain_gaussian':
+        dataset_cls, dataset_args = PretrainAtomDataset, {}
+    else:
+        raise NotImplementedError(f'Streaming dataset for {task} not implemented!')
+    # the datasets hold no items, they only transform the streamed ones
+    sources = [(set_noise(dataset_cls(None, **dataset_args), args), path) for path in paths if path is not None]
+    dataset = StreamingDataset(sources, shuffle=args.shuffle, shuffle_buffer=args.shuffle_buffer,
+                               seed=args.seed, num_items=args.stream_num_items)
+    print_log(f'Streaming {len(dataset.shards)} shards, {dataset.num_items} items per epoch')
+    return dataset
+
+
 def set_noise(dataset, args):
     from data.dataset_pretrain import PretrainAtomDataset, PretrainTorsionDataset, PretrainMaskedDataset, PretrainMaskedTorsionDataset
     if type(dataset) in [PretrainAtomDataset, PretrainTorsionDataset, PretrainMaskedTorsionDataset]:
@@ -246,6 +283,8 @@ def set_noise(dataset, args):
             dataset.set_torsion_noise(args.torsion_noise)
         if type(dataset) == PretrainMaskedTorsionDataset:
             dataset.mask_proportion = args.mask_proportion
+        if args.batch_noise:
+            dataset.set_batch_noise()
     elif type(dataset) == PretrainMaskedDataset:
         dataset.mask_proportion = args.mask_proportion
     elif type(dataset) == MixDatasetWrapper:
@@ -257,7 +296,7 @@ def set_noise(dataset, args):
     return dataset
 
 
-def create_trainer(model, train_loader, valid_loader, config, resume_state=None):
+def create_trainer(model, train_loader, valid_loader, config, resume_state=None, batch_noise=None):
     model_type = type(model)
     if model_type in [models.AffinityPredictor, models.RegressionPredictor]:
         trainer = trainers.AffinityTrainer(model, train_loader, valid_loader, config)
@@ -270,16 +309,19 @@ def create_trainer(model, train_loader, valid_loader, config, resume_state=None)
             trainer = trainers.PretrainMaskingNoisingTrainer(
                 model, train_loader, valid_loader, config, 
                 resume_state=resume_state,  
+                batch_noise=batch_noise,
             )
         else:
             trainer = trainers.PretrainTrainer(
                 model, train_loader, valid_loader, config, 
                 resume_state=resume_state,
+                batch_noise=batch_noise,
             )
     elif model_type == models.DenoisePretrainModelWithBlockEmbedding:
         trainer = trainers.PretrainMaskingNoisingTrainerWithBlockEmbedding(
             model, train_loader, valid_loader, config, 
             resume_state=resume_state,
+            batch_noise=batch_noise,
         )
     elif model_type == models.MaskedNodeModel:
         trainer = trainers.MaskingTrainer(model, train_loader, valid_loader, config)
@@ -305,9 +347,14 @@ def main(args):
         train_task = 'PLA_noisy_nodes_train'
     else:
         train_task = args.task
-    train_set = create_dataset(train_task, args.train_set, args.train_set2, args.train_set3, args.fragmentation_method)
-    if args.task in {'pretrain_torsion', 'pretrain_gaussian', 'masking', 'PLA_noisy_nodes', 'pretrain_torsion_masking'}:
-        train_set = set_noise(train_set, args)
+    if args.streaming:
+        if args.max_n_vertex_per_gpu is not None:
+            raise NotImplementedError('Dynamic batches are not supported with streaming')
+        train_set = create_streaming_dataset(train_task, [args.train_set, args.train_set2, args.train_set3], args)
+    else:
+        train_set = create_dataset(train_task, args.train_set, args.train_set2, args.train_set3, args.fragmentation_method)
+        if args.task in {'pretrain_torsion', 'pretrain_gaussian', 'masking', 'PLA_noisy_nodes', 'pretrain_torsion_masking'}:
+            train_set = set_noise(train_set, args)
     if args.valid_set is not None:
         valid_set = create_dataset(args.task, args.valid_set, args.valid_set2, args.valid_set3, fragment=args.fragmentation_method)
         if args.task in {'pretrain_torsion', 'pretrain_gaussian', 'masking', 'pretrain_torsion_masking'}:
@@ -316,18 +363,28 @@ def main(args):
     else:
         valid_set = None
         print_log(f'Train: {len(train_set)}, no validation')
+    if args.task in {'binary_classifier', 'regression', 'multiclass_classifier', 'PDBBind'}:
+        # fixed coordinates, edges are read from the edge stores of the data files if they match the model
+        train_set = with_edge_cache(train_set, model)
+        if valid_set is not None:
+            valid_set = with_edge_cache(valid_set, model)
     if args.max_n_vertex_per_gpu is not None:
         if args.valid_max_n_vertex_per_gpu is None:
             args.valid_max_n_vertex_per_gpu = args.max_n_vertex_per_gpu
-        if args.balanced_sampler:
+        if args.bucketed_sampler:
+            if args.balanced_sampler:
+                raise NotImplementedError('The bucketed sampler cannot be combined with the balanced sampler')
+            train_set = BucketedDynamicBatchWrapper(train_set, args.max_n_vertex_per_gpu, args.max_n_vertex_per_item, shuffle=args.shuffle, k_neighbors=args.k_neighbors,
+                                                    max_n_edge_per_batch=args.max_n_edge_per_gpu)
+        elif args.balanced_sampler:
             if args.task in {'pretrain_torsion', 'pretrain_gaussian', 'masking', 'pretrain_torsion_masking'}:
-                train_set = PretrainBalancedDynamicBatchWrapper(train_set, args.max_n_vertex_per_gpu, args.max_n_vertex_per_item, shuffle=args.shuffle)
+                train_set = PretrainBalancedDynamicBatchWrapper(train_set, args.max_n_vertex_per_gpu, args.max_n_vertex_per_item, shuffle=args.shuffle, k_neighbors=args.k_neighbors)
             else:
-                train_set = BalancedDynamicBatchWrapper(train_set, args.max_n_vertex_per_gpu, args.max_n_vertex_per_item, shuffle=args.shuffle)
+                train_set = BalancedDynamicBatchWrapper(train_set, args.max_n_vertex_per_gpu, args.max_n_vertex_per_item, shuffle=args.shuffle, k_neighbors=args.k_neighbors)
         else:
-            train_set = DynamicBatchWrapper(train_set, args.max_n_vertex_per_gpu, args.max_n_vertex_per_item, shuffle=args.shuffle)
+            train_set = DynamicBatchWrapper(train_set, args.max_n_vertex_per_gpu, args.max_n_vertex_per_item, shuffle=args.shuffle, k_neighbors=args.k_neighbors)
         if valid_set is not None:
-            valid_set = DynamicBatchWrapper(valid_set, args.valid_max_n_vertex_per_gpu, args.max_n_vertex_per_item, shuffle=False)
+            valid_set = DynamicBatchWrapper(valid_set, args.valid_max_n_vertex_per_gpu, args.max_n_vertex_per_item, shuffle=False, k_neighbors=args.k_neighbors)
         args.batch_size, args.valid_batch_size = 1, 1
         args.num_workers = 1
 
@@ -352,7 +409,8 @@ def main(args):
         args.local_rank = int(os.environ['LOCAL_RANK'])
         torch.cuda.set_device(args.local_rank)
         torch.distributed.init_process_group(backend='nccl', world_size=len(args.gpus))
-        train_sampler = DistributedSamplerResume(train_set, shuffle=args.shuffle, seed=args.seed)
+        # streaming datasets shard across ranks by themselves
+        train_sampler = None if args.streaming else DistributedSamplerResume(train_set, shuffle=args.shuffle, seed=args.seed)
         if args.max_n_vertex_per_gpu is None:
             args.batch_size = int(args.batch_size / len(args.gpus))
         if args.local_rank == 0:
@@ -360,6 +418,8 @@ def main(args):
     else:
         args.local_rank = -1
         train_sampler = None
+    if args.streaming:
+        train_set.batch_size = args.batch_size
 
     if args.local_rank <= 0:
         if args.max_n_vertex_per_gpu is not None:
@@ -368,21 +428,41 @@ def main(args):
             print_log(f'Loaded pretrained checkpoint from {args.pretrain_ckpt}')
         print_log(f'Number of parameters: {count_parameters(model) / 1e6} M')
     
+    train_collate_fn = train_set.collate_fn
+    valid_collate_fn = None if valid_set is None else valid_set.collate_fn
+    batch_noise = None
+    if args.batch_noise:
+        from utils.noise_transforms import BatchNoiseTransform
+        if args.collate_edges:
+            raise ValueError('Edges cannot be built in the collate step if the noise is applied after it (--batch_noise)')
+        batch_noise = BatchNoiseTransform(
+            tor_sigma=args.torsion_noise or None, atom_sigma=args.atom_noise or None,
+            tr_sigma=args.translation_noise or None, rot_sigma=args.rotation_noise or None, max_theta=args.max_rotation)
+    if args.collate_edges:
+        if isinstance(model, models.ProteinInterfaceModel):
+            raise NotImplementedError('Building edges in the collate step is not supported for ProteinInterfaceModel')
+        train_collate_fn = PrecomputeEdgesCollate(train_collate_fn, model)
+        if valid_set is not None:
+            valid_collate_fn = PrecomputeEdgesCollate(valid_collate_fn, model)
+    if args.pin_memory and args.num_workers == 0:
+        train_collate_fn = BufferedCollate(train_collate_fn, CollateBuffers())
     train_loader = DataLoader(train_set, batch_size=args.batch_size,
                               num_workers=args.num_workers,
-                              shuffle=(args.shuffle and train_sampler is None),
+                              shuffle=(args.shuffle and train_sampler is None and not args.streaming),
                               sampler=train_sampler,
-                              collate_fn=train_set.collate_fn,
+                              collate_fn=train_collate_fn,
+                              pin_memory=(args.pin_memory and args.num_workers > 0),
                               worker_init_fn=lambda x: np.random.seed(args.seed + x))
     if valid_set is not None:
         valid_loader = DataLoader(valid_set, batch_size=args.valid_batch_size,
                                   num_workers=args.num_workers,
-                                  collate_fn=valid_set.collate_fn,
+                                  collate_fn=valid_collate_fn,
                                   shuffle=False)
     else:
         valid_loader = None
     trainer = create_trainer(model, train_loader, valid_loader, config, 
-                             resume_state=torch.load(args.pretrain_state) if args.pretrain_state else None)
+                             resume_state=torch.load(args.pretrain_state) if args.pretrain_state else None,
+                             batch_noise=batch_noise)
     if args.local_rank <= 0: # only log on the main process
         print_log(f"Saving model checkpoints to: {config.save_dir}")
         os.makedirs(config.save_dir, exist_ok=True)
@@ -107,6 +107,8 @@ class Trainer:
         elif isinstance(data, list) or isinstance(data, tuple):
             res = [cls.to_device(item, device) for item in data]
             data = type(data)(res)
+        elif isinstance(data, torch.Tensor):
+            data = data.to(device, non_blocking=True)  # asynchronous from pinned memory
         elif hasattr(data, 'to'):
             data = data.to(device)
         return data
@@ -125,11 +127,20 @@ class Trainer:
 
     def _before_train_epoch_start(self):
         return
+
+    def _epoch_sampler(self):
+        # the object whose set_epoch reshuffles the training data, None if there is none
+        if isinstance(self.train_loader.dataset, torch.utils.data.IterableDataset):
+            return self.train_loader.dataset  # streaming datasets shuffle and shard themselves
+        if self.train_loader.sampler is not None and self.local_rank != -1:  # distributed
+            return self.train_loader.sampler
+        return None
     
     def _train_epoch(self, device):
         self._before_train_epoch_start()
-        if self.train_loader.sampler is not None and self.local_rank != -1:  # distributed
-            self.train_loader.sampler.set_epoch(self.epoch)
+        sampler = self._epoch_sampler()
+        if sampler is not None:
+            sampler.set_epoch(self.epoch)
         t_iter = tqdm(self.train_loader) if self._is_main_proc() else self.train_loader
         for batch in t_iter:
             try:
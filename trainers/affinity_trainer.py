@@ -59,6 +59,7 @@ class AffinityTrainer(Trainer):
             block_embeddings=batch.get('block_embeddings', None),
             block_embeddings0=batch.get('block_embeddings0', None),
             block_embeddings1=batch.get('block_embeddings1', None),
+            precomputed_edges=batch.get('precomputed_edges', None),
         )
 
         log_type = 'Validation' if val else 'Train'
@@ -189,6 +190,7 @@ class ClassifierTrainer(Trainer):
             block_embeddings=batch.get('block_embeddings', None),
             block_embeddings0=batch.get('block_embeddings0', None),
             block_embeddings1=batch.get('block_embeddings1', None),
+            precomputed_edges=batch.get('precomputed_edges', None),
         )
 
         log_type = 'Validation' if val else 'Train'
@@ -325,6 +327,7 @@ class MultiClassClassifierTrainer(Trainer):
             block_embeddings=batch.get('block_embeddings', None),
             block_embeddings0=batch.get('block_embeddings0', None),
             block_embeddings1=batch.get('block_embeddings1', None),
+            precomputed_edges=batch.get('precomputed_edges', None),
         )
 
         log_type = 'Validation' if val else 'Train'
@@ -68,6 +68,7 @@ class MaskingTrainer(Trainer):
                 segment_ids=batch['segment_ids'],
                 masked_blocks=batch['masked_blocks'],
                 masked_labels=batch['masked_labels'],
+                precomputed_edges=batch.get('precomputed_edges', None),
             )
 
             if not val:
@@ -93,13 +94,14 @@ class MaskingTrainer(Trainer):
 
     def _train_epoch(self, device):
         self._before_train_epoch_start()
-        if self.train_loader.sampler is not None and self.local_rank != -1:  # distributed
+        sampler = self._epoch_sampler()
+        if sampler is not None:
             if self.resume_index > 0:
-                self.train_loader.sampler.set_epoch(epoch=self.epoch, resume_index=self.resume_index)
+                sampler.set_epoch(epoch=self.epoch, resume_index=self.resume_index)
                 print_log(f"Resume training from epoch {self.epoch}, global step {self.global_step}")
                 self.resume_index = 0
             else:
-                self.train_loader.sampler.set_epoch(self.epoch)
+                sampler.set_epoch(self.epoch)
         t_iter = tqdm(enumerate(self.train_loader)) if self._is_main_proc() else enumerate(self.train_loader)
         metric_dict = defaultdict(list)
         print(f"NUMBATCHES = {len(self.train_loader)}")
@@ -11,9 +11,10 @@ import json
 
 class PretrainTrainer(Trainer):
 
-    def __init__(self, model, train_loader, valid_loader, config, resume_state=None):
+    def __init__(self, model, train_loader, valid_loader, config, resume_state=None, batch_noise=None):
         self.global_step = 0
         self.epoch = 0
+        self.batch_noise = batch_noise  # BatchNoiseTransform for datasets returning clean items
         self.max_step = config.max_epoch * config.step_per_epoch
         super().__init__(model, train_loader, valid_loader, config)
         self.training_state_dir = os.path.join(self.config.save_dir, 'training_state')
@@ -49,14 +50,18 @@ class PretrainTrainer(Trainer):
         return (self.global_step + 1) * 1.0 / self.config.warmup
 
     def train_step(self, batch, batch_idx):
+        if self.batch_noise is not None:
+            batch = self.batch_noise(batch)
         return self.share_step(batch, batch_idx, val=False)
 
     def valid_step(self, batch, batch_idx):
+        if self.batch_noise is not None:
+            batch = self.batch_noise(batch)
         return self.share_step(batch, batch_idx, val=True)
 
     def _before_train_epoch_start(self):
         # reform batch, with new random batches
-        if type(self.train_loader.dataset).__name__ in ['DynamicBatchWrapper', 'PretrainBalancedDynamicBatchWrapper']:
+        if type(self.train_loader.dataset).__name__ in ['DynamicBatchWrapper', 'PretrainBalancedDynamicBatchWrapper', 'BucketedDynamicBatchWrapper']:
             self.train_loader.dataset._form_batch()
         return super()._before_train_epoch_start()
 
@@ -78,6 +83,7 @@ class PretrainTrainer(Trainer):
                 tor_edges=batch['tor_edges'],
                 tor_batch=batch['tor_batch'],
                 modality=batch['modality'],
+                precomputed_edges=batch.get('precomputed_edges', None),
             )
 
             if not val:
@@ -103,13 +109,14 @@ class PretrainTrainer(Trainer):
 
     def _train_epoch(self, device):
         self._before_train_epoch_start()
-        if self.train_loader.sampler is not None and self.local_rank != -1:  # distributed
+        sampler = self._epoch_sampler()
+        if sampler is not None:
             if self.resume_index > 0:
-                self.train_loader.sampler.set_epoch(epoch=self.epoch, resume_index=self.resume_index)
+                sampler.set_epoch(epoch=self.epoch, resume_index=self.resume_index)
                 print_log(f"Resume training from epoch {self.epoch}, global step {self.global_step}")
                 self.resume_index = 0
             else:
-                self.train_loader.sampler.set_epoch(self.epoch)
+                sampler.set_epoch(self.epoch)
         t_iter = tqdm(enumerate(self.train_loader), total=len(self.train_loader), desc=f"Train epoch {self.epoch}") if self._is_main_proc() else enumerate(self.train_loader)
         metric_dict = defaultdict(list)
         print(f"NUMBATCHES = {len(self.train_loader)}")
@@ -274,8 +281,8 @@ class PretrainTrainer(Trainer):
 
 class PretrainMaskingNoisingTrainer(PretrainTrainer):
 
-    def __init__(self, model, train_loader, valid_loader, config, resume_state=None):
-        super().__init__(model, train_loader, valid_loader, config, resume_state)              
+    def __init__(self, model, train_loader, valid_loader, config, resume_state=None, batch_noise=None):
+        super().__init__(model, train_loader, valid_loader, config, resume_state, batch_noise)              
 
     def share_step(self, batch, batch_idx, val=False):
         try:
@@ -296,6 +303,7 @@ class PretrainMaskingNoisingTrainer(PretrainTrainer):
                 masked_blocks=batch['masked_blocks'], 
                 masked_labels=batch['masked_labels'],
                 modality=batch['modality'],
+                precomputed_edges=batch.get('precomputed_edges', None),
             )
 
             if not val:
@@ -321,13 +329,14 @@ class PretrainMaskingNoisingTrainer(PretrainTrainer):
 
     def _train_epoch(self, device):
         self._before_train_epoch_start()
-        if self.train_loader.sampler is not None and self.local_rank != -1:  # distributed
+        sampler = self._epoch_sampler()
+        if sampler is not None:
             if self.resume_index > 0:
-                self.train_loader.sampler.set_epoch(epoch=self.epoch, resume_index=self.resume_index)
+                sampler.set_epoch(epoch=self.epoch, resume_index=self.resume_index)
                 print_log(f"Resume training from epoch {self.epoch}, global step {self.global_step}")
                 self.resume_index = 0
             else:
-                self.train_loader.sampler.set_epoch(self.epoch)
+                sampler.set_epoch(self.epoch)
         t_iter = tqdm(enumerate(self.train_loader), total=len(self.train_loader), desc=f"Train epoch {self.epoch}") if self._is_main_proc() else enumerate(self.train_loader)
         metric_dict = defaultdict(list)
         print(f"NUMBATCHES = {len(self.train_loader)}")
@@ -488,8 +497,8 @@ class PretrainMaskingNoisingTrainer(PretrainTrainer):
 
 
 class PretrainMaskingNoisingTrainerWithBlockEmbedding(PretrainMaskingNoisingTrainer):
-    def __init__(self, model, train_loader, valid_loader, config, resume_state=None):
-        super().__init__(model, train_loader, valid_loader, config, resume_state)
+    def __init__(self, model, train_loader, valid_loader, config, resume_state=None, batch_noise=None):
+        super().__init__(model, train_loader, valid_loader, config, resume_state, batch_noise)
     
     def share_step(self, batch, batch_idx, val=False):
         try:
@@ -513,6 +522,7 @@ class PretrainMaskingNoisingTrainerWithBlockEmbedding(PretrainMaskingNoisingTrai
                 block_embeddings=batch.get('block_embeddings', None),
                 block_embeddings0=batch.get('block_embeddings0', None),
                 block_embeddings1=batch.get('block_embeddings1', None),
+                precomputed_edges=batch.get('precomputed_edges', None),
             )
 
             if not val:
@@ -1,43 +1,161 @@
 import torch
 import numpy as np
 import copy
-from scipy.spatial import distance
+from scipy.spatial import cKDTree
 from scipy.spatial.transform import Rotation
 import math
+from functools import lru_cache
 from torch.nn import functional as F
-from .torus import score as torus_score
-from data.dataset import data_to_blocks, blocks_to_data, VOCAB
-from data.torsion import get_side_chain_torsion_mask_block, get_segment_torsion_mask
+from torch_scatter import scatter_mean, scatter_sum
+from .torus import score as torus_score, score_torch as torus_score_torch, tables as torus_tables
+from data.dataset import data_to_blocks
+from data.pdb_utils import VOCAB
+from data.torsion import STANDARD_RESIDUES, get_packed_torsion_mask, pack_torsion_mask, crop_torsion_mask
+
+
+def _rodrigues(axis, angle):
+    '''rotation matrices [n, 3, 3] about unit axes [n, 3] by angles [n] (radians)'''
+    K = np.zeros((len(axis), 3, 3))
+    K[:, 0, 1], K[:, 0, 2], K[:, 1, 2] = -axis[:, 2], axis[:, 1], -axis[:, 0]
+    K = K - K.transpose(0, 2, 1)
+    sin, cos = np.sin(angle)[:, None, None], np.cos(angle)[:, None, None]
+    return np.eye(3) + sin * K + (1 - cos) * K @ K
+
+
+def _rodrigues_torch(axis, angle):
+    K = torch.zeros(len(axis), 3, 3, dtype=axis.dtype, device=axis.device)
+    K[:, 0, 1], K[:, 0, 2], K[:, 1, 2] = -axis[:, 2], axis[:, 1], -axis[:, 0]
+    K = K - K.transpose(1, 2)
+    sin, cos = torch.sin(angle)[:, None, None], torch.cos(angle)[:, None, None]
+    return torch.eye(3, dtype=axis.dtype, device=axis.device) + sin * K + (1 - cos) * K @ K
+
+
+def _torsion_steps(n_edges, n_atoms, rotated_edge, rotated_atom):
+    '''
+    order of the (edge, atom) pairs of the rotated parts. The rotated parts of the rotatable edges of a tree are
+    nested or disjoint, so the rotations can be built from the input coordinates and applied to each atom from its
+    innermost (smallest) rotated part outwards, which gives the same conformer as rotating about the edges one after
+    another with the axes moved by the previous rotations. Returns the pair indexes sorted by atom and size of the
+    rotated part, and the step (rank within the atom) of each of them.
+    '''
+    part_size = np.bincount(rotated_edge, minlength=n_edges)
+    order = np.lexsort((part_size[rotated_edge], rotated_atom))
+    atom = rotated_atom[order]
+    first = np.searchsorted(atom, np.arange(n_atoms))
+    return order, np.arange(len(order)) - first[atom]
+
+
+def _check_rotated_sides(edges, u_rotated, v_rotated):
+    invalid = u_rotated == v_rotated
+    if invalid.any():
+        raise ValueError(f"Invalid edge {edges[np.argmax(invalid)].tolist()} for rotation, check mask rotate.")
+
+
+def apply_torsion_updates(coords, edges, rotated_edge, rotated_atom, torsion_updates):
+    '''
+    Rotates the atoms on the rotated side of each rotatable edge about the edge by its torsion update (radians).
+    Args:
+        coords: [n_atoms, 3]
+        edges: [n_edges, 2] rotatable edges, exactly one of their atoms is on the rotated side
+        rotated_edge, rotated_atom: [n_pairs], atom rotated_atom[i] is on the rotated side of edge rotated_edge[i]
+            (the nonzero entries of the mask_rotate of modify_conformer_torsion_angles). Edges of several
+            conformers (e.g. the side chains of all blocks) can be given at once, with atom indexes into coords.
+        torsion_updates: [n_edges]
+    Returns:
+        new coordinates [n_atoms, 3]
+    '''
+    coords = np.array(coords, dtype=float)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    rotated_edge, rotated_atom = np.asarray(rotated_edge, dtype=np.int64), np.asarray(rotated_atom, dtype=np.int64)
+    if len(edges) == 0:
+        return coords
+    keys = rotated_edge * len(coords) + rotated_atom
+    u_rotated = np.isin(np.arange(len(edges)) * len(coords) + edges[:, 0], keys)
+    v_rotated = np.isin(np.arange(len(edges)) * len(coords) + edges[:, 1], keys)
+    _check_rotated_sides(edges, u_rotated, v_rotated)
+
+    # all rotations at once, about the axis from the rotated to the fixed atom (positive rotation if pointing inwards)
+    rotated, fixed = np.where(v_rotated, edges[:, 1], edges[:, 0]), np.where(v_rotated, edges[:, 0], edges[:, 1])
+    axis = coords[fixed] - coords[rotated]
+    axis = axis / np.linalg.norm(axis, axis=-1, keepdims=True)
+    rot_mats = _rodrigues(axis, np.asarray(torsion_updates, dtype=float))
+    pivots = coords[rotated]
+
+    order, step = _torsion_steps(len(edges), len(coords), rotated_edge, rotated_atom)
+    for s in range(step.max() + 1 if len(step) else 0):
+        pairs = order[step == s]  # each atom at most once
+        e, a = rotated_edge[pairs], rotated_atom[pairs]
+        coords[a] = np.einsum('nij,nj->ni', rot_mats[e], coords[a] - pivots[e]) + pivots[e]
+    return coords
+
+
+def apply_torsion_updates_torch(coords, edges, rotated_edge, rotated_atom, torsion_updates):
+    '''torch implementation of apply_torsion_updates, on the device of coords'''
+    edges = edges.reshape(-1, 2)
+    if len(edges) == 0:
+        return coords.clone()
+    n_atoms, device = coords.shape[0], coords.device
+    keys = rotated_edge * n_atoms + rotated_atom
+    edge_idx = torch.arange(len(edges), device=device)
+    u_rotated = torch.isin(edge_idx * n_atoms + edges[:, 0], keys)
+    v_rotated = torch.isin(edge_idx * n_atoms + edges[:, 1], keys)
+    _check_rotated_sides(edges.cpu().numpy(), u_rotated.cpu().numpy(), v_rotated.cpu().numpy())
+
+    rotated, fixed = torch.where(v_rotated, edges[:, 1], edges[:, 0]), torch.where(v_rotated, edges[:, 0], edges[:, 1])
+    axis = coords[fixed] - coords[rotated]
+    axis = axis / torch.linalg.norm(axis, dim=-1, keepdim=True)
+    rot_mats = _rodrigues_torch(axis, torsion_updates.to(coords.dtype))
+    pivots = coords[rotated]
+
+    part_size = torch.bincount(rotated_edge, minlength=len(edges))
+    # sort by atom, then by size of the rotated part (see _torsion_steps)
+    order = torch.argsort(part_size[rotated_edge], stable=True)
+    order = order[torch.argsort(rotated_atom[order], stable=True)]
+    atom = rotated_atom[order]
+    first = torch.searchsorted(atom, torch.arange(n_atoms, device=device))
+    step = torch.arange(len(order), device=device) - first[atom]
+
+    coords = coords.clone()
+    for s in range(int(step.max()) + 1 if len(step) else 0):
+        pairs = order[step == s]
+        e, a = rotated_edge[pairs], rotated_atom[pairs]
+        coords[a] = torch.einsum('nij,nj->ni', rot_mats[e], coords[a] - pivots[e]) + pivots[e]
+    return coords
 
 
 def modify_conformer_torsion_angles(coords, rotateable_edges, mask_rotate, torsion_updates):
-    coords = copy.deepcopy(coords)
-    if type(coords) == torch.Tensor: 
+    '''
+    Args:
+        coords: [n_atoms, 3]
+        rotateable_edges: [n_edges, 2]
+        mask_rotate: [n_edges, n_atoms], True if the atom is part of the part that gets rotated
+        torsion_updates: [n_edges], radians
+    Returns:
+        new coordinates [n_atoms, 3] as a numpy array (see apply_torsion_updates)
+    '''
+    if type(coords) == torch.Tensor:
         coords = coords.cpu().numpy()
-    elif type(coords) == list:
-        coords = np.array(coords)
-    
-    if type(mask_rotate) == list:
-        mask_rotate = np.array(mask_rotate)
-
-    for idx_edge, e in enumerate(rotateable_edges):
-        if torsion_updates[idx_edge] == 0:
-            continue
-        u, v = e[0], e[1]
-
-        # check if need to reverse the edge, v should be connected to the part that gets rotated
-        if int(mask_rotate[idx_edge, u]) == 0 and int(mask_rotate[idx_edge, v]) == 1:
-            rot_vec = coords[u] - coords[v]  # convention: positive rotation if pointing inwards
-        elif int(mask_rotate[idx_edge, u]) == 1 and int(mask_rotate[idx_edge, v]) == 0:
-            rot_vec = coords[v] - coords[u]
-        else:
-            raise ValueError(f"Invalid edge {e} for rotation, check mask rotate.")
-        rot_vec = rot_vec * torsion_updates[idx_edge] / np.linalg.norm(rot_vec) # idx_edge!
-        rot_mat = Rotation.from_rotvec(rot_vec).as_matrix()
-        
-        # mask_rotate[idx_edge][node_idx]=True, node is part of the part that gets rotated
-        coords[mask_rotate[idx_edge]] = (coords[mask_rotate[idx_edge]] - coords[v]) @ rot_mat.T + coords[v]
-    return coords
+    rotated_edge, rotated_atom = np.nonzero(np.asarray(mask_rotate, dtype=bool).reshape(len(rotateable_edges), -1))
+    return apply_torsion_updates(coords, rotateable_edges, rotated_edge, rotated_atom, torsion_updates)
+
+
+def rigid_transform_Kabsch_3D_torch(A, B, index, dim_size):
+    '''
+    rotations [dim_size, 3, 3] and translations [dim_size, 3] aligning the points A [n, 3] to the points B [n, 3]
+    of each group given by index [n], as rigid_transform_Kabsch_3D does for a single group
+    '''
+    centroid_A = scatter_mean(A, index, dim=0, dim_size=dim_size)
+    centroid_B = scatter_mean(B, index, dim=0, dim_size=dim_size)
+    Am, Bm = A - centroid_A[index], B - centroid_B[index]
+    H = scatter_sum(Am[:, :, None] * Bm[:, None, :], index, dim=0, dim_size=dim_size)
+    U, S, Vt = torch.linalg.svd(H)
+    R = Vt.transpose(1, 2) @ U.transpose(1, 2)
+    # special reflection case
+    SS = torch.ones(dim_size, 3, dtype=A.dtype, device=A.device)
+    SS[:, 2] = torch.where(torch.linalg.det(R) < 0, -1.0, 1.0)
+    R = (Vt.transpose(1, 2) * SS[:, None, :]) @ U.transpose(1, 2)
+    t = centroid_B - torch.einsum('nij,nj->ni', R, centroid_A)
+    return R, t
 
 
 def rigid_transform_Kabsch_3D(A, B):
@@ -81,61 +199,112 @@ class CropTransform:
         self.max_blocks = max_blocks
         self.fragmentation_method = fragmentation_method
         self.top_k = 5 # closest blocks to crop around
-        self.residues = set([x[0] for x in VOCAB.aas] + [x[0] for x in VOCAB.bases])
+        # block ids of standard residues come before the fragments, so they do not depend on the tokenizer
+        self.standard_residue_ids = np.array(sorted(VOCAB.symbol_to_idx(symbol) for symbol in STANDARD_RESIDUES))
 
     def __call__(self, data):
-        segment0, segment1 = data_to_blocks(data, self.fragmentation_method)
-        segment0_coords = np.array([block.coords for block in segment0])
-        segment1_coords = np.array([block.coords for block in segment1])
-        cross_segment_distances = distance.cdist(segment0_coords, segment1_coords, 'euclidean')
-        top_k_indices = np.argsort(cross_segment_distances, axis=None)[:self.top_k]
+        """
+        Crops the item to the max_blocks blocks closest to one of the top_k closest pairs of blocks of the two
+        segments, on the arrays of the item. Blocks keep their order, torsion masks are sliced (see crop_torsion_mask).
+        Returns:
+            cropped data, indexes of the kept (non-global) blocks in data
+        """
+        B, block_lengths = np.asarray(data['B']), np.asarray(data['block_lengths'])
+        segment_ids = np.asarray(data['segment_ids'])
+        X = np.asarray(data['X'], dtype=float)
+        block_starts = np.concatenate([[0], np.cumsum(block_lengths)[:-1]])
+        centers = np.add.reduceat(X, block_starts, axis=0) / block_lengths[:, None]
+        is_global = B == VOCAB.symbol_to_idx(VOCAB.GLB)
+        segment_blocks = [np.nonzero(~is_global & (segment_ids == segment))[0] for segment in [0, 1]]
+        segment_centers = [centers[blocks] for blocks in segment_blocks]
+
+        # the top_k closest pairs of blocks are among the top_k nearest neighbors of each block of segment 0
+        k = min(self.top_k, len(segment_blocks[1]))
+        pair_distances, nearest = cKDTree(segment_centers[1]).query(segment_centers[0], k=k)
+        pair_distances, nearest = pair_distances.reshape(-1), nearest.reshape(-1)
+        pair0 = np.repeat(np.arange(len(segment_blocks[0])), k)
+        top_k_indices = np.lexsort((nearest, pair0, pair_distances))[:self.top_k]
         # pick one of the closest k pairs of blocks as the center
-        segment0_center_index, segment1_center_index = np.unravel_index(np.random.choice(top_k_indices), cross_segment_distances.shape) 
+        pair = np.random.choice(top_k_indices)
+        segment_center_indices = [pair0[pair], nearest[pair]]
         # crop the segment to the center
-        segment0_distances = np.linalg.norm(segment0_coords - segment0_coords[segment0_center_index], axis=1)
-        segment1_distances = np.linalg.norm(segment1_coords - segment1_coords[segment1_center_index], axis=1)
-        keep_indices = np.argsort(np.concatenate([segment0_distances, segment1_distances]))[:self.max_blocks]
-        segment0_keep_indices = keep_indices[keep_indices < len(segment0)]
-        segment1_keep_indices = keep_indices[keep_indices >= len(segment0)] - len(segment0)
-        segment0_cropped = [segment0[i] for i in segment0_keep_indices]
-        segment1_cropped = [segment1[i] for i in segment1_keep_indices]
-        cropped_data = blocks_to_data(segment0_cropped, segment1_cropped)
-
-        kept_old_indices = np.concatenate([segment0_keep_indices+1, segment1_keep_indices+len(segment0)+2]).tolist()
-
-        # add back torsion mask
+        distances = [np.linalg.norm(coords - coords[center], axis=1) for coords, center in zip(segment_centers, segment_center_indices)]
+        keep_indices = np.argsort(np.concatenate(distances))[:self.max_blocks]
+        keep_indices = [
+            np.sort(keep_indices[keep_indices < len(segment_blocks[0])]),
+            np.sort(keep_indices[keep_indices >= len(segment_blocks[0])] - len(segment_blocks[0])),
+        ]
+        global_blocks = [np.argmax(segment_ids == segment) for segment in [0, 1]]
+        kept_old_indices = np.concatenate([blocks[keep] for blocks, keep in zip(segment_blocks, keep_indices)])
+        kept_blocks = np.concatenate([
+            [global_blocks[0]], segment_blocks[0][keep_indices[0]], [global_blocks[1]], segment_blocks[1][keep_indices[1]]])
+
+        # atoms of the kept blocks
+        lengths = block_lengths[kept_blocks]
+        first_atom = np.cumsum(lengths) - lengths
+        atom_index = np.repeat(block_starts[kept_blocks] - first_atom, lengths) + np.arange(lengths.sum())
+        cropped_data = {
+            'X': X[atom_index],
+            'B': B[kept_blocks],
+            'A': np.asarray(data['A'])[atom_index],
+            'atom_positions': np.asarray(data['atom_positions'])[atom_index],
+            'block_lengths': lengths,
+            'segment_ids': segment_ids[kept_blocks],
+        }
+        # update coordinates of the global nodes to the centers
+        global_atoms = first_atom[[0, len(keep_indices[0]) + 1]]
+        cropped_data['X'][global_atoms[0]] = cropped_data['X'][global_atoms[0] + 1:global_atoms[1]].mean(axis=0)
+        cropped_data['X'][global_atoms[1]] = cropped_data['X'][global_atoms[1] + 1:].mean(axis=0)
+
+        # slice the torsion masks
         if 'torsion_mask' in data:
-            list_of_masks = []
-            for blocks in [segment0_cropped, segment1_cropped]:
-                block_ids = set([block.symbol for block in blocks])
-                rot_sidechains = len(block_ids.intersection(self.residues)) > 0
-                if rot_sidechains:
-                    # protein or nucleic acid
-                    edges, mask_rotate = get_side_chain_torsion_mask_block(blocks)
-                else:
-                    edges, mask_rotate = get_segment_torsion_mask(blocks)
-                list_of_masks.append({
-                    "type": 0 if rot_sidechains else 1,
-                    "edges": edges,
-                    "mask_rotate": mask_rotate,
-                })
-            cropped_data["torsion_mask"] = list_of_masks
+            cropped_data['torsion_mask'] = []
+            for segment, keep in enumerate(keep_indices):
+                segment_block_lengths = block_lengths[segment_blocks[segment]]
+                rot_sidechains = np.isin(B[segment_blocks[segment][keep]], self.standard_residue_ids).any()
+                torsion_mask = crop_torsion_mask(data['torsion_mask'][segment], segment_block_lengths, keep)
+                if torsion_mask is None or torsion_mask['type'] != (0 if rot_sidechains else 1):
+                    # bonds between blocks were cut, or the kind of the segment changed
+                    blocks = data_to_blocks(cropped_data, self.fragmentation_method)[segment]
+                    torsion_mask = get_packed_torsion_mask(blocks)
+                cropped_data['torsion_mask'].append(torsion_mask)
         if 'modality' in data:
             cropped_data['modality'] = data['modality']
             
         if 'block_embeddings' in data:
-            kept_blocks = sorted([0, len(segment0)+1] + kept_old_indices) # [0, len(segment0)+1] for the global blocks
-            cropped_data['block_embeddings'] = [data['block_embeddings'][i] for i in kept_blocks]
+            cropped_data['block_embeddings'] = np.asarray(data['block_embeddings'])[kept_blocks]
         elif 'block_embeddings0' in data and 'block_embeddings1' in data:
-            kept_blocks0 = [0] + (segment0_keep_indices+1).tolist() # [0] for the global block
-            cropped_data['block_embeddings0'] = [data['block_embeddings0'][i] for i in kept_blocks0]
-            kept_blocks1 = [0] + (segment1_keep_indices+1).tolist() # [0] for the global block
-            cropped_data['block_embeddings1'] = [data['block_embeddings1'][i] for i in kept_blocks1]
-        return cropped_data, kept_old_indices
+            for segment in [0, 1]:
+                kept_segment_blocks = np.concatenate([[0], keep_indices[segment] + 1]) # [0] for the global block
+                cropped_data[f'block_embeddings{segment}'] = np.asarray(data[f'block_embeddings{segment}'])[kept_segment_blocks]
+        return cropped_data, kept_old_indices.tolist()
+
+def torsion_rotated_parts(data, chosen_segment):
+    """
+    Rotatable edges of the chosen segment (side chains of its blocks or the whole segment, depending on the
+    type of its torsion mask) and the atoms rotated about them, with atom indexes into data['X'].
+    Returns:
+        edges [n_edges, 2], rotated_edge [n_pairs], rotated_atom [n_pairs] (see apply_torsion_updates),
+        None if the segment has no torsion angles
+    """
+    block_lengths, segment_ids = np.asarray(data['block_lengths']), np.asarray(data['segment_ids'])
+    atom_offsets = np.concatenate([[0], np.cumsum(block_lengths)])  # [Nb + 1], first atom of each block
+    start_block = np.sum(segment_ids < chosen_segment) + 1 # +1 to skip the global block at the beginning of each segment
+    # dense masks of datasets processed before the masks were packed
+    torsion_mask = pack_torsion_mask(data['torsion_mask'][chosen_segment], block_lengths[segment_ids == chosen_segment][1:])
+    if torsion_mask['edges'] is None:
+        return None
+    start_atoms = atom_offsets[start_block]
+    edges = np.asarray(torsion_mask['edges'], dtype=np.int64) + start_atoms
+    rotated_edge = np.repeat(np.arange(len(edges)), np.diff(torsion_mask['rotate_offsets']))
+    rotated_atom = np.asarray(torsion_mask['rotate_atoms'], dtype=np.int64) + start_atoms
+    return edges, rotated_edge, rotated_atom
+
 
 class TorsionNoiseTransform:
     def __init__(self, tor_sigma):
         self.tor_sigma = tor_sigma
+        torus_tables()  # built or mapped before DataLoader workers are forked, which then share them
 
     def __call__(self, data, chosen_segment):
         """
@@ -155,67 +324,30 @@ class TorsionNoiseTransform:
         if type(data['segment_ids']) == list:
             data["segment_ids"] = np.array(data["segment_ids"])
 
-        block_id = np.zeros(len(data['A'])) # [Nu]
-        block_id[np.cumsum(data['block_lengths'])[:-1]] = 1
-        block_id = np.cumsum(block_id)
-
-        start_block = np.sum(data["segment_ids"] < chosen_segment) + 1 # +1 to skip the global block at the beginning of each segment
+        parts = torsion_rotated_parts(data, chosen_segment)
+        if parts is None:
+            return data, None, torch.empty((2,0), dtype=torch.long)
+        torsion_edges, rotated_edge, rotated_atom = parts
+        torsion_updates = np.random.normal(0, self.tor_sigma, len(torsion_edges))
+        new_coords = apply_torsion_updates(data['X'], torsion_edges, rotated_edge, rotated_atom, torsion_updates)
 
+        atom_offsets = np.concatenate([[0], np.cumsum(data['block_lengths'])])  # [Nb + 1], first atom of each block
+        global_block = np.sum(data['segment_ids'] < chosen_segment)
+        global_atom = atom_offsets[global_block]
+        segment_atoms = np.sum(data['block_lengths'][data['segment_ids'] == chosen_segment])
         if data['torsion_mask'][chosen_segment]['type'] == 0:
             # sidechain
-            torsion_updates = []
-            torsion_edges = []
-
-            all_none = all([edges is None for edges in data['torsion_mask'][chosen_segment]['edges']])
-            if all_none:
-                return data, None, torch.empty((2,0), dtype=torch.long)
-
-            for i, (edges, mask_rotate) in enumerate(zip(data['torsion_mask'][chosen_segment]['edges'], data['torsion_mask'][chosen_segment]['mask_rotate'])):
-                if edges is None:
-                    continue
-                curr_block = start_block + i
-                curr_atoms = np.sum(block_id < curr_block)
-                num_atoms = data['block_lengths'][curr_block]
-
-                n_rotatable_edges = len(edges)
-                torsion_noise = np.random.normal(0, self.tor_sigma, n_rotatable_edges)
-                torsion_updates.append(torsion_noise)
-                coords = data['X'][curr_atoms:curr_atoms+num_atoms]
-                new_coords = modify_conformer_torsion_angles(coords, edges, mask_rotate, torsion_noise)
-                data['X'][curr_atoms:curr_atoms+num_atoms] = new_coords
-                torsion_edges.append(edges+curr_atoms)
-            torsion_updates = np.concatenate(torsion_updates)
-            torsion_edges = np.concatenate(torsion_edges, axis=0)
+            data['X'] = new_coords.astype(data['X'].dtype, copy=False)
         else:
-            # segment
-            edges = data['torsion_mask'][chosen_segment]['edges']
-            mask_rotate = data['torsion_mask'][chosen_segment]['mask_rotate']
-
-            if edges is None:
-                return data, None, torch.empty((2,0), dtype=torch.long)
-
-            start_atoms = np.sum(block_id < start_block)
-            
-            num_atoms = np.sum(data["block_lengths"][np.logical_and(
-                data['segment_ids'] == chosen_segment, 
-                np.arange(len(data['segment_ids'])) >= start_block
-            )])
-
-            coords = data['X'][start_atoms:start_atoms+num_atoms]
-            n_rotatable_edges = len(edges)
-            torsion_updates = np.random.normal(0, self.tor_sigma, n_rotatable_edges)
-
-            coords = data['X'][start_atoms:start_atoms+num_atoms]
-            new_coords = modify_conformer_torsion_angles(coords, edges, mask_rotate, torsion_updates)
+            # segment, aligned to the original conformer
+            start_atoms, end_atoms = global_atom + 1, global_atom + segment_atoms
+            coords = data['X'][start_atoms:end_atoms]
+            new_coords = new_coords[start_atoms:end_atoms]
             R, t = rigid_transform_Kabsch_3D(new_coords.T, coords.T)
             new_coords = (R @ new_coords.T + t).T
-            data['X'][start_atoms:start_atoms+num_atoms] = new_coords
-            torsion_edges = edges+start_atoms
+            data['X'][start_atoms:end_atoms] = new_coords
 
         # update global_block and global_atom
-        segment_atoms = np.sum(data['block_lengths'][data['segment_ids'] == chosen_segment])
-        global_block = np.sum(data['segment_ids'] < chosen_segment)
-        global_atom = np.sum(block_id < global_block)
         data['X'][global_atom] = data['X'][global_atom+1:global_atom+segment_atoms].mean(axis=0)
         # print(f"Torsion angle changes: {torsion_updates}")
         return data, torus_score(torsion_updates, self.tor_sigma), torsion_edges.T
@@ -294,10 +426,8 @@ class GlobalTranslationTransform:
 
 
 def _expansion(theta, sigma, L=2000):  # the summation term only
-    p = 0
-    for l in range(L):
-        p += (2 * l + 1) * np.exp(-l * (l + 1) * sigma**2) * np.sin(theta * (l + 1 / 2)) / np.sin(theta / 2)
-    return p
+    l = np.arange(L)[:, None]
+    return np.sum((2 * l + 1) * np.exp(-l * (l + 1) * sigma**2) * np.sin(theta * (l + 1 / 2)) / np.sin(theta / 2), axis=0)
 
 def _density(expansion, theta):
     density = expansion * (1 - np.cos(theta)) / np.pi
@@ -305,26 +435,32 @@ def _density(expansion, theta):
     return density / density.sum()
 
 def _score(exp, theta, sigma, L=2000):
-    dSigma = 0
-    for l in range(L):
-        hi = np.sin(theta * (l + 1 / 2))
-        dhi = (l + 1 / 2) * np.cos(theta * (l + 1 / 2))
-        lo = np.sin(theta / 2)
-        dlo = 1 / 2 * np.cos(theta / 2)
-        dSigma += (2 * l + 1) * np.exp(-l * (l + 1) * sigma**2) * (lo * dhi - hi * dlo) / (lo ** 2)
+    l = np.arange(L)[:, None]
+    hi = np.sin(theta * (l + 1 / 2))
+    dhi = (l + 1 / 2) * np.cos(theta * (l + 1 / 2))
+    lo = np.sin(theta / 2)
+    dlo = 1 / 2 * np.cos(theta / 2)
+    dSigma = np.sum((2 * l + 1) * np.exp(-l * (l + 1) * sigma**2) * (lo * dhi - hi * dlo) / (lo ** 2), axis=0)
     return dSigma / exp + np.sin(theta) / (1 - np.cos(theta))
 
+@lru_cache(maxsize=None)
+def _so3_tables(sigma, max_theta):
+    """IGSO(3) angles, their sampling density and score, shared by the transforms with the same parameters"""
+    theta_range = np.linspace(0.001, max_theta, 100)
+    expansion = _expansion(theta_range, sigma)
+    tables = theta_range, _density(expansion, theta_range), _score(expansion, theta_range, sigma)
+    for table in tables:
+        table.setflags(write=False)
+    return tables
+
 
 class GlobalRotationTransform:
     def __init__(self, rot_sigma, max_theta):
         # Source for SO3 transformation 
         # https://github.com/wengong-jin/DSMBind/blob/master/bindenergy/models/energy.py
         # https://github.com/gcorso/DiffDock/blob/main/utils/so3.py 
-        self.theta_range = np.linspace(0.001, max_theta, 100)
         self.sigma = rot_sigma
-        self.expansion = _expansion(self.theta_range, self.sigma)
-        self.density = _density(self.expansion, self.theta_range)
-        self.score = _score(self.expansion, self.theta_range, self.sigma)
+        self.theta_range, self.density, self.score = _so3_tables(float(rot_sigma), float(max_theta))
 
     def __call__(self, data, chosen_segment):
         """
@@ -365,4 +501,113 @@ class GlobalRotationTransform:
         data['X'][global_atom] = new_coords.mean(axis=0)
         rot_score = hat_w * self.score[tidx]
         # print(f"Global rotation: {theta}")
-        return data, np.squeeze(rot_score)
\ No newline at end of file
+        return data, np.squeeze(rot_score)
+
+
+class BatchNoiseTransform:
+    """
+    The noise of the pretraining datasets (global rotation and translation, then torsion or atom noise of the noisy
+    segment of each item) applied to a collated batch of clean items as tensor ops on the device of the batch,
+    instead of per item in the DataLoader workers (see set_batch_noise of the pretraining datasets).
+    Noise levels that are None are not applied.
+    """
+    def __init__(self, tor_sigma=None, atom_sigma=None, tr_sigma=None, rot_sigma=None, max_theta=np.pi/4):
+        self.tor_sigma = tor_sigma
+        if tor_sigma is not None:
+            torus_tables()
+        self.atom_sigma = atom_sigma
+        self.tr_sigma = tr_sigma
+        self.global_rot = None if rot_sigma is None else GlobalRotationTransform(rot_sigma, max_theta)
+
+    def __call__(self, batch):
+        """
+        Apply the noise to a batch of clean items
+        Args:
+            batch: collated batch with the clean coordinates 'X' [Natom, 3] and
+                'noisy_segment' [Nbatch], 'noisy_atom_range' [Nbatch, 2] (global atom of the noisy segment and the
+                end of its atoms), 'can_rotate' [Nbatch],
+                'tor_edges' [2, n_edges], 'tor_rotated' [2, n_pairs], 'tor_batch' [n_edges] and 'tor_align' [Nbatch]
+                for torsion noise (None for atom noise),
+                'atom_map' [Natom], new index of each atom if the atoms of masked blocks are merged
+        Returns:
+            the batch with noisy coordinates and the scores of the noise, as the collate_fn of datasets with
+            per-item noise returns them
+        """
+        X = batch['X']
+        device = X.device
+        bs = len(batch['noisy_segment'])
+        global_atom, end_atom = batch['noisy_atom_range'].T
+        # non-global atoms of the noisy segment of each item
+        n_noisy = end_atom - global_atom - 1
+        noisy_batch = torch.repeat_interleave(torch.arange(bs, device=device), n_noisy)
+        first = torch.cumsum(n_noisy, dim=0) - n_noisy
+        noisy_atoms = global_atom[noisy_batch] + 1 + torch.arange(len(noisy_batch), device=device) - first[noisy_batch]
+
+        def segment_center(X):
+            return scatter_mean(X[noisy_atoms], noisy_batch, dim=0, dim_size=bs)
+
+        X = X.clone()
+        rot_score = torch.zeros(bs, 3, dtype=X.dtype, device=device)
+        if self.global_rot is not None:
+            # segment length 2 means only one atom + global node, no need to rotate
+            rotated = batch['can_rotate']
+            density = torch.tensor(self.global_rot.density, device=device)
+            tidx = torch.multinomial(density, bs, replacement=True)
+            theta = torch.tensor(self.global_rot.theta_range, dtype=X.dtype, device=device)[tidx]
+            w = torch.randn(bs, 3, dtype=X.dtype, device=device)
+            hat_w = w / torch.linalg.norm(w, dim=-1, keepdim=True)
+            R = _rodrigues_torch(hat_w, theta * rotated)
+            center = segment_center(X)[noisy_batch]
+            X[noisy_atoms] = torch.einsum('nij,nj->ni', R[noisy_batch], X[noisy_atoms] - center) + center
+            X[global_atom[rotated]] = segment_center(X)[rotated]
+            score = torch.tensor(self.global_rot.score, dtype=X.dtype, device=device)
+            rot_score = hat_w * score[tidx][:, None] * rotated[:, None]
+
+        tr_score = torch.zeros(bs, 3, dtype=X.dtype, device=device)
+        tr_eps = torch.zeros(bs, dtype=X.dtype, device=device)
+        if self.tr_sigma is not None:
+            tr_eps = torch.rand(bs, dtype=X.dtype, device=device) * (self.tr_sigma - 0.1) + 0.1
+            tr_score = torch.randn(bs, 3, dtype=X.dtype, device=device)
+            shift = tr_score * tr_eps[:, None]
+            X[noisy_atoms] = X[noisy_atoms] + shift[noisy_batch]
+            X[global_atom] = X[global_atom] + shift
+
+        if batch['tor_edges'] is not None:
+            assert self.tor_sigma is not None, "Torsion noise transform not set"
+            tor_edges = batch['tor_edges']
+            rotated_edge, rotated_atom = batch['tor_rotated']
+            torsion_updates = torch.randn(tor_edges.shape[1], dtype=X.dtype, device=device) * self.tor_sigma
+            new_X = apply_torsion_updates_torch(X, tor_edges.T, rotated_edge, rotated_atom, torsion_updates)
+            # rotated segments are aligned to the original conformer
+            align = batch['tor_align'][noisy_batch]
+            if align.any():
+                atoms, atom_batch = noisy_atoms[align], noisy_batch[align]
+                R, t = rigid_transform_Kabsch_3D_torch(new_X[atoms], X[atoms], atom_batch, bs)
+                new_X[atoms] = torch.einsum('nij,nj->ni', R[atom_batch], new_X[atoms]) + t[atom_batch]
+            X = new_X
+            has_torsion = torch.bincount(batch['tor_batch'], minlength=bs) > 0
+            X[global_atom[has_torsion]] = segment_center(X)[has_torsion]
+            batch['tor_score'] = torus_score_torch(torsion_updates, self.tor_sigma).to(X.dtype)
+        else:
+            atom_score = torch.zeros_like(X)
+            atom_eps = torch.zeros(bs, dtype=X.dtype, device=device)
+            if self.atom_sigma is not None:
+                atom_eps = torch.rand(bs, dtype=X.dtype, device=device) * (self.atom_sigma - 0.1) + 0.1
+                noise = torch.randn(len(noisy_atoms), 3, dtype=X.dtype, device=device)
+                original_global = X[global_atom]
+                X[noisy_atoms] = X[noisy_atoms] + noise * atom_eps[noisy_batch, None]
+                X[global_atom] = segment_center(X)
+                atom_score[noisy_atoms] = -noise
+                atom_score[global_atom] = (original_global - X[global_atom]) / atom_eps[:, None]
+            batch['atom_score'], batch['atom_eps'] = atom_score, atom_eps
+
+        if batch.get('atom_map', None) is not None:
+            # atoms of masked blocks are merged into their centers
+            atom_map = batch['atom_map']
+            X = scatter_mean(X, atom_map, dim=0, dim_size=len(batch['A']))
+            if batch['tor_edges'] is not None:
+                batch['tor_edges'] = atom_map[batch['tor_edges']]
+
+        batch['X'] = X
+        batch['rot_score'], batch['tr_score'], batch['tr_eps'] = rot_score, tr_score, tr_eps
+        return batch
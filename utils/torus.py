@@ -1,43 +1,91 @@
-import numpy as np
-import tqdm
 import os
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+import torch
+
+from .logger import print_log
 
 """
     Source: https://github.com/gcorso/DiffDock/blob/main/utils/torus.py
-    Preprocessing for the SO(2)/torus sampling and score computations, truncated infinite series are computed and then
-    cached to memory, therefore the precomputation is only run the first time the repository is run on a machine
+    Preprocessing for the SO(2)/torus sampling and score computations, truncated infinite series are computed on first
+    use and cached to disk (see cache_dir), therefore the precomputation is only run the first time on a machine
 """
 
 
-def p(x, sigma, N=10):
-    p_ = 0
-    for i in tqdm.trange(-N, N + 1, desc='torus calculating p'):
-        p_ += np.exp(-(x + 2 * np.pi * i) ** 2 / 2 / sigma ** 2)
-    return p_
-
-
-def grad(x, sigma, N=10):
-    p_ = 0
-    for i in tqdm.trange(-N, N + 1, desc='torus calculating grad'):
-        p_ += (x + 2 * np.pi * i) / sigma ** 2 * np.exp(-(x + 2 * np.pi * i) ** 2 / 2 / sigma ** 2)
-    return p_
-
-
 X_MIN, X_N = 1e-5, 5000  # relative to pi
 SIGMA_MIN, SIGMA_MAX, SIGMA_N = 3e-3, 2, 5000  # relative to pi
+N_TERMS = 100
+TABLE_VERSION = 1
 
 x = 10 ** np.linspace(np.log10(X_MIN), 0, X_N + 1) * np.pi
 sigma = 10 ** np.linspace(np.log10(SIGMA_MIN), np.log10(SIGMA_MAX), SIGMA_N + 1) * np.pi
 
-if os.path.exists('.p.npy') and os.path.exists('.score.npy'):
-    p_ = np.load('.p.npy')
-    score_ = np.load('.score.npy')
-else:
-    p_ = p(x, sigma[:, None], N=100)
-    np.save('.p.npy', p_)
 
-    score_ = grad(x, sigma[:, None], N=100) / p_
-    np.save('.score.npy', score_)
+def cache_dir():
+    """$ATOMICA_CACHE_DIR, by default $XDG_CACHE_HOME/atomica (~/.cache/atomica)"""
+    default = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'atomica')
+    return os.environ.get('ATOMICA_CACHE_DIR', default)
+
+
+def _p_and_grad(x, sigma, N, chunk=256):
+    """
+    wrapped normal density of x and its derivative for each sigma [n_sigma, n_x], truncated to the terms -N..N.
+    Terms of exp(-(x + 2 pi i)^2 / 2 sigma^2) below the smallest double are exactly 0, so each chunk of sigmas
+    only sums the terms that can be nonzero (in the same order), which gives the same tables as summing all terms
+    """
+    p_, grad_ = np.zeros((len(sigma), len(x))), np.zeros((len(sigma), len(x)))
+    for start in range(0, len(sigma), chunk):
+        s = sigma[start:start + chunk, None]
+        # smallest |x + 2 pi i| is 2 pi |i| - pi, exp underflows to 0 below -745.2
+        n = min(N, int((np.sqrt(2 * 746) * s.max() + np.pi) / (2 * np.pi)) + 1)
+        for i in range(-n, n + 1):
+            shifted = x + 2 * np.pi * i
+            term = np.exp(-shifted ** 2 / 2 / s ** 2)
+            p_[start:start + chunk] += term
+            grad_[start:start + chunk] += shifted / s ** 2 * term
+    return p_, grad_
+
+
+def _build_tables():
+    p_, grad_ = _p_and_grad(x, sigma, N=N_TERMS)
+    with np.errstate(invalid='ignore'):  # nan where p underflows, as in the original tables
+        return {'p': p_, 'score': grad_ / p_}
+
+
+def _cached_tables(name, params, build):
+    """
+    tables built by build() (a dict of arrays), saved to the cache directory under a name derived from params and
+    memory-mapped read-only, so that processes (e.g. DataLoader workers) share one copy. Built in memory if the cache
+    directory is not writable.
+    """
+    key = hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+    paths = {k: os.path.join(cache_dir(), f'{name}_{key}.{k}.npy') for k in params['tables']}
+    if not all(os.path.exists(path) for path in paths.values()):
+        tables = build()
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+            for k, path in paths.items():
+                # concurrent builds each write their own file, the rename is atomic
+                tmp = f'{path}.{os.getpid()}.tmp'
+                with open(tmp, 'wb') as fout:
+                    np.save(fout, tables[k])
+                os.replace(tmp, path)
+        except OSError as e:
+            print_log(f'Cannot save the {name} tables to {cache_dir()} ({e}), set ATOMICA_CACHE_DIR to a writable directory', level='WARN')
+            return tables
+    return {k: np.load(path, mmap_mode='r') for k, path in paths.items()}
+
+
+@lru_cache(maxsize=None)
+def tables():
+    """probability and score tables [SIGMA_N + 1, X_N + 1], built on first use"""
+    params = {
+        'version': TABLE_VERSION, 'x': (X_MIN, X_N), 'sigma': (SIGMA_MIN, SIGMA_MAX, SIGMA_N),
+        'n_terms': N_TERMS, 'tables': ('p', 'score'),
+    }
+    return _cached_tables('torus', params, _build_tables)
 
 
 def score(x, sigma):
@@ -49,7 +97,20 @@ def score(x, sigma):
     sigma = np.log(sigma / np.pi)
     sigma = (sigma - np.log(SIGMA_MIN)) / (np.log(SIGMA_MAX) - np.log(SIGMA_MIN)) * SIGMA_N
     sigma = np.round(np.clip(sigma, 0, SIGMA_N)).astype(int)
-    return -sign * score_[sigma, x]
+    return -sign * tables()['score'][sigma, x]
+
+
+def score_torch(x, sigma):
+    """score of x (a tensor) for a single sigma, looked up on the device of x"""
+    x = (x + np.pi) % (2 * np.pi) - np.pi
+    sign = torch.sign(x)
+    x = torch.log(torch.abs(x) / np.pi)
+    x = (x - np.log(X_MIN)) / (0 - np.log(X_MIN)) * X_N
+    x = torch.round(torch.clamp(x, 0, X_N)).long()
+    sigma = np.log(sigma / np.pi)
+    sigma = (sigma - np.log(SIGMA_MIN)) / (np.log(SIGMA_MAX) - np.log(SIGMA_MIN)) * SIGMA_N
+    sigma = int(np.round(np.clip(sigma, 0, SIGMA_N)))
+    return -sign * torch.as_tensor(np.array(tables()['score'][sigma]), dtype=sign.dtype, device=sign.device)[x]
 
 
 def p(x, sigma):
@@ -60,7 +121,7 @@ def p(x, sigma):
     sigma = np.log(sigma / np.pi)
     sigma = (sigma - np.log(SIGMA_MIN)) / (np.log(SIGMA_MAX) - np.log(SIGMA_MIN)) * SIGMA_N
     sigma = np.round(np.clip(sigma, 0, SIGMA_N)).astype(int)
-    return p_[sigma, x]
+    return tables()['p'][sigma, x]
 
 
 def sample(sigma):
@@ -69,15 +130,17 @@ def sample(sigma):
     return out
 
 
-score_norm_ = score(
-    sample(sigma[None].repeat(10000, 0).flatten()),
-    sigma[None].repeat(10000, 0).flatten()
-).reshape(10000, -1)
-score_norm_ = (score_norm_ ** 2).mean(0)
+@lru_cache(maxsize=None)
+def _score_norm():
+    # Monte Carlo estimate of E[score^2] for each sigma, with a fixed seed so it does not consume the global random state
+    samples = np.random.RandomState(0).randn(10000, len(sigma)) * sigma[None]
+    samples = (samples + np.pi) % (2 * np.pi) - np.pi
+    score_norm_ = score(samples.flatten(), sigma[None].repeat(10000, 0).flatten()).reshape(10000, -1)
+    return (score_norm_ ** 2).mean(0)
 
 
 def score_norm(sigma):
     sigma = np.log(sigma / np.pi)
     sigma = (sigma - np.log(SIGMA_MIN)) / (np.log(SIGMA_MAX) - np.log(SIGMA_MIN)) * SIGMA_N
     sigma = np.round(np.clip(sigma, 0, SIGMA_N)).astype(int)
-    return score_norm_[sigma]
\ No newline at end of file
+    return _score_norm()[sigma]